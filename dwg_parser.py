@@ -5,11 +5,13 @@ import win32com.client
 import pythoncom
 import psutil  # Для завершения процессов
 import logging
+from rule_engine import rule_compiler
 
 class AutoCADProcessor:
     def __init__(self, replacement_digit, project, rules, logger=None):
         pythoncom.CoInitialize()
         self.replacement_digit = str(replacement_digit)
+        self.project = project
         self.logger = logger or logging.getLogger()
         self.logger.log(logging.DEBUG, f"Инициализация AutoCADProcessor с цифрой: {self.replacement_digit} и проектом: {project}")
         self.patterns = self._load_patterns(rules)
@@ -18,21 +20,9 @@ class AutoCADProcessor:
         self._initialize_autocad()
 
     def _load_patterns(self, rules):
-        patterns = []
-        try:
-            for rule_name, rule in rules.items():
-                try:
-                    pattern = eval(rule["pattern"], {"re": re})
-                    replacement = eval(rule["replacement"], {"self": self})
-                    patterns.append((pattern, replacement))
-                    self.logger.log(logging.DEBUG, f"Загружено правило '{rule_name}'")
-                except Exception as e:
-                    self.logger.log(logging.ERROR, f"Ошибка загрузки правила '{rule_name}': {e}")
-        except Exception as e:
-            self.logger.log(logging.ERROR, f"Ошибка обработки rules: {e}")
-        if not patterns:
-            self.logger.log(logging.DEBUG, "Предупреждение: Нет patterns для этого парсера")
-        return patterns
+        self.rule_set = rule_compiler.get(rules, self.replacement_digit, project=self.project,
+                                          parser='dwg_parser', logger=self.logger)
+        return self.rule_set.patterns
 
     def _initialize_autocad(self):
         retries = 3
@@ -88,10 +78,7 @@ class AutoCADProcessor:
         if not text:
             return text
         original = text
-        new_text = text
-        for pattern, repl in self.patterns:
-            if pattern.search(new_text):
-                new_text = pattern.sub(repl, new_text) if callable(repl) else pattern.sub(repl, new_text)
+        new_text = self.rule_set.apply(text)
         if new_text != original:
             self.logger.log(logging.DEBUG, f"Замена: {original} → {new_text}")
         return new_text
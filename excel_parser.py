@@ -1,10 +1,18 @@
+import io
 import os
 import re
+import struct
+import threading
 from shutil import rmtree
 from tempfile import mkdtemp
-from zipfile import ZipFile
+from zipfile import ZipFile, BadZipFile
 from lxml import etree as ET
 import logging
+from rule_engine import rule_compiler
+from ooxml_package import (rewrite_package, package_may_match, stream_rewrite_xml, discover_parts, DOCPROPS_TYPES, DRAWING_TYPES,
+                           EMBEDDED_PACKAGE_TYPES, MAX_EMBED_DEPTH, local_name, text_nodes, split_runs)
+from ole_package import CompoundFile, xls_text_slots, patch_slots
+from xlsb_package import rewrite_records
 
 
 try:
@@ -12,68 +20,298 @@ try:
 except ImportError:
     win32 = None
 
+# Листы больше этого размера (байт, в распакованном виде) обрабатываются потоково.
+STREAM_PART_SIZE = 32 * 1024 * 1024
+SPREADSHEET_NS = {'a': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+_FORMULA_TAG = '{%s}f' % SPREADSHEET_NS['a']
+_TEXT_TAG = '{%s}t' % SPREADSHEET_NS['a']
+_RUN_TAG = '{%s}r' % SPREADSHEET_NS['a']
+_CELL_TAG = '{%s}c' % SPREADSHEET_NS['a']
+_VALUE_TAG = '{%s}v' % SPREADSHEET_NS['a']
+_HEADER_FOOTER_TAG = '{%s}headerFooter' % SPREADSHEET_NS['a']
+# Строки с форматированием по фрагментам: общие строки, inline-строки, текст примечаний
+_RICH_TEXT_TAGS = tuple('{%s}%s' % (SPREADSHEET_NS['a'], name) for name in ('si', 'is', 'text'))
+_XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+
+SHARED_STRINGS_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml'
+WORKSHEET_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+# Части .xlsb в формате BIFF12
+XLSB_BINARY_TYPES = frozenset({
+    'application/vnd.ms-excel.sharedStrings',
+    'application/vnd.ms-excel.worksheet',
+})
+# Части книги, в которых есть текст для замены
+EXCEL_TEXT_TYPES = frozenset({
+    SHARED_STRINGS_TYPE,
+    WORKSHEET_TYPE,
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.comments+xml',
+    'application/vnd.ms-excel.threadedcomments+xml',
+}) | XLSB_BINARY_TYPES | DOCPROPS_TYPES | DRAWING_TYPES | frozenset(EMBEDDED_PACKAGE_TYPES)
+
+
+def _text_groups(elements):
+    """Текст SpreadsheetML для замены без обхода всех ячеек: [(узлы, имя элемента)].
+
+    Затрагиваются строки si/is/text (t и r/t; текст нескольких фрагментов r
+    склеивается в одну строку), формулы c/f, строковые результаты формул
+    (c t="str"/v) и колонтитулы headerFooter. Числа и индексы общих строк
+    в c/v не трогаются.
+    """
+    groups = []
+    for root in elements:
+        for elem in root.iter(_CELL_TAG, _FORMULA_TAG, _HEADER_FOOTER_TAG, *_RICH_TEXT_TAGS):
+            if elem.tag == _CELL_TAG:
+                value = elem.find(_VALUE_TAG) if elem.get('t') == 'str' else None
+                if value is not None and value.text:
+                    groups.append(([value], 'v'))
+            elif elem.tag == _FORMULA_TAG:
+                if elem.text:
+                    groups.append(([elem], 'f'))
+            elif elem.tag == _HEADER_FOOTER_TAG:
+                groups.extend(([child], local_name(child)) for child in elem
+                              if isinstance(child.tag, str) and child.text)
+            else:
+                nodes = [child if child.tag == _TEXT_TAG else child.find(_TEXT_TAG)
+                         for child in elem if child.tag in (_TEXT_TAG, _RUN_TAG)]
+                nodes = [node for node in nodes if node is not None]
+                if any(node.text for node in nodes):
+                    groups.append((nodes, 't'))
+    return groups
+
+
 class ExcelProcessor:
-    def __init__(self, replacement_digit, project, rules, logger=None):
+    def __init__(self, replacement_digit, project, rules, logger=None, stream_threshold=STREAM_PART_SIZE,
+                 project_rules=None, embed_depth=0, workers=None):
+        """
+        :param project_rules: Все разделы правил проекта ({"word_parser": ..., "excel_parser": ...})
+            для вложенных объектов; по умолчанию вложенные книги обрабатываются правилами rules,
+            а вложенные документы Word копируются без изменений.
+        :param embed_depth: Уровень вложенности пакета (0 - файл на диске).
+        :param workers: Число потоков обработки частей пакета (см. rewrite_package).
+        """
         self.replacement_digit = str(replacement_digit)
+        self.project = project
         self.logger = logger or logging.getLogger()
+        self.stream_threshold = stream_threshold
+        self.project_rules = project_rules if project_rules is not None else {'excel_parser': rules}
+        self.embed_depth = embed_depth
+        self.workers = workers
+        self._part_types = {}
+        self._embedded_processors = {}
+        # части обрабатываются в нескольких потоках, а вложенный процессор хранит состояние пакета
+        self._embed_lock = threading.Lock()
         self.patterns = self._load_patterns(rules)
 
     def _load_patterns(self, rules):
-        patterns = []
-        try:
-            for rule_name, rule in rules.items():
-                try:
-                    pattern = eval(rule["pattern"], {"re": re})
-                    replacement = eval(rule["replacement"], {"self": self})
-                    patterns.append((pattern, replacement))
-                    self.logger.log(logging.DEBUG, f"Загружено правило '{rule_name}'")
-                except Exception as e:
-                    pass
-                self.logger.log(logging.DEBUG, f"Ошибка загрузки правила '{rule_name}': {e}")
-        except Exception as e:
-            pass
-            self.logger.log(logging.DEBUG, f"Ошибка обработки rules: {e}")
-        if not patterns:
-            pass
-            self.logger.log(logging.DEBUG, "Предупреждение: Нет patterns для этого парсера")
-        return patterns
+        self.rule_set = rule_compiler.get(rules, self.replacement_digit, project=self.project,
+                                          parser='excel_parser', logger=self.logger)
+        return self.rule_set.patterns
 
     def _apply_replacements(self, text):
         if text is None:
             return None
         original_text = text
-        for pattern, repl in self.patterns:
-            text = pattern.sub(repl, text)
+        text = self.rule_set.apply(text)
         if text != original_text:
             self.logger.log(logging.DEBUG, f"Замена текста: '{original_text}' → '{text}'")
         return text
 
-    def _process_xml_tree(self, tree):
+    def _apply_replacements_batch(self, texts, part=None, elements=None):
+        """Пакетный вариант _apply_replacements для всех строк части документа.
+
+        elements - имена элементов строк для правил со scope (см. RuleSet.scoped).
+        """
+        if elements is None:
+            results = self.rule_set.apply_batch(texts)
+        else:
+            results = self.rule_set.apply_scoped(part, elements, texts)
+        changes = {(old, new) for old, new in zip(texts, results) if old != new}
+        for old, new in changes:
+            self.logger.log(logging.DEBUG, f"Замена текста: '{old}' → '{new}'")
+        return results
+
+    def _process_text_groups(self, groups, part=None):
+        """Применяет правила к группам из _text_groups; возвращает True, если текст изменился."""
+        texts = [''.join(node.text or '' for node in nodes) for nodes, _ in groups]
+        new_texts = self._apply_replacements_batch(texts, part, [element for _, element in groups])
         modified = False
-        nsmap = {'a': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
-        for elem in tree.iter():
-            if elem.text:
-                new_text = self._apply_replacements(elem.text)
-                if new_text != elem.text:
-                    elem.text = new_text
-                    modified = True
-            if elem.tail:
-                new_tail = self._apply_replacements(elem.tail)
-                if new_tail != elem.tail:
-                    elem.tail = new_tail
-                    modified = True
+        for (nodes, _), text, new_text in zip(groups, texts, new_texts):
+            if new_text == text:
+                continue
+            modified = True
+            values = [new_text] if len(nodes) == 1 else split_runs([node.text or '' for node in nodes], new_text)
+            for node, value in zip(nodes, values):
+                node.text = value
+                if node.tag == _TEXT_TAG and value != value.strip():
+                    node.set(_XML_SPACE, 'preserve')
         return modified
 
+    def _process_xml_tree(self, tree, part=None):
+        root = tree.getroot()
+        if ET.QName(root).namespace == SPREADSHEET_NS['a']:
+            # лист, общие строки, примечания
+            return self._process_text_groups(_text_groups([root]), part)
+        modified = False
+        nodes = text_nodes(tree)
+        new_values = self._apply_replacements_batch([value for _, _, value, _ in nodes], part,
+                                                    [element for _, _, _, element in nodes])
+        for (elem, attr, value, _), new_value in zip(nodes, new_values):
+            if new_value != value:
+                setattr(elem, attr, new_value)
+                modified = True
+        return modified
+
+    def _process_part(self, fname, data):
+        """Обрабатывает XML-часть пакета; возвращает новые байты или None, если изменений нет."""
+        try:
+            parser = ET.XMLParser(remove_blank_text=True)
+            tree = ET.fromstring(data, parser).getroottree()
+        except ET.XMLSyntaxError as e:
+            self.logger.log(logging.DEBUG, f"Ошибка XML в {fname}: {e}")
+            return None
+        if not self._process_xml_tree(tree, fname):
+            return None
+        self.logger.log(logging.DEBUG, f"Файл изменен: {fname}")
+        return ET.tostring(tree, encoding='UTF-8', xml_declaration=True, pretty_print=True)
+
+    def _process_sheet_chunk(self, elements, part=None):
+        """Обрабатывает пачку элементов части в потоковом режиме (строки листа, si, headerFooter)."""
+        return self._process_text_groups(_text_groups(elements), part)
+
+    def _process_sheet_stream(self, fname, src, dst):
+        modified = stream_rewrite_xml(src, dst, ('sheetData',),
+                                      lambda elements: self._process_sheet_chunk(elements, fname))
+        if modified:
+            self.logger.log(logging.DEBUG, f"Файл изменен: {fname}")
+        return modified
+
+    def _process_binary_stream(self, fname, src, dst):
+        """Обрабатывает двоичную часть .xlsb (общие строки или лист) из потока src в dst."""
+        modified = rewrite_records(src, dst,
+                                   lambda texts, elements: self._apply_replacements_batch(texts, fname, elements))
+        if modified:
+            self.logger.log(logging.DEBUG, f"Файл изменен: {fname}")
+        return modified
+
+    def _process_binary_part(self, fname, data):
+        out = io.BytesIO()
+        if not self._process_binary_stream(fname, io.BytesIO(data), out):
+            return None
+        return out.getvalue()
+
+    def _embedded_processor(self, parser):
+        if parser not in self._embedded_processors:
+            rules = self.project_rules.get(parser)
+            if rules is None:
+                return None
+            if parser == 'excel_parser':
+                processor_class = ExcelProcessor
+            else:
+                from word_parser import WordProcessor as processor_class  # word_parser импортирует этот модуль
+            self._embedded_processors[parser] = processor_class(
+                self.replacement_digit, self.project, rules, logger=self.logger,
+                project_rules=self.project_rules, embed_depth=self.embed_depth + 1, workers=1)
+        return self._embedded_processors[parser]
+
+    def _process_embedded(self, fname, data):
+        """Обрабатывает вложенный пакет (объект Excel или Word) в памяти; возвращает новые байты или None."""
+        if self.embed_depth >= MAX_EMBED_DEPTH:
+            self.logger.log(logging.DEBUG, f"Пропущен вложенный объект (слишком глубокая вложенность): {fname}")
+            return None
+        processor = self._embedded_processor(EMBEDDED_PACKAGE_TYPES[self._part_types[fname]])
+        if processor is None:
+            self.logger.log(logging.DEBUG, f"Пропущен вложенный объект (нет правил): {fname}")
+            return None
+        self.logger.log(logging.DEBUG, f"Обработка вложенного объекта: {fname}")
+        try:
+            with self._embed_lock:
+                return processor.process_bytes(data)
+        except (BadZipFile, ValueError, KeyError, ET.XMLSyntaxError) as e:
+            self.logger.log(logging.DEBUG, f"Вложенный объект {fname} не обработан: {e}")
+            return None
+
+    def _process_package_part(self, fname, data):
+        content_type = self._part_types.get(fname)
+        if content_type in XLSB_BINARY_TYPES:
+            return self._process_binary_part(fname, data)
+        if content_type in EMBEDDED_PACKAGE_TYPES:
+            return self._process_embedded(fname, data)
+        return self._process_part(fname, data)
+
+    def _process_package_stream(self, fname, src, dst):
+        content_type = self._part_types.get(fname)
+        if content_type in XLSB_BINARY_TYPES:
+            return self._process_binary_stream(fname, src, dst)
+        if content_type in (SHARED_STRINGS_TYPE, WORKSHEET_TYPE):
+            return self._process_sheet_stream(fname, src, dst)
+        # прочие большие части (диаграммы, примечания, вложенные объекты) обрабатываются целиком
+        data = src.read()
+        new_data = self._process_package_part(fname, data)
+        dst.write(data if new_data is None else new_data)
+        return new_data is not None
+
+    def _process_xls_inplace(self, input_path, output_path):
+        """Замена строк .xls прямо в потоке Workbook, без Excel.
+
+        :return: True, если файл записан; False - нужна конвертация в .xlsm.
+        """
+        try:
+            compound = CompoundFile.open(input_path)
+            workbook = compound.read_stream('Workbook')
+            slots = xls_text_slots(workbook)
+        except (ValueError, KeyError, struct.error) as e:
+            self.logger.log(logging.DEBUG, f"Замена на месте невозможна ({input_path}): {e}")
+            return False
+        new_texts = self._apply_replacements_batch([slot.text for slot in slots],
+                                                   elements=[slot.element for slot in slots])
+        patched, info = patch_slots(workbook, slots, new_texts)
+        if not patched:
+            self.logger.log(logging.DEBUG, f"Замена на месте невозможна ({input_path}): {info}")
+            return False
+        compound.write_stream('Workbook', workbook)
+        compound.save(output_path)
+        self.logger.log(logging.DEBUG, f"Изменено строк: {info}. Файл обработан без конвертации: {output_path}")
+        return True
+
+    def process_package(self, input_path, output_path):
+        """Переписывает пакет OOXML (путь или файловый объект); возвращает имена изменённых частей."""
+        with ZipFile(input_path) as zip_in:
+            self._part_types = discover_parts(zip_in, EXCEL_TEXT_TYPES)
+        self.logger.log(logging.DEBUG, f"Части с текстом: {', '.join(self._part_types)}")
+        return rewrite_package(input_path, output_path, self._part_types, self._process_package_part,
+                               logger=self.logger, stream_part=self._process_package_stream,
+                               stream_threshold=self.stream_threshold, workers=self.workers)
+
+    def process_bytes(self, data):
+        """Обрабатывает пакет в памяти; возвращает новые байты или None, если изменений нет."""
+        output = io.BytesIO()
+        if not self.process_package(io.BytesIO(data), output):
+            return None
+        return output.getvalue()
+
+    def may_change(self, input_path):
+        """Быстрая проверка пакета без разбора XML: False, если обработка точно ничего не изменит
+        (тогда файл можно просто скопировать). Для .xls всегда True.
+        """
+        if input_path.lower().endswith('.xls'):
+            return True
+        try:
+            with ZipFile(input_path) as zip_in:
+                return package_may_match(zip_in, EXCEL_TEXT_TYPES, self.rule_set.could_match)
+        except (BadZipFile, ValueError, KeyError, OSError):
+            return True
+
     def process_file(self, input_path, output_path):
-        tmp_dir = mkdtemp()
+        tmp_dir = None
         self.logger.log(logging.DEBUG, f"Открыт файл: {input_path}")
-        modified_files = set()
-        converted = False
-        temp_input = None
 
         try:
             if input_path.lower().endswith('.xls'):
+                if self._process_xls_inplace(input_path, output_path):
+                    return True
+                output_path = os.path.splitext(output_path)[0] + '.xlsm'
                 self.logger.log(logging.DEBUG, f"Обнаружен .xls файл. Конвертируем в .xlsm...")
+                tmp_dir = mkdtemp()
                 temp_input = os.path.join(tmp_dir, 'converted.xlsm')
 
                 if win32:
@@ -89,34 +327,8 @@ class ExcelProcessor:
                         "pywin32 не установлен. Установите 'pip install pywin32' для конвертации на Windows.")
 
                 input_path = temp_input
-                converted = True
 
-            with ZipFile(input_path) as zip_in:
-                filenames = zip_in.namelist()
-                zip_in.extractall(tmp_dir)
-
-            target_files = ['xl/sharedStrings.xml']
-            target_files += [f for f in filenames if f.startswith('xl/worksheets/sheet')]
-
-            for fname in target_files:
-                full_path = os.path.join(tmp_dir, fname)
-                if not os.path.exists(full_path) or os.path.getsize(full_path) == 0:
-                    self.logger.log(logging.DEBUG, f"Пропущен файл (отсутствует или пуст): {fname}")
-                    continue
-                try:
-                    parser = ET.XMLParser(remove_blank_text=True)
-                    tree = ET.parse(full_path, parser)
-                    modified = self._process_xml_tree(tree)
-                    if modified:
-                        tree.write(full_path, encoding='UTF-8', xml_declaration=True, pretty_print=True)
-                        modified_files.add(fname)
-                        self.logger.log(logging.DEBUG, f"Файл изменен: {fname}")
-                except ET.XMLSyntaxError as e:
-                    self.logger.log(logging.DEBUG, f"Ошибка XML в {fname}: {e}")
-
-            with ZipFile(output_path, 'w') as zip_out:
-                for fname in filenames:
-                    zip_out.write(os.path.join(tmp_dir, fname), fname)
+            self.process_package(input_path, output_path)
 
             self.logger.log(logging.DEBUG, f"Файл успешно обработан: {output_path}")
             return True
@@ -126,4 +338,5 @@ class ExcelProcessor:
             return False
 
         finally:
-            rmtree(tmp_dir, ignore_errors=True)
\ No newline at end of file
+            if tmp_dir:
+                rmtree(tmp_dir, ignore_errors=True)
@@ -5,14 +5,23 @@ import logging
 from excel_parser import ExcelProcessor
 from word_parser import WordProcessor
 from dwg_parser import AutoCADProcessor
+from fast_copy import copy_verbatim
 from config_handler import config_data
+from rule_engine import rule_compiler, replacement_cache, rule_profiler
 
 
 class FileHandler():
-    def __init__(self, input_folder, project, replacement_digit, config_data=config_data, logger=None):
+    def __init__(self, input_folder, project, replacement_digit, config_data=config_data, logger=None,
+                 profile=False, workers=None):
         self.project = project
         self.input_folder = input_folder
         self.output_folder = input_folder + "_processed"
+        # Отчёт профилировщика правил пишется рядом с папкой _processed
+        self.profile = profile
+        self.profile_path = input_folder + "_rules_profile"
+        # Потоков на распаковку/сжатие частей одного файла и процессов на страницы PDF
+        # (None - по числу ядер, не больше 4)
+        self.workers = workers
         self.processed_files_counter = 0
         self.files = []
         self.replacement_digit = replacement_digit
@@ -31,52 +40,63 @@ class FileHandler():
         word_files = glob.glob(os.path.join(self.input_folder, '*.do*'))
         dwg_files = glob.glob(os.path.join(self.input_folder, '*.dwg'))
         sha_files = glob.glob(os.path.join(self.input_folder, '*.sha'))
-        self.files = excel_files + word_files + dwg_files + sha_files
+        pdf_files = glob.glob(os.path.join(self.input_folder, '*.pdf'))
+        self.files = excel_files + word_files + dwg_files + sha_files + pdf_files
         return self.files
 
+    def _process_or_copy(self, processor, input_path, output_path):
+        """Обрабатывает файл процессором Word/Excel или копирует его, если правила ничего не изменят."""
+        if processor.may_change(input_path):
+            return processor.process_file(input_path, output_path)
+        method = copy_verbatim(input_path, output_path)
+        self.logger.log(logging.DEBUG, f"Замен нет, файл скопирован ({method}): {output_path}")
+        return True
+
     def process_files(self):
         self.logger.log(logging.INFO, "Обработка файлов начата")
         sha_processor = None
         sha_app_started = False
         input_files = self.select_files()
+        rule_compiler.load_snapshot(self.config_data, logger=self.logger)
+        replacement_cache.clear()
+        if self.profile:
+            rule_profiler.start()
+        file_rename_rules = self.config_data.get(self.project, {}).get("file_rename", {})
+        rename_rule_set = rule_compiler.get(file_rename_rules, self.replacement_digit, project=self.project,
+                                            parser="file_rename", logger=self.logger)
         try:
             for input_path in input_files:
                 try:
                     filename = os.path.basename(input_path)
                     name, ext = os.path.splitext(filename)
-                    new_name = name
-                    file_rename_rules = self.config_data.get(self.project, {}).get("file_rename", {})
-                    for rule_name, rule in file_rename_rules.items():
-                        try:
-                            pattern = eval(rule["pattern"], {"re": re})
-                            repl_str = rule["replacement"]
-                            repl = eval(repl_str, {"replacement_digit": self.replacement_digit})
-                            new_name = pattern.sub(repl, new_name)
-                        except Exception as e:
-                            pass
+                    rule_profiler.current_file = filename
+                    new_name = rename_rule_set.apply_isolated(name, logger=self.logger,
+                                                              context=f"переименования {filename}")
                     if new_name == name:
                         new_name = f"{name}"
 
-                    if ext == ".xls":
-                        output_path = os.path.join(self.output_folder, new_name + ".xlsm")
-                    else:
-                        output_path = os.path.join(self.output_folder, new_name + ext)
+                    # .xls/.doc, которые нельзя исправить на месте, процессоры сохраняют в .xlsm/.docx
+                    output_path = os.path.join(self.output_folder, new_name + ext)
                     extension = ext.lower()
 
-                    if extension in ('.doc', '.docx', '.dotx', 'dot'):
-                        rules = self.config_data.get(self.project, {}).get("word_parser", {})
-                        processor = WordProcessor(self.replacement_digit, self.project, rules, logger=self.logger)
-                        success = processor.process_file(input_path, output_path)
+                    if extension in ('.doc', '.docx', '.dotx', '.dot'):
+                        project_rules = self.config_data.get(self.project, {})
+                        rules = project_rules.get("word_parser", {})
+                        processor = WordProcessor(self.replacement_digit, self.project, rules, logger=self.logger,
+                                                  project_rules=project_rules, workers=self.workers)
+                        success = self._process_or_copy(processor, input_path, output_path)
                         if success:
                             self.logger.log(logging.INFO, f"Успешно: {filename}")
                             self.processed_files_counter += 1
                         else:
                             self.logger.log(logging.INFO, f"Ошибка обработки: {filename}")
 
-                    elif extension in ('.xls', '.xlsx', '.xlsm'):
-                        rules = self.config_data.get(self.project, {}).get("excel_parser", {})
-                        processor = ExcelProcessor(self.replacement_digit, self.project, rules, logger=self.logger)
-                        success = processor.process_file(input_path, output_path)
+                    elif extension in ('.xls', '.xlsx', '.xlsm', '.xlsb'):
+                        project_rules = self.config_data.get(self.project, {})
+                        rules = project_rules.get("excel_parser", {})
+                        processor = ExcelProcessor(self.replacement_digit, self.project, rules, logger=self.logger,
+                                                   project_rules=project_rules, workers=self.workers)
+                        success = self._process_or_copy(processor, input_path, output_path)
                         if success:
                             self.logger.log(logging.INFO, f"Успешно: {filename}")
                             self.processed_files_counter += 1
@@ -116,6 +136,23 @@ class FileHandler():
                         else:
                             self.logger.log(logging.INFO, f"Пропуск {filename} (нет правил для sha_parser в config)")
 
+                    elif extension == '.pdf':
+                        rules = self.config_data.get(self.project, {}).get("pdf_parser", {})
+                        if rules:  # Проверяем, есть ли правила
+                            from pdf_parser import PdfProcessor
+                            processor = PdfProcessor(
+                                self.replacement_digit, self.project, rules, debug=True,
+                                log_callback=lambda message: self.logger.log(logging.DEBUG, message),
+                                workers=self.workers, config_data=self.config_data)
+                            success = processor.process_file(input_path, output_path)
+                            if success:
+                                self.logger.log(logging.INFO, f"Успешно: {filename}")
+                                self.processed_files_counter += 1
+                            else:
+                                self.logger.log(logging.INFO, f"Ошибка обработки: {filename}")
+                        else:
+                            self.logger.log(logging.INFO, f"Пропуск {filename} (нет правил для pdf_parser в config)")
+
                     else:
                         self.logger.log(logging.INFO, f"Пропуск {filename} (неподдерживаемый формат: {extension})")
 
@@ -125,6 +162,21 @@ class FileHandler():
         finally:
             if sha_app_started and sha_processor:
                 sha_processor.stop_app()
+            rule_compiler.save_snapshot(logger=self.logger)
+            stats = replacement_cache.stats()
+            self.logger.log(logging.DEBUG, f"Кеш замен: попаданий {stats['hits']}, промахов {stats['misses']}, "
+                                           f"вытеснений {stats['evictions']}, записей {stats['size']}")
+            if self.profile:
+                self.write_profile_report()
+
+    def write_profile_report(self):
+        rule_profiler.stop()
+        try:
+            json_path, csv_path = rule_profiler.write_report(
+                self.profile_path, extra={"project": self.project, "replacement_digit": self.replacement_digit})
+            self.logger.log(logging.INFO, f"Отчёт профилирования правил: {json_path}, {csv_path}")
+        except OSError as e:
+            self.logger.log(logging.ERROR, f"Не удалось записать отчёт профилирования: {e}")
 
     
    
\ No newline at end of file
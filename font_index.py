@@ -0,0 +1,238 @@
+# font_index.py
+"""Модуль font_index.py: Индекс системных шрифтов для PdfProcessor.
+
+Имена шрифтов из PDF ("ArialMT", "ABCDEF+Arial,Bold", "TimesNewRomanPSMT")
+сопоставляются с файлами шрифтов по таблице name самих файлов: PostScript-имя,
+полное имя, семейство + начертание. Коллекции .ttc индексируются по каждому
+шрифту внутри.
+
+Индекс строится один раз и сохраняется в кеше приложения (font-index.json
+рядом со снимками правил) вместе с временем изменения каталогов шрифтов; пока
+каталоги не менялись, индекс читается с диска, и поиск шрифта - обращение к
+словарю. Общий экземпляр font_index используют все процессоры PDF в процессе,
+а рабочие процессы читают тот же файл.
+"""
+import os
+import re
+import json
+import struct
+import logging
+import platform
+import threading
+from rule_engine import default_cache_dir
+
+FONT_INDEX_VERSION = 1
+FONT_EXTENSIONS = ('.ttf', '.otf', '.ttc', '.otc')
+
+# Идентификаторы записей таблицы name, из которых строятся ключи
+_FAMILY, _SUBFAMILY, _FULL_NAME, _POSTSCRIPT_NAME = 1, 2, 4, 6
+_TYPO_FAMILY, _TYPO_SUBFAMILY = 16, 17
+_REGULAR_STYLES = {'', 'regular', 'normal', 'book', 'roman', 'обычный'}
+_SUBSET_PREFIX = re.compile(r'^[A-Z]{6}\+')
+
+
+def font_dirs():
+    """Каталоги системных и пользовательских шрифтов."""
+    if platform.system() == "Windows":
+        windir = os.environ.get("WINDIR", "C:\\Windows")
+        dirs = [os.path.join(windir, "Fonts")]
+        if os.environ.get("LOCALAPPDATA"):
+            dirs.append(os.path.join(os.environ["LOCALAPPDATA"], "Microsoft", "Windows", "Fonts"))
+        return dirs
+    return ["/usr/share/fonts", "/usr/local/share/fonts", os.path.expanduser("~/.fonts"),
+            os.path.expanduser("~/.local/share/fonts"), "/Library/Fonts", "/System/Library/Fonts",
+            os.path.expanduser("~/Library/Fonts")]
+
+
+def normalize_name(name):
+    """Ключ имени шрифта: без префикса подмножества, регистра, пробелов и разделителей."""
+    return re.sub(r'[\W_]+', '', _SUBSET_PREFIX.sub('', name or '').casefold())
+
+
+def _face_offsets(f):
+    """Смещения таблиц шрифтов в файле: одно для .ttf/.otf, по одному на шрифт для коллекции."""
+    header = f.read(12)
+    if header[:4] == b'ttcf':
+        count = struct.unpack('>I', header[8:12])[0]
+        return list(struct.unpack(f'>{count}I', f.read(4 * count)))
+    return [0]
+
+
+def _table_directory(f, offset):
+    """{тег: (смещение, длина)} таблиц шрифта, начинающегося с offset."""
+    f.seek(offset)
+    num_tables = struct.unpack('>4sH', f.read(6))[1]
+    f.seek(offset + 12)
+    data = f.read(16 * num_tables)
+    tables = {}
+    for i in range(num_tables):
+        tag, _, table_offset, length = struct.unpack_from('>4sIII', data, 16 * i)
+        tables[tag] = (table_offset, length)
+    return tables
+
+
+def _read_names(f, offset):
+    """Записи таблицы name: {id: строка}; английские записи Windows в приоритете."""
+    table = _table_directory(f, offset).get(b'name')
+    if table is None:
+        return {}
+    f.seek(table[0])
+    data = f.read(table[1])
+    _, count, string_offset = struct.unpack_from('>HHH', data, 0)
+    names, priorities = {}, {}
+    for i in range(count):
+        platform_id, encoding_id, language_id, name_id, length, name_offset = struct.unpack_from(
+            '>HHHHHH', data, 6 + 12 * i)
+        if name_id not in (_FAMILY, _SUBFAMILY, _FULL_NAME, _POSTSCRIPT_NAME, _TYPO_FAMILY, _TYPO_SUBFAMILY):
+            continue
+        raw = data[string_offset + name_offset:string_offset + name_offset + length]
+        if platform_id in (0, 3):
+            text, priority = raw.decode('utf-16-be', errors='ignore'), 2 if language_id == 0x409 else 1
+        elif platform_id == 1 and encoding_id == 0:
+            text, priority = raw.decode('mac_roman', errors='ignore'), 0
+        else:
+            continue
+        if text and priority > priorities.get(name_id, -1):
+            names[name_id], priorities[name_id] = text, priority
+    return names
+
+
+def _name_keys(names):
+    """Ключи, по которым шрифт ищется из PDF."""
+    keys = [names.get(_POSTSCRIPT_NAME), names.get(_FULL_NAME)]
+    for family_id, style_id in ((_FAMILY, _SUBFAMILY), (_TYPO_FAMILY, _TYPO_SUBFAMILY)):
+        family, style = names.get(family_id), names.get(style_id, '')
+        if family:
+            keys.append(family + style)
+            if normalize_name(style) in _REGULAR_STYLES:
+                keys.append(family)
+    return [key for key in map(normalize_name, keys) if key]
+
+
+def read_font_faces(path):
+    """[(номер шрифта в файле, ключи имён)] для файла шрифта; пустой список, если файл не читается."""
+    faces = []
+    try:
+        with open(path, 'rb') as f:
+            for index, offset in enumerate(_face_offsets(f)):
+                faces.append((index, _name_keys(_read_names(f, offset))))
+    except (OSError, struct.error, ValueError):
+        return []
+    return faces
+
+
+def extract_face(path, index):
+    """Отдельный шрифт index из коллекции .ttc в виде байтов .ttf (fitz.Font открывает только первый).
+
+    Таблицы копируются как есть, каталог таблиц строится заново.
+    """
+    with open(path, 'rb') as f:
+        offset = _face_offsets(f)[index]
+        f.seek(offset)
+        sfnt_version = f.read(4)
+        tables = sorted(_table_directory(f, offset).items())
+        blobs = []
+        for _, (table_offset, length) in tables:
+            f.seek(table_offset)
+            blobs.append(f.read(length))
+    count = len(tables)
+    entry_selector = max(count.bit_length() - 1, 0)
+    search_range = (1 << entry_selector) * 16
+    header = sfnt_version + struct.pack('>HHHH', count, search_range, entry_selector, count * 16 - search_range)
+    position = 12 + 16 * count
+    directory, body = [], []
+    for (tag, _), blob in zip(tables, blobs):
+        padded = blob + b'\0' * (-len(blob) % 4)
+        directory.append(struct.pack('>4sIII', tag, 0, position, len(blob)))
+        body.append(padded)
+        position += len(padded)
+    return header + b''.join(directory) + b''.join(body)
+
+
+class FontIndex:
+    """Индекс {ключ имени шрифта: (путь, номер шрифта в файле)} с сохранением на диск."""
+
+    def __init__(self, dirs=None, cache_path=None, logger=None):
+        self.dirs = dirs if dirs is not None else font_dirs()
+        self.cache_path = cache_path or os.path.join(default_cache_dir(), "font-index.json")
+        self.logger = logger or logging.getLogger(__name__)
+        self._fonts = None
+        self._lock = threading.Lock()
+
+    def _dir_stamps(self):
+        """{каталог: время изменения} для всех каталогов шрифтов и их подкаталогов."""
+        stamps = {}
+        for root_dir in self.dirs:
+            if not os.path.isdir(root_dir):
+                continue
+            for current, subdirs, _ in os.walk(root_dir):
+                try:
+                    stamps[current] = os.stat(current).st_mtime_ns
+                except OSError:
+                    continue
+        return stamps
+
+    def _build(self, stamps):
+        fonts = {}
+        for directory in stamps:
+            try:
+                names = sorted(os.listdir(directory))
+            except OSError:
+                continue
+            for name in names:
+                if not name.lower().endswith(FONT_EXTENSIONS):
+                    continue
+                path = os.path.join(directory, name)
+                for index, keys in read_font_faces(path):
+                    for key in keys:
+                        fonts.setdefault(key, (path, index))
+        return fonts
+
+    def load(self):
+        """Читает индекс с диска или строит заново, если каталоги шрифтов изменились."""
+        with self._lock:
+            if self._fonts is not None:
+                return self._fonts
+            stamps = self._dir_stamps()
+            try:
+                with open(self.cache_path, encoding='utf-8') as f:
+                    cached = json.load(f)
+                if cached.get("version") == FONT_INDEX_VERSION and cached.get("dirs") == stamps:
+                    self._fonts = {key: tuple(value) for key, value in cached["fonts"].items()}
+                    return self._fonts
+            except (OSError, ValueError, KeyError, AttributeError):
+                pass
+            self._fonts = self._build(stamps)
+            self.logger.log(logging.DEBUG, f"Индекс шрифтов построен: {len(self._fonts)} имён")
+            try:
+                os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+                tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({"version": FONT_INDEX_VERSION, "dirs": stamps, "fonts": self._fonts}, f,
+                              ensure_ascii=False)
+                os.replace(tmp_path, self.cache_path)
+            except OSError as e:
+                self.logger.log(logging.DEBUG, f"Индекс шрифтов не сохранён: {e}")
+            return self._fonts
+
+    def lookup(self, font_name):
+        """(путь, номер шрифта в файле) для имени шрифта из PDF или None.
+
+        Кроме точного имени пробуются имя без суффиксов MT/PS ("ArialMT" -> "Arial")
+        и имя семейства без начертания ("Arial-BoldItalicMT" -> "Arial").
+        """
+        fonts = self.load()
+        key = normalize_name(font_name)
+        if not key:
+            return None
+        candidates = [key, re.sub(r'(ps)?mt$', '', key)]
+        family = re.split(r'[-,]', _SUBSET_PREFIX.sub('', font_name))[0]
+        candidates.append(normalize_name(family))
+        for candidate in candidates:
+            if candidate in fonts:
+                return fonts[candidate]
+        return None
+
+
+# Общий индекс на процесс
+font_index = FontIndex()
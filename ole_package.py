@@ -0,0 +1,445 @@
+# ole_package.py
+"""Модуль ole_package.py: Замена текста "на месте" в старых форматах .xls и .doc без COM.
+
+Файлы .xls и .doc - составные документы OLE (Compound File Binary): внутри
+файловая система из секторов с потоками "Workbook", "WordDocument", "0Table"/"1Table".
+Большинство правил меняют цифры и буквы без изменения длины (10UKD -> 20UKD,
+C02 -> C01), поэтому текст можно заменить прямо в байтах потоков, сохранив
+структуру файла. Если замена меняет длину строки (или символ нельзя записать
+в кодировке исходного фрагмента), патч не применяется, и процессор использует
+прежний путь с конвертацией через COM.
+
+Основные объекты:
+    CompoundFile     - чтение потоков составного файла и запись потоков той же длины.
+    TextSlot         - строка текста и расположение её символов в байтах потока.
+    xls_text_slots   - строки BIFF8: таблица SST и колонтитулы (HEADER/FOOTER).
+    doc_text_slots   - абзацы документа Word 97-2003 по таблице фрагментов (piece table).
+    patch_slots      - запись новых строк той же длины в байты потока.
+"""
+import struct
+from bisect import bisect_right
+
+MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+_MAX_REG_SECT = 0xFFFFFFFA
+_STREAM = 2
+_ROOT = 5
+
+
+class CompoundFile:
+    """Составной файл OLE, целиком загруженный в память.
+
+    Поддерживается только перезапись потоков без изменения их длины,
+    поэтому таблицы размещения (FAT, MiniFAT) и каталог не меняются.
+    """
+
+    def __init__(self, data):
+        self.data = bytearray(data)
+        if self.data[:8] != MAGIC:
+            raise ValueError("Файл не является составным документом OLE")
+        self.sector_size = 1 << self._u16(0x1E)
+        self.mini_sector_size = 1 << self._u16(0x20)
+        self.mini_cutoff = self._u32(0x38)
+        self.fat = self._load_fat()
+        self.entries = self._load_directory()
+        root = self.entries[0]
+        self._mini_stream = self._sector_spans(root['start'], root['size'])
+        self.minifat = self._read_chain_u32(self._u32(0x3C))
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            return cls(f.read())
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.data)
+
+    def _u16(self, offset):
+        return struct.unpack_from('<H', self.data, offset)[0]
+
+    def _u32(self, offset):
+        return struct.unpack_from('<I', self.data, offset)[0]
+
+    def _sector_offset(self, sid):
+        return (sid + 1) * self.sector_size
+
+    def _sector_words(self, sid):
+        offset = self._sector_offset(sid)
+        return struct.unpack_from(f'<{self.sector_size // 4}I', self.data, offset)
+
+    def _load_fat(self):
+        fat_sectors = [sid for sid in struct.unpack_from('<109I', self.data, 0x4C) if sid < _MAX_REG_SECT]
+        difat_sid = self._u32(0x44)
+        seen = set()
+        while difat_sid < _MAX_REG_SECT and difat_sid not in seen:
+            seen.add(difat_sid)
+            words = self._sector_words(difat_sid)
+            fat_sectors.extend(sid for sid in words[:-1] if sid < _MAX_REG_SECT)
+            difat_sid = words[-1]
+        fat = []
+        for sid in fat_sectors:
+            fat.extend(self._sector_words(sid))
+        return fat
+
+    def _chain(self, start, table):
+        chain, sid = [], start
+        while sid < _MAX_REG_SECT:
+            if sid >= len(table) or len(chain) > len(table):
+                raise ValueError("Повреждена цепочка секторов")
+            chain.append(sid)
+            sid = table[sid]
+        return chain
+
+    def _read_chain_u32(self, start):
+        words = []
+        for sid in self._chain(start, self.fat):
+            words.extend(self._sector_words(sid))
+        return words
+
+    def _sector_spans(self, start, size):
+        """[(смещение в файле, длина)] потока, лежащего в обычных секторах."""
+        spans, remaining = [], size
+        for sid in self._chain(start, self.fat):
+            if remaining <= 0:
+                break
+            length = min(self.sector_size, remaining)
+            spans.append((self._sector_offset(sid), length))
+            remaining -= length
+        if remaining > 0:
+            raise ValueError("Поток короче заявленного размера")
+        return spans
+
+    def _mini_spans(self, start, size):
+        """[(смещение в файле, длина)] потока, лежащего в мини-секторах."""
+        spans, remaining = [], size
+        for sid in self._chain(start, self.minifat):
+            if remaining <= 0:
+                break
+            mini_offset = sid * self.mini_sector_size
+            index, within = divmod(mini_offset, self.sector_size)
+            if index >= len(self._mini_stream):
+                raise ValueError("Мини-сектор вне мини-потока")
+            length = min(self.mini_sector_size, remaining)
+            spans.append((self._mini_stream[index][0] + within, length))
+            remaining -= length
+        if remaining > 0:
+            raise ValueError("Поток короче заявленного размера")
+        return spans
+
+    def _load_directory(self):
+        entries = []
+        for sid in self._chain(self._u32(0x30), self.fat):
+            offset = self._sector_offset(sid)
+            for pos in range(offset, offset + self.sector_size, 128):
+                name_len = struct.unpack_from('<H', self.data, pos + 64)[0]
+                entry_type = self.data[pos + 66]
+                name = bytes(self.data[pos:pos + max(name_len - 2, 0)]).decode('utf-16-le', errors='replace')
+                start = struct.unpack_from('<I', self.data, pos + 116)[0]
+                size = struct.unpack_from('<Q', self.data, pos + 120)[0]
+                if self.sector_size == 512:
+                    size &= 0xFFFFFFFF  # в версии 3 старшие 4 байта не используются
+                entries.append({'name': name, 'type': entry_type, 'start': start, 'size': size})
+        if not entries or entries[0]['type'] != _ROOT:
+            raise ValueError("Не найден корневой каталог")
+        return entries
+
+    def _find(self, name):
+        for entry in self.entries:
+            if entry['type'] == _STREAM and entry['name'].lower() == name.lower():
+                return entry
+        raise KeyError(f"Поток не найден: {name}")
+
+    def has_stream(self, name):
+        try:
+            self._find(name)
+            return True
+        except KeyError:
+            return False
+
+    def _stream_spans(self, name):
+        entry = self._find(name)
+        if entry['size'] < self.mini_cutoff:
+            return self._mini_spans(entry['start'], entry['size'])
+        return self._sector_spans(entry['start'], entry['size'])
+
+    def read_stream(self, name):
+        """Содержимое потока (bytearray - его можно менять и записать обратно)."""
+        return bytearray().join(self.data[offset:offset + length] for offset, length in self._stream_spans(name))
+
+    def write_stream(self, name, data):
+        """Записывает поток на прежнее место; длина должна совпадать с исходной."""
+        spans = self._stream_spans(name)
+        if len(data) != sum(length for _, length in spans):
+            raise ValueError(f"Длина потока {name} изменилась")
+        pos = 0
+        for offset, length in spans:
+            self.data[offset:offset + length] = data[pos:pos + length]
+            pos += length
+
+
+class TextSlot:
+    """Строка текста и расположение её символов в потоке.
+
+    segments - [(смещение в потоке, число символов, кодировка)]: подряд идущие
+    символы одной кодировки ('latin-1'/'cp1252' - 1 байт, 'utf-16-le' - 2 байта).
+    element - имя соответствующего элемента OOXML ('t', 'oddHeader', ...) для scope правил.
+    """
+    __slots__ = ('text', 'segments', 'element', '_starts')
+
+    def __init__(self, text, segments, element='t'):
+        self.text = text
+        self.segments = segments
+        self.element = element
+        self._starts = None
+
+    def locate(self, index):
+        """(смещение в потоке, кодировка) символа с номером index."""
+        if self._starts is None:
+            starts, total = [], 0
+            for _, count, _ in self.segments:
+                starts.append(total)
+                total += count
+            self._starts = starts
+        seg = bisect_right(self._starts, index) - 1
+        offset, _, codec = self.segments[seg]
+        width = 2 if codec == 'utf-16-le' else 1
+        return offset + (index - self._starts[seg]) * width, codec
+
+    def slice(self, start, end):
+        """Часть строки [start, end) как отдельный TextSlot."""
+        segments, pos = [], 0
+        for offset, count, codec in self.segments:
+            seg_start, seg_end = max(start, pos), min(end, pos + count)
+            if seg_start < seg_end:
+                width = 2 if codec == 'utf-16-le' else 1
+                segments.append((offset + (seg_start - pos) * width, seg_end - seg_start, codec))
+            pos += count
+        return TextSlot(self.text[start:end], segments, self.element)
+
+
+def patch_slots(data, slots, new_texts):
+    """Записывает новые тексты в data (bytearray потока) без изменения длины.
+
+    Сначала проверяются все строки; если хотя бы одна замена меняет длину,
+    затрагивает управляющий символ или не кодируется в байты исходного
+    фрагмента, data не меняется.
+
+    :return: (True, число изменённых строк) или (False, причина).
+    """
+    writes = []
+    for slot, new_text in zip(slots, new_texts):
+        if new_text == slot.text:
+            continue
+        if len(new_text) != len(slot.text):
+            return False, f"замена меняет длину строки: '{slot.text}' → '{new_text}'"
+        for index, (old_char, new_char) in enumerate(zip(slot.text, new_text)):
+            if old_char == new_char:
+                continue
+            if old_char < ' ' or new_char < ' ':
+                return False, f"замена затрагивает служебный символ в строке '{slot.text}'"
+            offset, codec = slot.locate(index)
+            try:
+                encoded = new_char.encode(codec)
+            except UnicodeEncodeError:
+                return False, f"символ '{new_char}' нельзя записать в кодировке {codec}"
+            if len(encoded) != (2 if codec == 'utf-16-le' else 1):
+                return False, f"символ '{new_char}' нельзя записать без изменения длины"
+            writes.append((offset, encoded))
+    for offset, encoded in writes:
+        data[offset:offset + len(encoded)] = encoded
+    return True, sum(1 for slot, new_text in zip(slots, new_texts) if new_text != slot.text)
+
+
+# --- Excel 97-2003 (BIFF8) ---
+
+_BIFF_BOF = 0x0809
+_BIFF_FILEPASS = 0x002F
+_BIFF_SST = 0x00FC
+_BIFF_CONTINUE = 0x003C
+_BIFF_HEADER = 0x0014
+_BIFF_FOOTER = 0x0015
+
+
+class _RecordReader:
+    """Последовательное чтение данных записи BIFF вместе с её записями CONTINUE."""
+
+    def __init__(self, data, pieces):
+        self.data = data
+        self.pieces = pieces  # [(смещение данных записи, длина)]
+        self.index = 0
+        self.pos = 0
+
+    def _available(self):
+        return self.pieces[self.index][1] - self.pos if self.index < len(self.pieces) else 0
+
+    def _next_piece(self):
+        self.index += 1
+        self.pos = 0
+        if self.index >= len(self.pieces):
+            raise ValueError("Неожиданный конец записи SST")
+
+    def read(self, size):
+        out = bytearray()
+        while size > 0:
+            if self._available() == 0:
+                self._next_piece()
+            offset = self.pieces[self.index][0] + self.pos
+            chunk = min(size, self._available())
+            out += self.data[offset:offset + chunk]
+            self.pos += chunk
+            size -= chunk
+        return bytes(out)
+
+    def skip(self, size):
+        while size > 0:
+            if self._available() == 0:
+                self._next_piece()
+            chunk = min(size, self._available())
+            self.pos += chunk
+            size -= chunk
+
+    def read_chars(self, count, high_byte):
+        """Читает массив символов строки; при переходе в CONTINUE первый байт - новые флаги."""
+        text, segments = [], []
+        while count > 0:
+            if self._available() == 0:
+                self._next_piece()
+                high_byte = self.data[self.pieces[self.index][0]] & 0x01
+                self.pos = 1
+            width = 2 if high_byte else 1
+            chunk = min(count, self._available() // width)
+            if chunk == 0:
+                raise ValueError("Символ строки разделён между записями")
+            offset = self.pieces[self.index][0] + self.pos
+            codec = 'utf-16-le' if high_byte else 'latin-1'
+            text.append(bytes(self.data[offset:offset + chunk * width]).decode(codec))
+            segments.append((offset, chunk, codec))
+            self.pos += chunk * width
+            count -= chunk
+        return ''.join(text), segments
+
+
+def _biff_records(workbook):
+    pos, size = 0, len(workbook)
+    while pos + 4 <= size:
+        record_type, length = struct.unpack_from('<HH', workbook, pos)
+        yield record_type, pos + 4, length
+        pos += 4 + length
+
+
+def xls_text_slots(workbook):
+    """Строки книги BIFF8, которые обрабатывают правила: SST и колонтитулы листов.
+
+    :param workbook: Содержимое потока "Workbook".
+    :raises ValueError: книга зашифрована, не BIFF8 или повреждена.
+    """
+    records = list(_biff_records(workbook))
+    if not records or records[0][0] != _BIFF_BOF or struct.unpack_from('<H', workbook, records[0][1])[0] != 0x0600:
+        raise ValueError("Поддерживается только формат BIFF8 (Excel 97-2003)")
+    slots = []
+    for i, (record_type, offset, length) in enumerate(records):
+        if record_type == _BIFF_FILEPASS:
+            raise ValueError("Книга защищена паролем")
+        if record_type == _BIFF_SST:
+            pieces = [(offset, length)]
+            for next_type, next_offset, next_length in records[i + 1:]:
+                if next_type != _BIFF_CONTINUE:
+                    break
+                pieces.append((next_offset, next_length))
+            reader = _RecordReader(workbook, pieces)
+            _, unique = struct.unpack('<II', reader.read(8))
+            for _ in range(unique):
+                count, flags = struct.unpack('<HB', reader.read(3))
+                runs = struct.unpack('<H', reader.read(2))[0] if flags & 0x08 else 0
+                ext_size = struct.unpack('<I', reader.read(4))[0] if flags & 0x04 else 0
+                text, segments = reader.read_chars(count, flags & 0x01)
+                slots.append(TextSlot(text, segments))
+                reader.skip(4 * runs + ext_size)
+        elif record_type in (_BIFF_HEADER, _BIFF_FOOTER) and length >= 3:
+            count, flags = struct.unpack_from('<HB', workbook, offset)
+            width = 2 if flags & 0x01 else 1
+            if 3 + count * width > length:
+                raise ValueError("Повреждена запись колонтитула")
+            codec = 'utf-16-le' if flags & 0x01 else 'latin-1'
+            text = bytes(workbook[offset + 3:offset + 3 + count * width]).decode(codec)
+            element = 'oddHeader' if record_type == _BIFF_HEADER else 'oddFooter'
+            slots.append(TextSlot(text, [(offset + 3, count, codec)], element))
+    return slots
+
+
+# --- Word 97-2003 ---
+
+_WORD_IDENT = 0xA5EC
+_FIB_ENCRYPTED = 0x0100
+_FIB_WHICH_TABLE = 0x0200
+_CLX_INDEX = 33  # номер пары fcClx/lcbClx в FibRgFcLcb97
+_COMPRESSED = 0x40000000
+# Концы абзацев и ячеек таблиц: правила применяются к тексту между ними
+PARAGRAPH_MARKS = ('\r', '\x07')
+
+
+def doc_table_stream_name(word_document):
+    flags = struct.unpack_from('<H', word_document, 0x0A)[0]
+    return '1Table' if flags & _FIB_WHICH_TABLE else '0Table'
+
+
+def doc_text_slots(word_document, table):
+    """Абзацы документа Word 97-2003 (основной текст, колонтитулы, сноски...).
+
+    :param word_document: Содержимое потока "WordDocument".
+    :param table: Содержимое потока "0Table"/"1Table" (см. doc_table_stream_name).
+    :raises ValueError: документ зашифрован или повреждён.
+    """
+    ident, _ = struct.unpack_from('<HH', word_document, 0)
+    flags = struct.unpack_from('<H', word_document, 0x0A)[0]
+    if ident != _WORD_IDENT:
+        raise ValueError("Поток WordDocument не распознан")
+    if flags & _FIB_ENCRYPTED:
+        raise ValueError("Документ защищён паролем")
+    pos = 32
+    csw = struct.unpack_from('<H', word_document, pos)[0]
+    pos += 2 + csw * 2
+    cslw = struct.unpack_from('<H', word_document, pos)[0]
+    pos += 2 + cslw * 4
+    cb_rg_fc_lcb = struct.unpack_from('<H', word_document, pos)[0]
+    if cb_rg_fc_lcb <= _CLX_INDEX:
+        raise ValueError("Неподдерживаемая версия документа Word")
+    fc_clx, lcb_clx = struct.unpack_from('<II', word_document, pos + 2 + _CLX_INDEX * 8)
+
+    # CLX: набор Prc (0x01) и затем Pcdt (0x02) с таблицей фрагментов
+    pos, end = fc_clx, fc_clx + lcb_clx
+    while pos < end and table[pos] == 0x01:
+        pos += 3 + struct.unpack_from('<h', table, pos + 1)[0]
+    if pos >= end or table[pos] != 0x02:
+        raise ValueError("Не найдена таблица фрагментов текста")
+    lcb = struct.unpack_from('<I', table, pos + 1)[0]
+    plc = pos + 5
+    pieces = (lcb - 4) // 12
+    cps = struct.unpack_from(f'<{pieces + 1}I', table, plc)
+
+    text, segments = [], []
+    for k in range(pieces):
+        count = cps[k + 1] - cps[k]
+        fc_value = struct.unpack_from('<I', table, plc + (pieces + 1) * 4 + k * 8 + 2)[0]
+        if count <= 0:
+            continue
+        if fc_value & _COMPRESSED:
+            offset, codec, width = (fc_value & ~_COMPRESSED) // 2, 'cp1252', 1
+        else:
+            offset, codec, width = fc_value, 'utf-16-le', 2
+        raw = bytes(word_document[offset:offset + count * width])
+        if len(raw) != count * width:
+            raise ValueError("Фрагмент текста за пределами потока")
+        text.append(raw.decode(codec, errors='replace'))
+        segments.append((offset, count, codec))
+    document = TextSlot(''.join(text), segments)
+
+    slots, start = [], 0
+    for index, char in enumerate(document.text):
+        if char in PARAGRAPH_MARKS:
+            if index > start:
+                slots.append(document.slice(start, index))
+            start = index + 1
+    if start < len(document.text):
+        slots.append(document.slice(start, len(document.text)))
+    return slots
@@ -0,0 +1,495 @@
+# ooxml_package.py
+"""Модуль ooxml_package.py: Потоковая перезапись пакетов OOXML (.docx, .xlsx, ...) zip -> zip.
+
+Раньше процессоры распаковывали весь пакет во временную папку (включая картинки
+и вложения), затем заново читали каждый файл с диска и писали выходной архив
+без сжатия (ZIP_STORED) - результат получался в разы больше исходного.
+
+Здесь выходной архив собирается напрямую из входного:
+    - нетронутые части копируются "как есть" - сжатые байты переносятся без
+      распаковки и повторного сжатия, с исходным методом сжатия и CRC;
+    - читаются и передаются обработчику только выбранные части; сжимаются
+      заново (ZIP_DEFLATED) только те, которые обработчик изменил.
+Временная папка не нужна.
+
+Какие части обрабатывать, определяет discover_parts: по [Content_Types].xml и
+графу связей (_rels/*.rels) составляется точный список частей с текстом,
+двоичные части и части только со стилями при этом не открываются.
+
+Распаковка выбранных частей, их обработка и повторное сжатие выполняются в
+пуле потоков (zlib отпускает GIL), а выходной архив собирается в исходном
+порядке частей. Число потоков задаёт параметр workers (1 - без пула).
+
+package_may_match - быстрая проверка "правила ничего не изменят": текст частей
+ищется в распакованных байтах без разбора XML, и такой файл можно просто
+скопировать.
+
+Вложенные пакеты (EMBEDDED_PACKAGE_TYPES) процессоры обрабатывают рекурсивно,
+в памяти: rewrite_package принимает и пути, и файловые объекты.
+
+Очень большие части (листы на сотни тысяч строк) можно не загружать в память
+целиком: rewrite_package передаёт их stream_part как потоки, а
+stream_rewrite_xml переписывает XML по элементам (iterparse) с ограниченным
+расходом памяти.
+"""
+import os
+import re
+import html
+import difflib
+import zlib
+import struct
+import posixpath
+import logging
+import zipfile
+from collections import deque
+from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+from lxml import etree as ET
+
+# Бит 3 флагов: CRC и размеры записаны после данных (data descriptor).
+_FLAG_DATA_DESCRIPTOR = 0x08
+_EXTRA_ZIP64 = 0x0001
+_COPY_CHUNK = 1024 * 1024
+
+# Потоков на один пакет по умолчанию
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def _copy_info(zinfo):
+    """Копия ZipInfo для записи в новый архив с теми же сжатыми данными."""
+    info = ZipInfo(zinfo.filename, zinfo.date_time)
+    info.compress_type = zinfo.compress_type
+    info.comment = zinfo.comment
+    # zip64-поле FileHeader добавит сам, если оно нужно
+    info.extra = zipfile._strip_extra(zinfo.extra, (_EXTRA_ZIP64,))
+    info.create_system = zinfo.create_system
+    info.create_version = zinfo.create_version
+    info.extract_version = zinfo.extract_version
+    # CRC и размеры известны из центрального каталога - пишем их в локальный заголовок
+    info.flag_bits = zinfo.flag_bits & ~_FLAG_DATA_DESCRIPTOR
+    info.volume = zinfo.volume
+    info.internal_attr = zinfo.internal_attr
+    info.external_attr = zinfo.external_attr
+    info.CRC = zinfo.CRC
+    info.compress_size = zinfo.compress_size
+    info.file_size = zinfo.file_size
+    return info
+
+
+def _write_raw(zip_out, info, chunks):
+    """Пишет в zip_out часть с уже сжатыми данными; CRC и размеры заданы в info."""
+    zip64 = info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+    with zip_out._lock:
+        info.header_offset = zip_out.fp.tell()
+        zip_out._writecheck(info)
+        zip_out._didModify = True
+        zip_out.fp.write(info.FileHeader(zip64))
+        for chunk in chunks:
+            zip_out.fp.write(chunk)
+        zip_out.filelist.append(info)
+        zip_out.NameToInfo[info.filename] = info
+        zip_out.start_dir = zip_out.fp.tell()
+
+
+def copy_member_raw(zip_in, zip_out, zinfo):
+    """Копирует часть из zip_in в zip_out без распаковки (сжатые байты как есть)."""
+    info = _copy_info(zinfo)
+    with zip_in._lock:
+        fp = zip_in.fp
+        fp.seek(zinfo.header_offset)
+        header = fp.read(zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(f"Повреждён локальный заголовок части {zinfo.filename}")
+        fields = struct.unpack(zipfile.structFileHeader, header)
+        fp.seek(fields[zipfile._FH_FILENAME_LENGTH] + fields[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+
+        def chunks():
+            remaining = info.compress_size
+            while remaining > 0:
+                chunk = fp.read(min(_COPY_CHUNK, remaining))
+                if not chunk:
+                    raise zipfile.BadZipFile(f"Неожиданный конец данных части {zinfo.filename}")
+                yield chunk
+                remaining -= len(chunk)
+
+        _write_raw(zip_out, info, chunks())
+
+
+def _deflate(data):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _transform_member(zip_in, zinfo, process_part):
+    """Распаковка, обработка и сжатие одной части (выполняется в пуле потоков).
+
+    :return: (длина, CRC, сжатые данные) или None, если часть не изменилась.
+    """
+    new_data = process_part(zinfo.filename, zip_in.read(zinfo))
+    if new_data is None:
+        return None
+    return len(new_data), zlib.crc32(new_data), _deflate(new_data)
+
+
+def rewrite_package(input_path, output_path, parts, process_part, logger=None,
+                    stream_part=None, stream_threshold=None, workers=None):
+    """Переписывает пакет: выбранные части проходят через process_part, остальные копируются.
+
+    input_path и output_path - пути или файловые объекты (BytesIO для вложенных пакетов).
+
+    :param parts: Имена частей, которые нужно передать обработчику.
+    :param process_part: Функция (имя, байты) -> новые байты или None, если часть не изменилась.
+        При workers > 1 вызывается из нескольких потоков одновременно.
+    :param stream_part: Функция (имя, входной поток, выходной поток) -> True, если часть изменена.
+        Вызывается вместо process_part для частей больше stream_threshold байт.
+        Такая часть всегда сжимается заново, даже если не изменилась.
+    :param workers: Число потоков для распаковки, обработки и сжатия частей
+        (по умолчанию DEFAULT_WORKERS; 1 - всё в текущем потоке).
+    :return: Множество имён изменённых частей.
+    """
+    logger = logger or logging.getLogger(__name__)
+    parts = set(parts)
+    workers = DEFAULT_WORKERS if workers is None else max(1, workers)
+    modified = set()
+
+    def streamed(zinfo):
+        return stream_part is not None and stream_threshold is not None and zinfo.file_size > stream_threshold
+
+    with ZipFile(input_path) as zip_in, ZipFile(output_path, 'w', ZIP_DEFLATED) as zip_out:
+        members = zip_in.infolist()
+        pooled = deque(i for i, zinfo in enumerate(members)
+                       if zinfo.filename in parts and zinfo.file_size > 0 and not streamed(zinfo))
+        executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 and len(pooled) > 1 else None
+        pending = {}   # номер части -> Future
+
+        def submit_ahead():
+            # в работе не больше 2 * workers частей - ограничение памяти
+            while pooled and len(pending) < 2 * workers:
+                index = pooled.popleft()
+                pending[index] = executor.submit(_transform_member, zip_in, members[index], process_part)
+
+        try:
+            for index, zinfo in enumerate(members):
+                if executor is not None:
+                    submit_ahead()
+                if zinfo.filename in parts and zinfo.file_size == 0:
+                    logger.log(logging.DEBUG, f"Пропущен файл (пуст): {zinfo.filename}")
+                elif zinfo.filename in parts and streamed(zinfo):
+                    logger.log(logging.DEBUG, f"Потоковая обработка части {zinfo.filename} "
+                                              f"({zinfo.file_size // 1024} КБ)")
+                    info = ZipInfo(zinfo.filename, zinfo.date_time)
+                    info.compress_type = ZIP_DEFLATED
+                    info.external_attr = zinfo.external_attr
+                    with zip_in.open(zinfo) as src, \
+                            zip_out.open(info, 'w', force_zip64=zinfo.file_size > zipfile.ZIP64_LIMIT // 2) as dst:
+                        if stream_part(zinfo.filename, src, dst):
+                            modified.add(zinfo.filename)
+                    continue
+                elif zinfo.filename in parts:
+                    if executor is None:
+                        result = _transform_member(zip_in, zinfo, process_part)
+                    else:
+                        result = pending.pop(index).result()
+                    if result is not None:
+                        file_size, crc, data = result
+                        info = ZipInfo(zinfo.filename, zinfo.date_time)
+                        info.compress_type = ZIP_DEFLATED
+                        info.external_attr = zinfo.external_attr
+                        info.file_size, info.CRC, info.compress_size = file_size, crc, len(data)
+                        _write_raw(zip_out, info, (data,))
+                        modified.add(zinfo.filename)
+                        continue
+                copy_member_raw(zip_in, zip_out, zinfo)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+    return modified
+
+
+CONTENT_TYPES_PART = '[Content_Types].xml'
+_CT_NS = '{http://schemas.openxmlformats.org/package/2006/content-types}'
+_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+# Свойства документа и общие для Word и Excel части DrawingML с текстом
+DOCPROPS_TYPES = frozenset({
+    'application/vnd.openxmlformats-package.core-properties+xml',
+    'application/vnd.openxmlformats-officedocument.extended-properties+xml',
+    'application/vnd.openxmlformats-officedocument.custom-properties+xml',
+})
+DRAWING_TYPES = frozenset({
+    'application/vnd.openxmlformats-officedocument.drawingml.chart+xml',
+    'application/vnd.openxmlformats-officedocument.drawingml.diagramData+xml',
+    'application/vnd.openxmlformats-officedocument.drawing+xml',
+})
+
+# Вложенные пакеты (объекты Excel и Word внутри документа): тип содержимого -> раздел правил
+EMBEDDED_PACKAGE_TYPES = {
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': 'excel_parser',
+    'application/vnd.ms-excel.sheet.macroEnabled.12': 'excel_parser',
+    'application/vnd.ms-excel.sheet.binary.macroEnabled.12': 'excel_parser',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': 'word_parser',
+    'application/vnd.ms-word.document.macroEnabled.12': 'word_parser',
+}
+# Глубже вложенные пакеты копируются без изменений
+MAX_EMBED_DEPTH = 3
+
+
+def _part_name(name):
+    return name.lstrip('/')
+
+
+def _content_types(zip_in):
+    """{имя части: тип содержимого} по [Content_Types].xml (Override важнее Default)."""
+    try:
+        root = ET.fromstring(zip_in.read(CONTENT_TYPES_PART))
+    except KeyError:
+        raise ValueError(f"В пакете нет {CONTENT_TYPES_PART} - это не документ OOXML")
+    defaults = {elem.get('Extension', '').lower(): elem.get('ContentType')
+                for elem in root.iter(_CT_NS + 'Default')}
+    overrides = {}
+    for elem in root.iter(_CT_NS + 'Override'):
+        # PartName - URI: имя в архиве может быть как с %-кодами, так и без них
+        part = _part_name(elem.get('PartName', ''))
+        overrides[part.lower()] = elem.get('ContentType')
+        overrides.setdefault(unquote(part).lower(), elem.get('ContentType'))
+    types = {}
+    for name in zip_in.namelist():
+        content_type = overrides.get(name.lower())
+        if content_type is None:
+            content_type = defaults.get(posixpath.splitext(name)[1][1:].lower())
+        if content_type is not None:
+            types[name] = content_type
+    return types
+
+
+def _rels_name(part):
+    folder, base = posixpath.split(part)
+    return posixpath.join(folder, '_rels', base + '.rels')
+
+
+def _related_parts(zip_in, names, part):
+    """Внутренние цели связей части ('' - сам пакет)."""
+    rels = _rels_name(part)
+    if rels not in names:
+        return []
+    targets = []
+    folder = posixpath.dirname(part)
+    for rel in ET.fromstring(zip_in.read(rels)).iter(_REL_NS + 'Relationship'):
+        if rel.get('TargetMode') == 'External':
+            continue
+        target = rel.get('Target', '')
+        if target.startswith('/'):
+            target = _part_name(target)
+        else:
+            target = posixpath.normpath(posixpath.join(folder, target))
+        targets.append(target)
+    return targets
+
+
+def discover_parts(zip_in, content_types):
+    """Части пакета с типом содержимого из content_types, достижимые по связям от корня.
+
+    Читаются только [Content_Types].xml и файлы связей. Если в пакете нет
+    корневых связей (_rels/.rels), отбор идёт только по типу содержимого.
+
+    :return: {имя части: тип содержимого} в порядке частей архива.
+    """
+    names = set(zip_in.namelist())
+    by_lower = {name.lower(): name for name in names}
+    types = _content_types(zip_in)
+    if _rels_name('') not in names:
+        return {name: types[name] for name in zip_in.namelist() if types.get(name) in content_types}
+    reached, queue = set(), ['']
+    while queue:
+        for target in _related_parts(zip_in, names, queue.pop()):
+            # Target - URI ('media/My%20File.xml'), в архиве имя обычно без %-кодов
+            target = by_lower.get(target.lower()) or by_lower.get(unquote(target).lower())
+            if target is not None and target not in reached:
+                reached.add(target)
+                queue.append(target)
+    return {name: types[name] for name in zip_in.namelist()
+            if name in reached and types.get(name) in content_types}
+
+
+# Части больше этого размера package_may_match не читает (считает, что замены возможны)
+PRESCAN_PART_SIZE = 64 * 1024 * 1024
+_TAG = re.compile(rb'<[^>]*>')
+_T_ELEMENT = re.compile(rb'<(?:[\w.-]+:)?t(?:\s[^>]*)?>([^<]*)</(?:[\w.-]+:)?t>')
+
+
+def _text_views(data):
+    """Текст XML-части без разметки для префильтра правил.
+
+    Первый вариант - все текстовые узлы подряд (каждый узел - подстрока),
+    второй - склеенные элементы t (текст абзаца Word и строки из нескольких
+    фрагментов Excel тоже подстрока). Префильтр RuleSet.could_match проверяет
+    только наличие литералов и классов символов, поэтому лишний текст вокруг
+    не приводит к пропуску замены.
+    :return: список строк или None, если часть нельзя проверить без разбора.
+    """
+    body = data[5:] if data.startswith(b'<?xml') else data
+    if b'<!--' in body or b'<![CDATA[' in body or b'<?' in body:
+        return None   # комментарии, CDATA и инструкции обработки процессоры тоже обрабатывают
+    try:
+        views = [_TAG.sub(b'', data), b''.join(_T_ELEMENT.findall(data))]
+        return [html.unescape(view.decode('utf-8')) for view in views]
+    except UnicodeDecodeError:
+        return None
+
+
+def package_may_match(zip_in, content_types, could_match, max_part_size=PRESCAN_PART_SIZE):
+    """Может ли обработка изменить пакет: текст частей проверяется функцией could_match(str).
+
+    Проверка консервативная: True при любой неясности - двоичные и вложенные
+    части, части больше max_part_size, XML с комментариями/CDATA, не UTF-8.
+    """
+    for name, content_type in discover_parts(zip_in, content_types).items():
+        if not content_type.endswith('xml'):
+            return True
+        zinfo = zip_in.getinfo(name)
+        if zinfo.file_size > max_part_size:
+            return True
+        views = _text_views(zip_in.read(zinfo))
+        if views is None or any(could_match(view) for view in views):
+            return True
+    return False
+
+
+def local_name(elem):
+    """Локальное имя элемента ('' для комментариев и инструкций обработки)."""
+    return elem.tag.rpartition('}')[2] if isinstance(elem.tag, str) else ''
+
+
+def text_nodes(tree):
+    """Текстовые узлы дерева: [(элемент, 'text'/'tail', значение, имя элемента, которому принадлежит текст)]."""
+    nodes = []
+    for elem in tree.iter():
+        if elem.text:
+            nodes.append((elem, 'text', elem.text, local_name(elem)))
+        if elem.tail:
+            parent = elem.getparent()
+            nodes.append((elem, 'tail', elem.tail, local_name(parent) if parent is not None else ''))
+    return nodes
+
+
+def split_runs(parts, new_text):
+    """Раскладывает новый текст по фрагментам (runs) с исходным текстом parts.
+
+    Неизменённый текст остаётся в своём фрагменте, заменённый - во фрагменте,
+    где начиналась замена, так что форматирование фрагментов сохраняется.
+    """
+    old_text = ''.join(parts)
+    opcodes = difflib.SequenceMatcher(None, old_text, new_text, autojunk=False).get_opcodes()
+
+    def position(offset):
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == 'equal' and i1 <= offset <= i2:
+                return j1 + offset - i1
+            if i1 <= offset < i2 or (offset == i1 == i2):
+                return j1 if offset == i1 else j2
+        return len(new_text)
+
+    bounds, offset = [0], 0
+    for part in parts[:-1]:
+        offset += len(part)
+        bounds.append(position(offset))
+    bounds.append(len(new_text))
+    return [new_text[start:max(start, end)] for start, end in zip(bounds, bounds[1:])]
+
+
+_XMLNS_DECL = re.compile(rb' xmlns(?::([\w.-]+))?="([^"]*)"')
+
+
+def _start_tag_end(data):
+    """Позиция конца первого открывающего тега (в значениях атрибутов lxml экранирует '>')."""
+    return data.index(b'>')
+
+
+class _Serializer:
+    """Сериализует элементы без повторного объявления пространств имён корня."""
+
+    def __init__(self, root):
+        self.root_decls = {((prefix or '').encode(), uri.encode()) for prefix, uri in root.nsmap.items()}
+
+    def _strip(self, data):
+        end = _start_tag_end(data)
+        start_tag = _XMLNS_DECL.sub(
+            lambda m: b'' if ((m.group(1) or b''), m.group(2)) in self.root_decls else m.group(0), data[:end])
+        return start_tag + data[end:]
+
+    def element(self, elem):
+        elem.tail = None
+        return self._strip(ET.tostring(elem, encoding='UTF-8', xml_declaration=False))
+
+    def start_tag(self, elem, declare=False):
+        shallow = ET.Element(elem.tag, dict(elem.attrib), nsmap=elem.nsmap)
+        data = ET.tostring(shallow, encoding='UTF-8', xml_declaration=False)
+        if not declare:
+            data = self._strip(data)
+        return data[:-2] + b'>'   # '<tag .../>' -> '<tag ...>'
+
+    @staticmethod
+    def end_tag(elem):
+        qname = ET.QName(elem)
+        prefix = f"{elem.prefix}:" if elem.prefix else ''
+        return f"</{prefix}{qname.localname}>".encode()
+
+
+def stream_rewrite_xml(src, dst, containers, process_chunk, chunk_size=500):
+    """Переписывает XML-часть из потока src в поток dst по элементам.
+
+    Единицы обработки - дети корня, а для детей корня с локальным именем из
+    containers (например 'sheetData') - их дети (строки листа). Готовые элементы
+    передаются в process_chunk(список элементов) -> bool (были ли изменения)
+    пачками по chunk_size, записываются и удаляются из дерева, так что в памяти
+    держится не больше одной пачки. Комментарии и пробелы между элементами
+    верхнего уровня не сохраняются.
+
+    :return: True, если process_chunk сообщил об изменениях.
+    """
+    containers = set(containers)
+    modified = False
+    pending = []
+    serializer = None
+    root = None
+    open_container = None
+
+    def flush():
+        nonlocal modified
+        if not pending:
+            return
+        if process_chunk(pending):
+            modified = True
+        dst.write(b''.join(serializer.element(elem) for elem in pending))
+        for elem in pending:
+            parent = elem.getparent()
+            elem.clear()
+            if parent is not None:
+                parent.remove(elem)
+        pending.clear()
+
+    dst.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\r\n')
+    for event, elem in ET.iterparse(src, events=('start', 'end'), remove_blank_text=True, huge_tree=True):
+        if event == 'start':
+            if root is None:
+                root = elem
+                serializer = _Serializer(root)
+                dst.write(serializer.start_tag(elem, declare=True))
+            elif open_container is None and elem.getparent() is root and ET.QName(elem).localname in containers:
+                flush()
+                open_container = elem
+                dst.write(serializer.start_tag(elem))
+            continue
+        if elem is root:
+            flush()
+            dst.write(serializer.end_tag(elem))
+        elif elem is open_container:
+            flush()
+            dst.write(serializer.end_tag(elem))
+            open_container = None
+        elif elem.getparent() is root or (open_container is not None and elem.getparent() is open_container):
+            pending.append(elem)
+            if len(pending) >= chunk_size:
+                flush()
+    return modified
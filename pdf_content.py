@@ -0,0 +1,335 @@
+# pdf_content.py
+"""Модуль pdf_content.py: Замена текста прямо в потоках содержимого страниц PDF.
+
+Текст страницы выводится операторами Tj, TJ, ' и " со строками в кодировке
+текущего шрифта (Tf). Поток разбирается на лексемы, строки этих операторов
+декодируются кодеком шрифта (FontCodec, text_operators) и сопоставляются с
+текстом страницы (align_operators); изменённые строки кодируются обратно тем
+же кодеком (patch_operators). Остальные лексемы потока копируются байт в байт.
+
+Кодек строится по ToUnicode (parse_tounicode) или, для простых шрифтов без
+ToUnicode, по кодировке /Encoding (simple_encoding_map). Заменяются только
+строки, все коды которых декодируются ровно в один символ, а новые символы
+есть в кодеке; в подмножестве шрифта (ABCDEF+Name) глифа нового символа может
+не быть, поэтому для него годятся только символы, уже выведенные этим шрифтом.
+Иначе текст остаётся для замены поверх (PdfProcessor).
+"""
+import re
+
+_WHITESPACE = b'\x00\t\n\x0c\r '
+_DELIMITERS = b'()<>[]{}/%'
+_TEXT_OPERATORS = (b'Tj', b'TJ', b"'", b'"')
+
+# Имена глифов из /Differences, которые встречаются в обозначениях
+_GLYPH_NAMES = {
+    'space': ' ', 'hyphen': '-', 'minus': '-', 'period': '.', 'comma': ',', 'slash': '/', 'colon': ':',
+    'semicolon': ';', 'underscore': '_', 'parenleft': '(', 'parenright': ')', 'numbersign': '#',
+    'ampersand': '&', 'plus': '+', 'equal': '=', 'percent': '%', 'quotesingle': "'", 'quotedbl': '"',
+    'zero': '0', 'one': '1', 'two': '2', 'three': '3', 'four': '4', 'five': '5', 'six': '6', 'seven': '7',
+    'eight': '8', 'nine': '9',
+}
+_BASE_ENCODINGS = {'WinAnsiEncoding': 'cp1252', 'MacRomanEncoding': 'mac_roman', 'StandardEncoding': 'latin-1'}
+
+
+class FontCodec:
+    """Соответствие кодов шрифта (по width байт) и символов.
+
+    used - символы, выведенные этим шрифтом в разобранных потоках (для подмножеств шрифтов).
+    """
+
+    def __init__(self, decode_map, width=1, subset=False):
+        self.width = width
+        self.subset = subset
+        self.decode_map = decode_map
+        self.encode_map = {}
+        self.used = set()
+        for code, char in sorted(decode_map.items()):
+            self.encode_map.setdefault(char, code)
+
+    def decode(self, raw):
+        """Символы строки по одному на код или None, если код неизвестен либо даёт не один символ."""
+        if len(raw) % self.width:
+            return None
+        chars = []
+        for i in range(0, len(raw), self.width):
+            char = self.decode_map.get(raw[i:i + self.width])
+            if char is None or len(char) != 1:
+                return None
+            chars.append(char)
+        return ''.join(chars)
+
+    def can_replace(self, old, new):
+        """Можно ли заменить old на new той же длины, не выходя за глифы шрифта."""
+        return len(old) == len(new) and all(
+            o == n or (n in self.encode_map and (not self.subset or n in self.used)) for o, n in zip(old, new))
+
+    def patch(self, raw, old, new):
+        """raw с кодами изменившихся символов, заменёнными кодами символов new."""
+        codes = [raw[i:i + self.width] for i in range(0, len(raw), self.width)]
+        return b''.join(code if o == n else self.encode_map[n] for code, o, n in zip(codes, old, new))
+
+
+def _hex_bytes(text):
+    text = re.sub(rb'\s+', b'', text)
+    if len(text) % 2:
+        text += b'0'
+    return bytes.fromhex(text.decode('ascii'))
+
+
+def parse_tounicode(data):
+    """Разбирает CMap ToUnicode: ({код: строка}, ширина кода в байтах)."""
+    mapping = {}
+    for block in re.findall(rb'beginbfchar(.*?)endbfchar', data, re.S):
+        for src, dst in re.findall(rb'<([0-9A-Fa-f\s]+)>\s*<([0-9A-Fa-f\s]*)>', block):
+            mapping[_hex_bytes(src)] = _hex_bytes(dst).decode('utf-16-be', errors='ignore')
+    for block in re.findall(rb'beginbfrange(.*?)endbfrange', data, re.S):
+        for lo, hi, dst in re.findall(rb'<([0-9A-Fa-f\s]+)>\s*<([0-9A-Fa-f\s]+)>\s*(<[^>]*>|\[[^\]]*\])', block):
+            lo, hi = _hex_bytes(lo), _hex_bytes(hi)
+            width = len(lo)
+            start, end = int.from_bytes(lo, 'big'), int.from_bytes(hi, 'big')
+            if end - start > 0xFFFF:
+                continue
+            if dst.startswith(b'['):
+                targets = [_hex_bytes(item) for item in re.findall(rb'<([0-9A-Fa-f\s]*)>', dst)]
+                for offset, target in enumerate(targets[:end - start + 1]):
+                    mapping[(start + offset).to_bytes(width, 'big')] = target.decode('utf-16-be', errors='ignore')
+            else:
+                target = _hex_bytes(dst[1:-1])
+                base = int.from_bytes(target, 'big')
+                for offset in range(end - start + 1):
+                    value = (base + offset).to_bytes(len(target), 'big')
+                    mapping[(start + offset).to_bytes(width, 'big')] = value.decode('utf-16-be', errors='ignore')
+    width = len(next(iter(mapping))) if mapping else 1
+    return {code: text for code, text in mapping.items() if len(code) == width}, width
+
+
+def glyph_char(name):
+    """Символ по имени глифа (uniXXXX, uXXXX[XX], однобуквенные имена и _GLYPH_NAMES) или None."""
+    if name in _GLYPH_NAMES:
+        return _GLYPH_NAMES[name]
+    if len(name) == 1 and name.isalpha():
+        return name
+    match = re.fullmatch(r'uni([0-9A-Fa-f]{4})|u([0-9A-Fa-f]{4,6})', name)
+    if match:
+        return chr(int(match.group(1) or match.group(2), 16))
+    return None
+
+
+def simple_encoding_map(base_encoding=None, differences=None):
+    """Коды однобайтового шрифта по базовой кодировке и массиву /Differences.
+
+    :param base_encoding: Имя кодировки без '/' (WinAnsiEncoding, ...) или None.
+    :param differences: Элементы /Differences: числа (код) и имена глифов без '/'.
+    """
+    codec = _BASE_ENCODINGS.get(base_encoding, 'cp1252')
+    mapping = {}
+    for code in range(32, 256):
+        try:
+            mapping[bytes([code])] = bytes([code]).decode(codec)
+        except UnicodeDecodeError:
+            continue
+    if base_encoding in (None, 'StandardEncoding'):
+        # в StandardEncoding совпадает с ASCII только печатная часть
+        mapping = {code: char for code, char in mapping.items() if code[0] < 127}
+    code = None
+    for item in differences or ():
+        if isinstance(item, int):
+            code = item
+            continue
+        if code is None or code > 255:
+            continue
+        char = glyph_char(item)
+        if char is None:
+            mapping.pop(bytes([code]), None)
+        else:
+            mapping[bytes([code])] = char
+        code += 1
+    return mapping
+
+
+def _literal_string(data, pos):
+    """Литеральная строка с позиции pos ('('): (байты, позиция после ')')."""
+    out = bytearray()
+    depth = 1
+    i = pos + 1
+    escapes = {ord('n'): b'\n', ord('r'): b'\r', ord('t'): b'\t', ord('b'): b'\b', ord('f'): b'\f',
+               ord('('): b'(', ord(')'): b')', ord('\\'): b'\\'}
+    while i < len(data):
+        byte = data[i]
+        if byte == ord('\\'):
+            i += 1
+            if i >= len(data):
+                break
+            byte = data[i]
+            if byte in escapes:
+                out += escapes[byte]
+                i += 1
+            elif ord('0') <= byte <= ord('7'):
+                digits = re.match(rb'[0-7]{1,3}', data[i:i + 3]).group(0)
+                out.append(int(digits, 8) & 0xFF)
+                i += len(digits)
+            elif byte in b'\r\n':
+                i += 2 if data[i:i + 2] == b'\r\n' else 1   # перенос строки внутри строки
+            else:
+                out.append(byte)
+                i += 1
+            continue
+        if byte == ord('('):
+            depth += 1
+        elif byte == ord(')'):
+            depth -= 1
+            if depth == 0:
+                return bytes(out), i + 1
+        out.append(byte)
+        i += 1
+    raise ValueError("Незакрытая строка в потоке содержимого")
+
+
+def serialize_string(raw, hex_form=False):
+    """Строка PDF в литеральной или шестнадцатеричной форме."""
+    if hex_form:
+        return b'<' + raw.hex().upper().encode('ascii') + b'>'
+    escaped = raw.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)').replace(b'\r', b'\\r')
+    return b'(' + escaped + b')'
+
+
+def tokenize(data):
+    """Лексемы потока содержимого: (вид, значение, начало, конец).
+
+    Виды: 'str' (значение - (байты, шестнадцатеричная ли форма)), 'name', 'word'
+    (числа и операторы), '[' и ']', 'dict' (<< и >>). Данные встроенных
+    изображений (BI ... ID ... EI) пропускаются.
+    """
+    i, length = 0, len(data)
+    while i < length:
+        byte = data[i]
+        if byte in _WHITESPACE:
+            i += 1
+        elif byte == ord('%'):
+            while i < length and data[i] not in b'\r\n':
+                i += 1
+        elif byte == ord('('):
+            raw, end = _literal_string(data, i)
+            yield 'str', (raw, False), i, end
+            i = end
+        elif data.startswith(b'<<', i) or data.startswith(b'>>', i):
+            yield 'dict', data[i:i + 2], i, i + 2
+            i += 2
+        elif byte == ord('<'):
+            end = data.index(b'>', i)
+            yield 'str', (_hex_bytes(data[i + 1:end]), True), i, end + 1
+            i = end + 1
+        elif byte in b'[]':
+            yield chr(byte), None, i, i + 1
+            i += 1
+        elif byte in b'{}':
+            i += 1
+        else:
+            start = i
+            i += 1
+            while i < length and data[i] not in _WHITESPACE and data[i] not in _DELIMITERS:
+                i += 1
+            word = data[start:i]
+            if word.startswith(b'/'):
+                yield 'name', word[1:], start, i
+                continue
+            yield 'word', word, start, i
+            if word == b'ID':
+                # данные изображения до EI, окружённого пробельными символами
+                match = re.compile(rb'[\x00\t\n\x0c\r ]EI(?=[\x00\t\n\x0c\r ]|$)').search(data, i + 1)
+                i = match.end() if match else length
+
+
+class TextOperator:
+    """Текстовый оператор потока: кодек шрифта, лексемы строк и их текст (по строке на лексему)."""
+    __slots__ = ('codec', 'strings', 'texts')
+
+    def __init__(self, codec, strings, texts):
+        self.codec = codec
+        self.strings = strings
+        self.texts = texts
+
+    @property
+    def text(self):
+        return ''.join(self.texts)
+
+
+def text_operators(data, codecs):
+    """Текстовые операторы потока в порядке вывода, строки которых декодируются кодеком шрифта.
+
+    Символы операторов добавляются в FontCodec.used.
+    :param codecs: {имя ресурса шрифта (bytes, без '/'): FontCodec}.
+    """
+    operators = []
+    operands, arrays = [], []
+    font, font_stack = None, []
+    for kind, value, start, end in tokenize(data):
+        if kind == '[':
+            arrays.append(len(operands))
+            continue
+        if kind == ']':
+            if arrays:
+                begin = arrays.pop()
+                operands[begin:] = [('array', operands[begin:], start, end)]
+            continue
+        if kind != 'word' or arrays or value[:1].isdigit() or value[:1] in b'+-.':
+            operands.append((kind, value, start, end))
+            continue
+        if value == b'Tf' and len(operands) >= 2 and operands[-2][0] == 'name':
+            font = operands[-2][1]
+        elif value == b'q':
+            font_stack.append(font)
+        elif value == b'Q' and font_stack:
+            font = font_stack.pop()
+        elif value in _TEXT_OPERATORS and operands and font in codecs:
+            operand = operands[-1]
+            strings = [item for item in (operand[1] if operand[0] == 'array' else [operand]) if item[0] == 'str']
+            codec = codecs[font]
+            texts = [codec.decode(item[1][0]) for item in strings]
+            if strings and None not in texts:
+                codec.used.update(*texts)
+                operators.append(TextOperator(codec, strings, texts))
+        operands = []
+    return operators
+
+
+def align_operators(operators, page_text):
+    """Позиции текста операторов в тексте страницы: [начало или None].
+
+    Операторы идут в тексте страницы в порядке вывода; между ними может быть
+    текст, которого нет в списке (другие шрифты, Form XObject, переводы строк).
+    Оператор без точного вхождения после предыдущего (например, с пробелом,
+    добавленным при разборе страницы) получает None.
+    """
+    starts, cursor = [], 0
+    for operator in operators:
+        text = operator.text
+        pos = page_text.find(text, cursor) if text else -1
+        if pos < 0:
+            starts.append(None)
+            continue
+        starts.append(pos)
+        cursor = pos + len(text)
+    return starts
+
+
+def patch_operators(data, edits):
+    """Поток с новым текстом операторов: edits - [(TextOperator, новый текст той же длины)].
+
+    Меняются только коды изменившихся символов; новые символы должны
+    проходить FontCodec.can_replace.
+    """
+    out, last = [], 0
+    edits = sorted(edits, key=lambda edit: edit[0].strings[0][2])
+    for operator, new_text in edits:
+        pos = 0
+        for (_, (raw, hex_form), start, end), old in zip(operator.strings, operator.texts):
+            new = new_text[pos:pos + len(old)]
+            pos += len(old)
+            if new == old:
+                continue
+            out.append(data[last:start])
+            out.append(serialize_string(operator.codec.patch(raw, old, new), hex_form=hex_form))
+            last = end
+    out.append(data[last:])
+    return b''.join(out)
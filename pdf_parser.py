@@ -1,35 +1,197 @@
 # pdf_parser.py
 import os
-import re
 import fitz
 import logging
-import platform
+import math
+import re
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from rule_engine import rule_compiler, rule_profiler
+from fast_copy import copy_verbatim
+from font_index import font_index, extract_face
+from pdf_content import (FontCodec, parse_tounicode, simple_encoding_map, text_operators, align_operators,
+                         patch_operators)
+
+# Флаги разбора текста страницы: как у rawdict, но без изображений
+TEXT_FLAGS = fitz.TEXTFLAGS_RAWDICT & ~fitz.TEXT_PRESERVE_IMAGES
+# Документ разбивается на диапазоны по столько страниц для обработки в нескольких процессах
+PAGES_PER_CHUNK = 50
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+
+class TextSpan:
+    """Спан страницы: символы text[start:end] индекса, шрифт, размер, цвет, базовая точка, bbox
+    и направление строки (dir из rawdict, (1, 0) - горизонтальный текст)."""
+    __slots__ = ('start', 'end', 'font', 'size', 'color', 'origin', 'bbox', 'dir')
+
+    def __init__(self, start, end, font, size, color, origin, bbox, dir=(1.0, 0.0)):
+        self.start = start
+        self.end = end
+        self.font = font
+        self.size = size
+        self.color = color
+        self.origin = origin
+        self.bbox = bbox
+        self.dir = dir
+
+
+class PageTextIndex:
+    """Индекс текста страницы, построенный одним вызовом get_text("rawdict").
+
+    text - текст страницы (спаны строки подряд, строки через '\n', как в
+    get_text("text")); для каждого символа хранится его bbox, для каждого
+    спана - диапазон символов и стиль. Совпадения правил ищутся в text, а
+    прямоугольник и стиль берутся из индекса, без search_for и повторного
+    разбора страницы.
+    """
+
+    def __init__(self, page, textpage=None):
+        """:param textpage: Уже разобранный текст страницы (page.get_textpage(TEXT_FLAGS)), чтобы не разбирать её снова."""
+        self.spans = []
+        self._boxes = []   # bbox символа; None для перевода строки
+        self._origins = []
+        pieces = []
+        raw = page.get_text("rawdict", flags=TEXT_FLAGS, textpage=textpage)
+        for block in raw.get("blocks", []):
+            if block.get("type") != 0:
+                continue
+            for line in block.get("lines", []):
+                for span in line.get("spans", []):
+                    start = len(pieces)
+                    for char in span.get("chars", []):
+                        pieces.append(char["c"])
+                        self._boxes.append(char["bbox"])
+                        self._origins.append(char["origin"])
+                    self.spans.append(TextSpan(start, len(pieces), span.get("font", "helv"), span.get("size", 8.0),
+                                               span.get("color", 0), span.get("origin"), span.get("bbox"),
+                                               tuple(line.get("dir", (1.0, 0.0)))))
+                pieces.append("\n")
+                self._boxes.append(None)
+                self._origins.append(None)
+        self.text = "".join(pieces)
+        self._starts = [span.start for span in self.spans]
+
+    def span_at(self, offset):
+        """Спан, которому принадлежит символ text[offset]."""
+        return self.spans[max(bisect_right(self._starts, offset) - 1, 0)] if self.spans else None
+
+    def origin(self, offset):
+        """Базовая точка символа text[offset] (начало новой строки при вставке текста)."""
+        return self._origins[offset]
+
+    def rect(self, start, end):
+        """Прямоугольник символов text[start:end] или None, если диапазон переходит на другую строку."""
+        boxes = self._boxes[start:end]
+        if not boxes or None in boxes:
+            return None
+        return fitz.Rect(min(b[0] for b in boxes), min(b[1] for b in boxes),
+                         max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+
+def _process_page_range(job):
+    """Обрабатывает страницы [first, last) документа в отдельном процессе.
+
+    Процесс открывает документ сам и подключает снимок правил основного процесса
+    (settings['config_data']); журнал собирается в список и выводится
+    в основном процессе. Если в основном процессе включён профилировщик
+    правил (profile - кортеж из текущего файла профилировщика), статистика процесса
+    возвращается для RuleProfiler.merge.
+    :return: (номера изменённых страниц, PDF только из этих страниц или None, если изменений нет,
+              сообщения журнала, статистика профилировщика или None).
+    """
+    input_path, first, last, settings, profile = job
+    messages = []
+    if settings.get('config_data') is not None:
+        rule_compiler.load_snapshot(settings['config_data'])
+    if profile is not None:
+        rule_profiler.start()
+        rule_profiler.current_file = profile[0]
+    else:
+        rule_profiler.stop()
+    processor = PdfProcessor(log_callback=messages.append, workers=1, **settings)
+    doc = fitz.open(input_path)
+    try:
+        changed_pages = processor._process_pages(doc, range(first, last))
+        data = None
+        if changed_pages:
+            part = fitz.open()
+            for page_num in changed_pages:
+                part.insert_pdf(doc, from_page=page_num, to_page=page_num, links=False, annots=False)
+            data = part.tobytes(garbage=3, deflate=True)
+        return changed_pages, data, messages, rule_profiler.export() if profile is not None else None
+    finally:
+        doc.close()
+
+
+def _transplant_pages(doc, part, page_nums):
+    """Переносит содержимое страниц part на страницы page_nums документа doc.
+
+    Страницы doc остаются теми же объектами: меняются только /Contents и
+    /Resources, поэтому ссылки, аннотации, именованные назначения и
+    оглавление, указывающие на эти страницы, сохраняются.
+    """
+    start = len(doc)
+    doc.insert_pdf(part, links=False, annots=False)
+    for offset, page_num in enumerate(page_nums):
+        source, target = doc[start + offset].xref, doc[page_num].xref
+        for key in ("Contents", "Resources"):
+            kind, value = doc.xref_get_key(source, key)
+            if kind != 'null':
+                doc.xref_set_key(target, key, value)
+    # временные страницы удаляются, их потоки и ресурсы остаются у страниц doc
+    doc.delete_pages(start, len(doc) - 1)
+
+
+# Загруженные шрифты, общие для всех процессоров в процессе:
+# имя шрифта PDF -> fitz.Font или имя встроенного шрифта; имя шрифта PDF -> fitz.Font для TextWriter
+_font_cache = {}
+_writer_fonts = {}
+
+# Шрифты PDF, для которых вставляется встроенный шрифт MuPDF с тем же начертанием
+_BUILTIN_FONTS = (("times", "tiro"), ("courier", "cour"))
+
 
 class PdfProcessor:
-    def __init__(self, replacement_digit, project, rules, log_callback=None, debug=False):
+    """Замена текста в PDF.
+
+    replace_mode:
+        'content' - замены той же длины вносятся прямо в строки операторов Tj/TJ
+                    потока содержимого, если кодировка шрифта это позволяет (см.
+                    pdf_content); остальные совпадения заменяются как в 'redact'
+                    (по умолчанию);
+        'redact'  - все совпадения страницы удаляются одним apply_redactions,
+                    новый текст вставляется одним TextWriter на цвет;
+        'overlay' - старый текст закрашивается белым прямоугольником, новый
+                    вставляется insert_textbox поверх, для каждого совпадения отдельно.
+
+    Документы больше pages_per_chunk страниц при workers > 1 обрабатываются
+    диапазонами страниц в пуле процессов (см. _process_parallel).
+    """
+    def __init__(self, replacement_digit, project, rules, log_callback=None, debug=False, replace_mode='content',
+                 workers=None, pages_per_chunk=PAGES_PER_CHUNK, config_data=None):
+        """
+        :param workers: Число процессов (None - по числу ядер, не больше 4; 1 - без пула).
+        :param pages_per_chunk: Страниц в одном диапазоне для процесса.
+        :param config_data: Вся конфигурация (config.json): по ней рабочие процессы
+            подключают снимок правил (rule_compiler.load_snapshot) и не компилируют правила заново.
+        """
         self.replacement_digit = str(replacement_digit)
+        self.project = project
+        self.rules = rules
         self.debug = debug
+        self.replace_mode = replace_mode
+        self.workers = DEFAULT_WORKERS if workers is None else max(1, workers)
+        self.pages_per_chunk = max(1, pages_per_chunk)
+        self.config_data = config_data
         self.log = log_callback or (lambda msg: None)
         self._log(f"Инициализация PdfProcessor с цифрой: {self.replacement_digit} и проектом: {project}")
         self.patterns = self._load_patterns(rules)
-        self._font_cache = {}  # кеш для fitz.Font объектов
 
     def _load_patterns(self, rules):
-        patterns = []
-        try:
-            for rule_name, rule in rules.items():
-                try:
-                    pattern = eval(rule["pattern"], {"re": re})
-                    replacement = eval(rule["replacement"], {"self": self})
-                    patterns.append((pattern, replacement, rule_name))
-                    self._log(f"Загружено правило '{rule_name}' для pdf_parser")
-                except Exception as e:
-                    self._log(f"Ошибка загрузки правила '{rule_name}': {e}")
-        except Exception as e:
-            self._log(f"Ошибка обработки rules: {e}")
-        if not patterns:
-            self._log("Предупреждение: Нет patterns для этого проекта/парсера")
-        return patterns
+        self.rule_set = rule_compiler.get(rules, self.replacement_digit, project=self.project,
+                                          parser='pdf_parser')
+        self._log(f"Загружено правил для pdf_parser: {len(self.rule_set)}")
+        return [(rule.pattern, rule.replacement, rule.name) for rule in self.rule_set.rules]
 
     def _log(self, message):
         always_log = (
@@ -43,32 +205,12 @@ class PdfProcessor:
         if self.debug or always_log:
             self.log(message)
 
-    def _apply_replacements(self, text):
-        if text is None:
-            return None
-        original_text = text
-        for pattern, repl, rule_name in self.patterns:
-            text = pattern.sub(repl, text) if callable(repl) else pattern.sub(repl, text)
-        if text != original_text:
-            self._log(f"Замена текста: '{original_text}' → '{text}'")
-        return text
-
-    def _get_style_for_text(self, page, old_str, rect):
-        """Извлекает шрифт, размер и цвет из dict-структуры страницы для совпадающего текста."""
-        text_dict = page.get_text("dict")
-        for block in text_dict.get("blocks", []):
-            for line in block.get("lines", []):
-                for span in line.get("spans", []):
-                    span_text = span.get("text", "")
-                    if old_str in span_text:
-                        font = span.get("font", "helv")  # Fallback на helv
-                        size = span.get("size", 8.0)     # Fallback на 8 pt
-                        color = span.get("color", 0)     # Может быть int или tuple
-                        origin = span.get("origin", (rect.x0, rect.y0))
-                        self._log(f"Извлечён стиль для '{old_str}': font={font}, size={size}, color={color}")
-                        return font, size, color, origin[1]  # Возвращаем y для baseline
-        # Fallback, если не найдено
-        return "helv", 8.0, 0, rect.y0
+    def _find_matches(self, index):
+        """Совпадения правил в тексте страницы за один проход по индексу (RuleSet.find_matches).
+
+        :return: [(start, end, старый текст, новый текст, имя правила)] по возрастанию start.
+        """
+        return self.rule_set.find_matches(index.text)
 
     def _color_to_tuple(self, color):
         """
@@ -100,66 +242,18 @@ class PdfProcessor:
 
     def _find_system_font_file(self, font_name):
         """
-        Пробует найти файл шрифта по имени на типичных системных путях.
-        Возвращает путь к файлу или None.
+        Ищет файл шрифта по имени в индексе системных шрифтов (font_index).
+        Возвращает (путь, номер шрифта в файле) или None.
         """
         if not font_name:
             return None
-
-        # Убираем пробелы и возможные постфиксы (например 'Bold', 'Italic' и т.п.)
-        base = font_name.split('+')[-1].split(',')[0].strip()
-        base_clean = re.sub(r'[^A-Za-z0-9]', '', base).lower()
-
-        candidates = []
-        system = platform.system()
-        if system == "Windows":
-            win_fonts = os.path.join(os.environ.get("WINDIR", "C:\\Windows"), "Fonts")
-            # типичные расширения
-            for ext in (".ttf", ".TTF", ".otf", ".ttc"):
-                candidates.append(os.path.join(win_fonts, base + ext))
-                candidates.append(os.path.join(win_fonts, base_clean + ext))
-                # часто имя файла может быть arial.ttf для Arial
-                candidates.append(os.path.join(win_fonts, base.split()[0] + ext))
-        else:
-            # Linux / macOS пути
-            unix_paths = [
-                "/usr/share/fonts",
-                "/usr/local/share/fonts",
-                os.path.expanduser("~/.fonts"),
-                "/Library/Fonts",
-                "/System/Library/Fonts"
-            ]
-            for p in unix_paths:
-                for ext in (".ttf", ".otf", ".ttc"):
-                    candidates.append(os.path.join(p, base + ext))
-                    candidates.append(os.path.join(p, base_clean + ext))
-                    candidates.append(os.path.join(p, base.split()[0] + ext))
-
-        # проверить кандидатов
-        for c in candidates:
-            if c and os.path.exists(c):
-                return c
-
-        # дополнительно: попробовать найти любой файл, в имени которого есть base_clean
-        for root in (os.path.join(os.environ.get("WINDIR", "C:\\Windows"), "Fonts"), "/usr/share/fonts", "/usr/local/share/fonts", os.path.expanduser("~/.fonts"), "/Library/Fonts"):
-            if not root or not os.path.isdir(root):
-                continue
-            try:
-                for fname in os.listdir(root):
-                    if base_clean and base_clean in fname.lower():
-                        full = os.path.join(root, fname)
-                        if os.path.isfile(full):
-                            return full
-            except Exception:
-                continue
-
-        return None
+        return font_index.lookup(font_name)
 
     def _ensure_fitz_font(self, font_name):
         """
         Возвращает либо объект fitz.Font (если удалось загрузить файл),
         либо встроенное имя шрифта (str) для использования в insert_text.
-        Кеширует объекты.
+        Кеш общий для всех процессоров в процессе.
         """
         if not font_name:
             return "helv"
@@ -170,91 +264,373 @@ class PdfProcessor:
             return font_name.lower()
 
         # Кеширование по имени
-        if font_name in self._font_cache:
-            return self._font_cache[font_name]
+        if font_name in _font_cache:
+            return _font_cache[font_name]
 
-        # Попробуем найти файл шрифта в системе
-        font_path = self._find_system_font_file(font_name)
-        if font_path:
+        found = self._find_system_font_file(font_name)
+        if found:
+            font_path, face = found
             try:
-                fobj = fitz.Font(file=font_path)
-                self._font_cache[font_name] = fobj
-                self._log(f"Загружен системный файл шрифта для '{font_name}': {font_path}")
+                if face:
+                    fobj = fitz.Font(fontbuffer=extract_face(font_path, face))
+                else:
+                    fobj = fitz.Font(fontfile=font_path)
+                _font_cache[font_name] = fobj
+                self._log(f"Загружен системный файл шрифта для '{font_name}': {font_path} (шрифт {face})")
                 return fobj
             except Exception as e:
                 self._log(f"Не удалось загрузить файл шрифта '{font_path}' для '{font_name}': {e}")
 
         # Если не удалось — попробуем простую конвертацию имени (например, Arial -> helv)
         self._log(f"Файл шрифта для '{font_name}' не найден. Использую fallback 'helv'.")
-        self._font_cache[font_name] = "helv"
+        _font_cache[font_name] = "helv"
         return "helv"
 
+    def _overlay_page(self, page, page_num, index, matches):
+        """Режим 'overlay': белый прямоугольник и insert_textbox для каждого совпадения."""
+        changes_made = False
+        for start, end, old_str, new_str, rule_name in matches:
+            rect = index.rect(start, end)
+            if rect is None:
+                self._log(f"Пропуск замены '{old_str}' на странице {page_num + 1}: текст на нескольких строках")
+                continue
+            span = index.span_at(start)
+            font, size, color = span.font, span.size, span.color
+            self._log(f"Извлечён стиль для '{old_str}': font={font}, size={size}, color={color}")
+
+            try:
+                # закрасить прямоугольник белым (чтобы "стереть" старый текст)
+                page.draw_rect(rect, color=(1, 1, 1), fill=(1, 1, 1))
+
+                # подготовка шрифта и цвета
+                font_obj_or_name = self._ensure_fitz_font(font)
+                color_tuple = self._color_to_tuple(color)
+
+                # Вставляем текст в тот же rect (insert_textbox сам позаботится о переносах)
+                if isinstance(font_obj_or_name, fitz.Font):
+                    # если у вас объект fitz.Font, удобнее использовать стандартное имя для insert_textbox,
+                    # но если нужно — можно пробовать font=font_obj_or_name (в зависимости от версии PyMuPDF).
+                    page.insert_textbox(rect, new_str, fontsize=size, fontname="helv",
+                                        color=color_tuple, align=0)
+                else:
+                    page.insert_textbox(rect, new_str, fontsize=size, fontname=font_obj_or_name,
+                                        color=color_tuple, align=0)
+
+                self._log(
+                    f"Замена (textbox) на странице {page_num + 1} по правилу '{rule_name}': '{old_str}' → '{new_str}' (font={font}, size={size})")
+            except Exception as e:
+                self._log(f"Ошибка вставки (draw_rect+textbox) для '{old_str}': {e}")
+                # fallback: попытаться вставить с helv и чёрным цветом
+                try:
+                    page.draw_rect(rect, color=(1, 1, 1), fill=(1, 1, 1))
+                    page.insert_textbox(rect, new_str, fontsize=size, fontname="helv",
+                                        color=(0, 0, 0), align=0)
+                    self._log(
+                        f"Успешная вставка (fallback helv) на странице {page_num + 1}: '{new_str}'")
+                except Exception as e2:
+                    self._log(f"Критическая ошибка вставки текста (fallback): {e2}")
+
+            changes_made = True
+        return changes_made
+
+    def _writer_font(self, font_name):
+        """fitz.Font для вставки текста через TextWriter (файл системного шрифта или встроенный шрифт)."""
+        if font_name not in _writer_fonts:
+            font = self._ensure_fitz_font(font_name)
+            if not isinstance(font, fitz.Font):
+                builtin = next((name for key, name in _BUILTIN_FONTS if key in (font_name or '').lower()), "helv")
+                font = fitz.Font(builtin)
+            _writer_fonts[font_name] = font
+        return _writer_fonts[font_name]
+
+    @staticmethod
+    def _add_redaction(page, rects):
+        """Одна аннотация Redact на все прямоугольники страницы (по четырёхугольнику в QuadPoints).
+
+        add_redact_annot на каждое совпадение перебирает все аннотации
+        страницы, и сотни совпадений на листе обходились квадратично.
+        """
+        annot = page.add_redact_annot(rects[0], fill=False)
+        if len(rects) == 1:
+            return
+        to_pdf = ~page.transformation_matrix
+        points = []
+        for rect in rects:
+            quad = rect.quad * to_pdf
+            points.extend(coord for point in (quad.ul, quad.ur, quad.ll, quad.lr) for coord in (point.x, point.y))
+        union = fitz.Rect(rects[0])
+        for rect in rects[1:]:
+            union |= rect
+        doc = page.parent
+        doc.xref_set_key(annot.xref, "QuadPoints", "[%s]" % " ".join("%g" % coord for coord in points))
+        doc.xref_set_key(annot.xref, "Rect", "[%g %g %g %g]" % tuple(union * to_pdf))
+
+    @staticmethod
+    def _restore_links(page, links):
+        """Возвращает в /Annots страницы ссылки links [(xref, исходник объекта)], которые из него пропали.
+
+        apply_redactions убирает из /Annots ссылки, пересекающие область, но
+        сами объекты остаются в документе - они возвращаются как есть (рамка,
+        цвета, /AP). Если объект всё же удалён, он создаётся заново из исходника.
+        """
+        doc = page.parent
+        annots = [xref for xref, _, _ in page.annot_xrefs()]
+        missing = [(xref, source) for xref, source in links if xref not in annots]
+        if not missing:
+            return
+        for xref, source in missing:
+            if doc.xref_object(xref).strip() in ("", "null"):
+                xref = doc.get_new_xref()
+                doc.update_object(xref, source)
+            annots.append(xref)
+        doc.xref_set_key(page.xref, "Annots", "[%s]" % " ".join(f"{xref} 0 R" for xref in annots))
+
+    def _redact_page(self, page, page_num, index, matches):
+        """Режим 'redact': все совпадения страницы - одна операция apply_redactions.
+
+        Удаляется только текст под совпадениями (графика и изображения
+        остаются), новый текст ставится на базовую линию старого одним
+        TextWriter на цвет, так что каждый шрифт добавляется в ресурсы
+        страницы один раз. Если новый текст шире старого, кегль уменьшается.
+        """
+        inserts = []
+        for start, end, old_str, new_str, rule_name in matches:
+            rect = index.rect(start, end)
+            if rect is None:
+                self._log(f"Пропуск замены '{old_str}' на странице {page_num + 1}: текст на нескольких строках")
+                continue
+            inserts.append((index.origin(start), rect, index.span_at(start), old_str, new_str, rule_name))
+        if not inserts:
+            return False
+        self._add_redaction(page, [rect for _, rect, _, _, _, _ in inserts])
+        # apply_redactions удаляет ссылки, пересекающие область, - заменённый текст остаётся ссылкой
+        links = [(link["xref"], page.parent.xref_object(link["xref"])) for link in page.get_links() if link.get("xref")]
+        page.apply_redactions(images=fitz.PDF_REDACT_IMAGE_NONE,
+                              graphics=getattr(fitz, "PDF_REDACT_LINE_ART_NONE", 0))
+        self._restore_links(page, links)
+
+        writers = {}   # цвет -> TextWriter для горизонтального текста
+        for origin, rect, span, old_str, new_str, rule_name in inserts:
+            font = self._writer_font(span.font)
+            size = span.size
+            width = font.text_length(new_str, fontsize=size)
+            dx, dy = span.dir
+            room = abs(dx) * rect.width + abs(dy) * rect.height
+            if width > room > 0:
+                size *= room / width
+            color = self._color_to_tuple(span.color)
+            if (dx, dy) == (1.0, 0.0):
+                if color not in writers:
+                    writers[color] = fitz.TextWriter(page.rect, color=color)
+                writers[color].append(origin, new_str, font=font, fontsize=size)
+            else:
+                # повёрнутый текст (редкость на чертежах) - отдельно, с поворотом вокруг базовой точки
+                writer = fitz.TextWriter(page.rect, color=color)
+                writer.append(origin, new_str, font=font, fontsize=size)
+                writer.write_text(page, morph=(fitz.Point(origin), fitz.Matrix(-math.degrees(math.atan2(dy, dx)))))
+            self._log(f"Замена (redact) на странице {page_num + 1} по правилу '{rule_name}': "
+                      f"'{old_str}' → '{new_str}' (font={span.font}, size={size:g})")
+        for writer in writers.values():
+            writer.write_text(page)
+        return True
+
+    @staticmethod
+    def _font_codec(doc, xref):
+        """FontCodec шрифта xref или None, если коды шрифта нельзя сопоставить символам.
+
+        Type0 - только Identity-H/V с ToUnicode; простые шрифты - по ToUnicode
+        или по /Encoding с /Differences; Type3 и символьные шрифты без
+        кодировки не поддерживаются.
+        """
+        subtype = doc.xref_get_key(xref, "Subtype")[1]
+        subset = re.match(r'/[A-Z]{6}\+', doc.xref_get_key(xref, "BaseFont")[1]) is not None
+        mapping, width = {}, 1
+        kind, value = doc.xref_get_key(xref, "ToUnicode")
+        if kind == 'xref':
+            mapping, width = parse_tounicode(doc.xref_stream(int(value.split()[0])) or b'')
+        if subtype == '/Type0':
+            if doc.xref_get_key(xref, "Encoding")[1] not in ('/Identity-H', '/Identity-V') or width != 2:
+                return None
+        elif subtype in ('/Type1', '/MMType1', '/TrueType'):
+            if not mapping or width != 1:
+                kind, value = doc.xref_get_key(xref, "Encoding")
+                if kind == 'name':
+                    base, differences = value[1:], None
+                elif kind == 'null':
+                    flags = doc.xref_get_key(xref, "FontDescriptor/Flags")[1]
+                    if (flags.isdigit() and int(flags) & 4) or \
+                            doc.xref_get_key(xref, "BaseFont")[1] in ('/Symbol', '/ZapfDingbats'):
+                        return None   # символьный шрифт: коды - номера глифов встроенной кодировки
+                    base, differences = None, None
+                else:
+                    kind, value = doc.xref_get_key(xref, "Encoding/BaseEncoding")
+                    base = value[1:] if kind == 'name' else None
+                    differences = [int(code) if code else name for code, name in re.findall(
+                        r'(\d+)|/([^\s/\[\]<>()]+)', doc.xref_get_key(xref, "Encoding/Differences")[1])]
+                mapping, width = simple_encoding_map(base, differences), 1
+        else:
+            return None
+        return FontCodec(mapping, width, subset=subset)
+
+    def _page_codecs(self, page, codecs):
+        """{имя ресурса шрифта: FontCodec} для шрифтов страницы; codecs - кеш по xref шрифта на документ."""
+        page_codecs = {}
+        for xref, _, _, _, name, _, referencer in page.get_fonts(full=True):
+            if referencer != 0:
+                continue   # шрифт из ресурсов Form XObject, а не страницы
+            if xref not in codecs:
+                try:
+                    codecs[xref] = self._font_codec(page.parent, xref)
+                except (ValueError, RuntimeError) as e:
+                    self._log(f"Кодировка шрифта {xref} не разобрана: {e}")
+                    codecs[xref] = None
+            if codecs[xref] is not None:
+                page_codecs[name.encode('latin-1', errors='replace')] = codecs[xref]
+        return page_codecs
+
+    def _rewrite_content(self, page, page_num, index, matches, codecs):
+        """Заменяет совпадения прямо в строках текстовых операторов потока содержимого страницы.
+
+        Текст каждого оператора сопоставляется с его диапазоном в тексте
+        страницы (align_operators); меняются только совпадения matches той же
+        длины, целиком лежащие в одном операторе, шрифт которого позволяет
+        закодировать новые символы. После правки текст страницы разбирается
+        заново и должен отличаться от исходного ровно этими заменами, иначе
+        поток возвращается как был. Совпадения, разбитые между операторами, в
+        Form XObject или с другой длиной замены остаются для замены поверх.
+        :return: (изменена ли страница, индекс текста страницы, оставшиеся совпадения).
+        """
+        if not any(len(old_str) == len(new_str) for _, _, old_str, new_str, _ in matches):
+            return False, index, matches
+        page_codecs = self._page_codecs(page, codecs)
+        if not page_codecs:
+            return False, index, matches
+        try:
+            data = page.read_contents()
+            operators = text_operators(data, page_codecs)
+        except ValueError as e:
+            self._log(f"Поток содержимого страницы {page_num + 1} не разобран: {e}")
+            return False, index, matches
+
+        ranges = [(start, start + len(operator.text), operator)
+                  for start, operator in zip(align_operators(operators, index.text), operators) if start is not None]
+        range_starts = [start for start, _, _ in ranges]
+        new_texts, patched = {}, []
+        for match in matches:
+            start, end, old_str, new_str, rule_name = match
+            pos = bisect_right(range_starts, start) - 1
+            if pos < 0 or ranges[pos][1] < end or not ranges[pos][2].codec.can_replace(old_str, new_str):
+                continue
+            op_start, _, operator = ranges[pos]
+            text = new_texts.get(id(operator), (operator, operator.text))[1]
+            new_texts[id(operator)] = (operator, text[:start - op_start] + new_str + text[end - op_start:])
+            patched.append(match)
+        if not patched:
+            return False, index, matches
+
+        # новый поток, а не update_stream старого: один поток может быть общим для нескольких страниц
+        doc = page.parent
+        old_contents = doc.xref_get_key(page.xref, "Contents")[1]
+        xref = doc.get_new_xref()
+        doc.update_object(xref, "<<>>")
+        doc.update_stream(xref, patch_operators(data, list(new_texts.values())))
+        page.set_contents(xref)
+
+        expected, last = [], 0
+        for start, end, _, new_str, _ in patched:
+            expected += [index.text[last:start], new_str]
+            last = end
+        new_index = PageTextIndex(page)
+        if new_index.text != ''.join(expected) + index.text[last:]:
+            doc.xref_set_key(page.xref, "Contents", old_contents)
+            self._log(f"Поток содержимого страницы {page_num + 1} не сопоставлен с текстом, замена поверх")
+            return False, index, matches
+        for _, _, old_str, new_str, rule_name in patched:
+            self._log(f"Замена (content) на странице {page_num + 1} по правилу '{rule_name}': "
+                      f"'{old_str}' → '{new_str}'")
+        return True, new_index, [match for match in matches if match not in patched]
+
+    def _process_pages(self, doc, pages):
+        """Обрабатывает страницы pages документа; возвращает список номеров изменённых страниц.
+
+        Текст страницы разбирается один раз: по нему сначала проверяется
+        префильтр правил, и только страницы с кандидатами индексируются.
+        """
+        changed_pages = []
+        codecs = {}
+        for page_num in pages:
+            page = doc[page_num]
+            textpage = page.get_textpage(TEXT_FLAGS)
+            if not self.rule_set.could_match(textpage.extractText()):
+                continue
+            index = PageTextIndex(page, textpage)
+            matches = self._find_matches(index)
+            if not matches:
+                continue
+            page_changed = False
+            if self.replace_mode == 'content':
+                page_changed, index, matches = self._rewrite_content(page, page_num, index, matches, codecs)
+            if matches and self.replace_mode == 'overlay':
+                page_changed = self._overlay_page(page, page_num, index, matches) or page_changed
+            elif matches:
+                page_changed = self._redact_page(page, page_num, index, matches) or page_changed
+            if page_changed:
+                changed_pages.append(page_num)
+        return changed_pages
+
+    def _process_parallel(self, doc, input_path):
+        """Обрабатывает документ диапазонами по pages_per_chunk страниц в пуле из workers процессов.
+
+        Каждый процесс открывает файл сам и возвращает изменённые страницы
+        своего диапазона отдельным PDF; их содержимое переносится на страницы
+        doc (_transplant_pages), сами страницы не удаляются и не вставляются.
+        """
+        settings = {'replacement_digit': self.replacement_digit, 'project': self.project, 'rules': self.rules,
+                    'debug': self.debug, 'replace_mode': self.replace_mode, 'config_data': self.config_data}
+        profile = (rule_profiler.current_file,) if rule_profiler.enabled else None
+        jobs = [(input_path, first, min(first + self.pages_per_chunk, len(doc)), settings, profile)
+                for first in range(0, len(doc), self.pages_per_chunk)]
+        self._log(f"Обработка {len(doc)} страниц: {len(jobs)} диапазонов, процессов: {self.workers}")
+        font_index.load()   # индекс шрифтов строится до запуска процессов, они читают его с диска
+        if self.config_data is not None:
+            # набор правил pdf_parser мог быть только что скомпилирован - процессы читают его из снимка
+            rule_compiler.load_snapshot(self.config_data)
+            rule_compiler.save_snapshot()
+        changes_made = False
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(jobs))) as pool:
+            for changed_pages, data, messages, profile in pool.map(_process_page_range, jobs):
+                for message in messages:
+                    self.log(message)
+                if profile is not None:
+                    rule_profiler.merge(profile)
+                if data is None:
+                    continue
+                with fitz.open(stream=data, filetype="pdf") as part:
+                    _transplant_pages(doc, part, changed_pages)
+                changes_made = True
+        return changes_made
+
     def process_file(self, input_path, output_path):
         try:
             doc = fitz.open(input_path)
             self._log(f"Открыт PDF файл: {input_path}")
-            changes_made = False
-
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                full_text = page.get_text("text")
-                new_text = self._apply_replacements(full_text)
-
-                if new_text != full_text:
-                    for pattern, repl, rule_name in self.patterns:
-                        matches = pattern.finditer(full_text)
-                        for match in matches:
-                            old_str = match.group(0)
-                            new_str = repl(match) if callable(repl) else repl
-
-                            # Находим все вхождения old_str
-                            rects = page.search_for(old_str)
-                            for rect in rects:
-                                # Извлекаем оригинальный стиль
-                                font, size, color, baseline_y = self._get_style_for_text(page, old_str, rect)
-
-                                try:
-                                    # закрасить прямоугольник белым (чтобы "стереть" старый текст)
-                                    page.draw_rect(rect, color=(1, 1, 1), fill=(1, 1, 1))
-
-                                    # подготовка шрифта и цвета
-                                    font_obj_or_name = self._ensure_fitz_font(font)
-                                    color_tuple = self._color_to_tuple(color)
-
-                                    # Вставляем текст в тот же rect (insert_textbox сам позаботится о переносах)
-                                    if isinstance(font_obj_or_name, fitz.Font):
-                                        # если у вас объект fitz.Font, удобнее использовать стандартное имя для insert_textbox,
-                                        # но если нужно — можно пробовать font=font_obj_or_name (в зависимости от версии PyMuPDF).
-                                        page.insert_textbox(rect, new_str, fontsize=size, fontname="helv",
-                                                            color=color_tuple, align=0)
-                                    else:
-                                        page.insert_textbox(rect, new_str, fontsize=size, fontname=font_obj_or_name,
-                                                            color=color_tuple, align=0)
-
-                                    self._log(
-                                        f"Замена (textbox) на странице {page_num + 1} по правилу '{rule_name}': '{old_str}' → '{new_str}' (font={font}, size={size})")
-                                except Exception as e:
-                                    self._log(f"Ошибка вставки (draw_rect+textbox) для '{old_str}': {e}")
-                                    # fallback: попытаться вставить с helv и чёрным цветом
-                                    try:
-                                        page.draw_rect(rect, color=(1, 1, 1), fill=(1, 1, 1))
-                                        page.insert_textbox(rect, new_str, fontsize=size, fontname="helv",
-                                                            color=(0, 0, 0), align=0)
-                                        self._log(
-                                            f"Успешная вставка (fallback helv) на странице {page_num + 1}: '{new_str}'")
-                                    except Exception as e2:
-                                        self._log(f"Критическая ошибка вставки текста (fallback): {e2}")
-
-                    changes_made = True
+
+            if self.workers > 1 and len(doc) > self.pages_per_chunk:
+                changes_made = self._process_parallel(doc, input_path)
+            else:
+                changes_made = self._process_pages(doc, range(len(doc)))
 
             if changes_made:
-                doc.save(output_path)
+                # garbage=4 объединяет одинаковые объекты и потоки: шрифт новых надписей хранится один раз
+                # на файл, даже если страницы собраны из диапазонов разных процессов
+                doc.save(output_path, garbage=4, deflate=True)
+                doc.close()
                 self._log(f"Файл успешно обработан и сохранен: {output_path}")
             else:
+                doc.close()
                 self._log(f"Изменений не найдено в {input_path}, копируем оригинал")
-                doc.save(output_path)
+                copy_verbatim(input_path, output_path)
 
-            doc.close()
             return True
 
         except Exception as e:
@@ -0,0 +1,1201 @@
+# rule_engine.py
+"""Модуль rule_engine.py: Компиляция правил замены из config.json.
+
+Правила в config.json хранятся как строки Python ("re.compile(...)", "lambda m: ...")
+или в декларативном виде без eval:
+    {"regex": "(Unit\\s*)\\d\\b", "flags": ["IGNORECASE"], "template": "\\g<1>{digit}"}
+Шаблон замены - обычный шаблон re.sub (ссылки \\g<N>) с подстановкой {digit};
+для каждой цифры он заранее превращается в строку, и замена выполняется целиком в C.
+
+Любое правило может иметь необязательное поле "scope" - где правило применяется:
+    "scope": {"parts": ["xl/worksheets/*.xml"], "elements": ["oddHeader", "evenHeader"]}
+parts - шаблоны имён частей пакета (fnmatch), elements - локальные имена элементов
+XML, текст которых обрабатывается (для хвостового текста - имя родителя).
+Процессоры берут нужный поднабор через RuleSet.scoped(part, element); правила
+без scope действуют везде, как раньше.
+
+Раньше каждый процессор выполнял eval для всех правил при создании, а FileHandler
+создаёт новый процессор на каждый файл. Здесь правила компилируются один раз
+для каждого набора (проект, парсер, цифра замены), и все процессоры получают
+один и тот же объект RuleSet.
+
+Скомпилированные наборы сохраняются в снимок на диске, привязанный к хешу
+конфигурации: при холодном старте и в рабочих процессах исходники правил
+не разбираются заново.
+
+Основные объекты:
+    RuleSet           - скомпилированный набор правил с методами apply(text) и
+                        find_matches(text) (совпадения без замены, для PDF).
+    RuleCompiler      - кеш наборов правил и работа со снимком.
+    rule_compiler     - общий экземпляр RuleCompiler на процесс.
+    replacement_cache - общий LRU-кеш результатов RuleSet.apply.
+    rule_profiler     - профилировщик правил (по умолчанию выключен).
+"""
+import os
+import re
+import sys
+import csv
+import json
+import time
+import marshal
+import fnmatch
+import hashlib
+import logging
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from types import SimpleNamespace
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+SNAPSHOT_VERSION = 2
+
+# Дешёвые проверки классов символов, без которых правило не может сработать.
+_FEATURES = {
+    "digit": re.compile(r"\d"),
+    "upper": re.compile(r"[A-Z]"),
+}
+_DIGITS = frozenset(range(ord("0"), ord("9") + 1))
+_UPPER = frozenset(range(ord("A"), ord("Z") + 1))
+
+
+def default_cache_dir():
+    """Возвращает каталог для кешей приложения (снимки правил и т.п.)."""
+    base = os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "WESA_parser")
+
+
+def config_hash(config_data):
+    """Хеш конфигурации, не зависящий от порядка ключей и форматирования файла."""
+    dump = json.dumps(config_data, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(dump.encode("utf-8")).hexdigest()
+
+
+def rules_hash(rules):
+    """Хеш одного набора правил (например, config[project]["word_parser"])."""
+    dump = json.dumps(rules or {}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(dump.encode("utf-8")).hexdigest()
+
+
+def parse_flags(flags):
+    """Флаги декларативного правила: число, имя ("IGNORECASE", "I") или список имён."""
+    if not flags:
+        return 0
+    if isinstance(flags, int):
+        return flags
+    if isinstance(flags, str):
+        flags = flags.split("|")
+    value = 0
+    for name in flags:
+        flag = getattr(re, name.strip().upper(), None)
+        if not isinstance(flag, re.RegexFlag):
+            raise ValueError(f"Неизвестный флаг regex: {name}")
+        value |= flag
+    return value
+
+
+def parse_scope(scope):
+    """Проверяет поле "scope" правила; возвращает (parts, elements) или None.
+
+    parts/elements - кортежи строк или None (без ограничения).
+    """
+    if scope is None:
+        return None
+    if not isinstance(scope, dict) or not set(scope) <= {"parts", "elements"}:
+        raise ValueError('scope должен быть объектом с полями "parts" и/или "elements"')
+    result = []
+    for field in ("parts", "elements"):
+        values = scope.get(field)
+        if values is None:
+            result.append(None)
+            continue
+        if isinstance(values, str):
+            values = [values]
+        if not values or not all(isinstance(value, str) and value for value in values):
+            raise ValueError(f'scope.{field} должен быть непустым списком строк')
+        result.append(tuple(values))
+    return tuple(result)
+
+
+def render_template(template, replacement_digit):
+    """Подставляет цифру в шаблон замены декларативного правила."""
+    return template.replace("{digit}", str(replacement_digit).replace("\\", "\\\\"))
+
+
+_TEMPLATE_TOKEN = re.compile(r"\\(?:g<(\d+)>|(\d{1,2})|(\\))")
+
+
+def template_function(template):
+    """Превращает шаблон re.sub (\\g<N>, \\N, \\\\) в функцию от совпадения.
+
+    Нужна объединённому режиму, где номера групп правила сдвинуты.
+    Другие escape-последовательности не поддерживаются (ValueError).
+    """
+    parts, pos = [], 0
+    for m in _TEMPLATE_TOKEN.finditer(template):
+        literal = template[pos:m.start()]
+        if "\\" in literal:
+            raise ValueError(f"Неподдерживаемая escape-последовательность в шаблоне: {template}")
+        if literal:
+            parts.append(literal)
+        if m.group(3):
+            parts.append("\\")
+        else:
+            parts.append(int(m.group(1) or m.group(2)))
+        pos = m.end()
+    if "\\" in template[pos:]:
+        raise ValueError(f"Неподдерживаемая escape-последовательность в шаблоне: {template}")
+    if template[pos:]:
+        parts.append(template[pos:])
+    return lambda m: "".join(p if isinstance(p, str) else (m.group(p) or "") for p in parts)
+
+
+def _class_feature(items, ignorecase):
+    """Определяет, входит ли класс [...] целиком в цифры или заглавные латинские буквы."""
+    codes = set()
+    for op, av in items:
+        name = str(op)
+        if name == "CATEGORY" and str(av) == "CATEGORY_DIGIT":
+            return "digit"
+        if name == "LITERAL":
+            codes.add(av)
+        elif name == "RANGE" and av[1] - av[0] < 64:
+            codes.update(range(av[0], av[1] + 1))
+        else:
+            return None
+    if codes and codes <= _DIGITS:
+        return "digit"
+    if codes and codes <= _UPPER and not ignorecase:
+        return "upper"
+    return None
+
+
+def _scan_required(items, chars, features, ignorecase):
+    """Собирает обязательные элементы шаблона.
+
+    В chars складываются символы обязательных литералов (None - разрыв между
+    последовательностями), в features - обязательные классы символов.
+    """
+    for op, av in items:
+        name = str(op)
+        if name == "LITERAL":
+            chars.append(chr(av))
+        elif name == "AT":
+            continue  # якоря нулевой ширины не разрывают литерал
+        elif name == "SUBPATTERN":
+            add_flags, del_flags, sub = av[1], av[2], av[3]
+            if add_flags or del_flags:
+                chars.append(None)
+            else:
+                _scan_required(sub, chars, features, ignorecase)
+        elif name == "ATOMIC_GROUP":
+            _scan_required(av, chars, features, ignorecase)
+        elif name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT"):
+            chars.append(None)
+            if av[0] >= 1:
+                _scan_required(av[2], chars, features, ignorecase)
+                chars.append(None)
+        elif name == "IN":
+            feature = _class_feature(av, ignorecase)
+            if feature:
+                features.add(feature)
+            chars.append(None)
+        else:
+            chars.append(None)
+
+
+def analyze_pattern(pattern):
+    """Выводит префильтр правила: самый длинный обязательный литерал и классы символов.
+
+    :param pattern: Скомпилированный regex.
+    :return: (literal или None, ignorecase, frozenset имён классов из _FEATURES).
+    """
+    ignorecase = bool(pattern.flags & re.IGNORECASE)
+    if not isinstance(pattern.pattern, str):
+        return None, ignorecase, frozenset()
+    chars, features = [], set()
+    try:
+        _scan_required(sre_parse.parse(pattern.pattern, pattern.flags), chars, features, ignorecase)
+    except Exception:
+        return None, ignorecase, frozenset()
+    runs, current = [], []
+    for ch in chars + [None]:
+        if ch is None:
+            if current:
+                runs.append("".join(current))
+            current = []
+        else:
+            current.append(ch)
+    literal = max(runs, key=len) if runs else None
+    return literal, ignorecase, frozenset(features)
+
+
+# Разделитель строк в общем буфере RuleSet.apply_batch.
+BATCH_SEPARATOR = "\x00"
+# Границы слова ведут себя у разделителя так же, как у начала/конца строки.
+_SEPARATOR_SAFE_AT = {"AT_BOUNDARY", "AT_NON_BOUNDARY", "AT_UNI_BOUNDARY", "AT_UNI_NON_BOUNDARY",
+                      "AT_LOC_BOUNDARY", "AT_LOC_NON_BOUNDARY"}
+
+
+def _separator_safe(items):
+    """True, если ни один элемент шаблона не может совпасть с BATCH_SEPARATOR
+    и шаблон не привязан к началу/концу строки."""
+    for op, av in items:
+        name = str(op)
+        if name == "LITERAL":
+            if av == ord(BATCH_SEPARATOR):
+                return False
+        elif name in ("NOT_LITERAL", "ANY"):
+            return False
+        elif name == "IN":
+            if av and str(av[0][0]) == "NEGATE":
+                return False
+            if any(str(o) == "CATEGORY" and str(a) not in _SAMPLE_CATEGORIES for o, a in av):
+                return False
+            if _class_contains(av, BATCH_SEPARATOR):
+                return False
+        elif name == "AT":
+            if str(av) not in _SEPARATOR_SAFE_AT:
+                return False
+        elif name == "SUBPATTERN":
+            if not _separator_safe(av[3]):
+                return False
+        elif name == "ATOMIC_GROUP":
+            if not _separator_safe(av):
+                return False
+        elif name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT"):
+            if not _separator_safe(av[2]):
+                return False
+        elif name == "BRANCH":
+            if not all(_separator_safe(branch) for branch in av[1]):
+                return False
+        elif name in ("ASSERT", "ASSERT_NOT"):
+            if not _separator_safe(av[1]):
+                return False
+        elif name == "GROUPREF_EXISTS":
+            if not all(_separator_safe(branch) for branch in av[1:] if branch is not None):
+                return False
+        elif name != "GROUPREF":
+            return False
+    return True
+
+
+def is_joinable(pattern, replacement):
+    """Можно ли применять правило к нескольким строкам, склеенным через BATCH_SEPARATOR.
+
+    Совпадение не должно захватывать разделитель, зависеть от ^/$ или быть
+    пустым (иначе замены на стыках строк разойдутся с построчным применением).
+    """
+    if not isinstance(pattern.pattern, str):
+        return False
+    if isinstance(replacement, str) and BATCH_SEPARATOR in replacement:
+        return False
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+        return parsed.getwidth()[0] > 0 and _separator_safe(parsed)
+    except Exception:
+        return False
+
+
+class CompiledRule:
+    """Одно скомпилированное правило: имя, regex и замена (строка или функция).
+
+    literal/features - префильтр: правило может сработать только если в тексте
+    есть обязательный литерал и символы всех обязательных классов.
+    joinable - правило можно применять к склеенным строкам (см. is_joinable).
+    scope - (parts, elements) из parse_scope или None (правило действует везде).
+    """
+    __slots__ = ("name", "pattern", "replacement", "literal", "ignorecase", "folded", "features", "joinable",
+                 "scope")
+
+    def __init__(self, name, pattern, replacement, scope=None):
+        self.name = name
+        self.pattern = pattern
+        self.replacement = replacement
+        self.scope = scope
+        self.literal, self.ignorecase, features = analyze_pattern(pattern)
+        self.folded = self.literal.casefold() if self.literal is not None and self.ignorecase else None
+        self.features = tuple(_FEATURES[f] for f in sorted(features))
+        self.joinable = is_joinable(pattern, replacement)
+
+    @property
+    def anchor(self):
+        """Самое дешёвое необходимое условие правила в виде regex (или None)."""
+        if self.literal is not None:
+            escaped = re.escape(self.literal)
+            return f"(?i:{escaped})" if self.ignorecase else escaped
+        if self.features:
+            return self.features[0].pattern
+        return None
+
+    def may_match(self, text, folded=None):
+        """Быстрая проверка префильтра. folded - text.casefold(), если уже посчитан."""
+        if self.literal is not None:
+            if self.ignorecase:
+                if self.folded not in (folded if folded is not None else text.casefold()):
+                    return False
+            elif self.literal not in text:
+                return False
+        for feature in self.features:
+            if feature.search(text) is None:
+                return False
+        return True
+
+    def apply(self, text):
+        return self.pattern.sub(self.replacement, text)
+
+# Флаги, которые можно задать локально внутри группы объединённого шаблона.
+_SCOPED_FLAGS = {re.IGNORECASE: "i", re.MULTILINE: "m", re.DOTALL: "s"}
+_SAMPLE_CATEGORIES = {
+    "CATEGORY_DIGIT": "0", "CATEGORY_NOT_DIGIT": "a",
+    "CATEGORY_SPACE": " ", "CATEGORY_NOT_SPACE": "a",
+    "CATEGORY_WORD": "a", "CATEGORY_NOT_WORD": " ",
+}
+_CATEGORY_ESCAPES = {
+    "CATEGORY_DIGIT": r"\d", "CATEGORY_NOT_DIGIT": r"\D",
+    "CATEGORY_SPACE": r"\s", "CATEGORY_NOT_SPACE": r"\S",
+    "CATEGORY_WORD": r"\w", "CATEGORY_NOT_WORD": r"\W",
+}
+
+
+def _sample_class(items):
+    """Возвращает символ, входящий в класс [...]."""
+    if items and str(items[0][0]) == "NEGATE":
+        for candidate in " ~x0A":
+            if not _class_contains(items[1:], candidate):
+                return candidate
+        raise ValueError("negated class")
+    op, av = items[0]
+    name = str(op)
+    if name == "LITERAL":
+        return chr(av)
+    if name == "RANGE":
+        return chr(av[0])
+    if name == "CATEGORY" and str(av) in _SAMPLE_CATEGORIES:
+        return _SAMPLE_CATEGORIES[str(av)]
+    raise ValueError(f"class item {name}")
+
+
+def _class_contains(items, char):
+    code = ord(char)
+    for op, av in items:
+        name = str(op)
+        if name == "LITERAL" and av == code:
+            return True
+        if name == "RANGE" and av[0] <= code <= av[1]:
+            return True
+        if name == "CATEGORY" and str(av) in _SAMPLE_CATEGORIES:
+            if re.fullmatch(f"[{_CATEGORY_ESCAPES[str(av)]}]", char):
+                return True
+    return False
+
+
+def _sample_items(items, out, minimal):
+    for op, av in items:
+        name = str(op)
+        if name == "LITERAL":
+            out.append(chr(av))
+        elif name == "NOT_LITERAL":
+            out.append("~" if av != ord("~") else "!")
+        elif name == "ANY":
+            out.append("x")
+        elif name == "IN":
+            out.append(_sample_class(av))
+        elif name in ("AT", "ASSERT", "ASSERT_NOT"):
+            continue
+        elif name == "SUBPATTERN":
+            _sample_items(av[3], out, minimal)
+        elif name == "ATOMIC_GROUP":
+            _sample_items(av, out, minimal)
+        elif name == "BRANCH":
+            _sample_items(av[1][0], out, minimal)
+        elif name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT"):
+            count = av[0] if minimal else min(max(av[0], 1), av[1])
+            for _ in range(count):
+                _sample_items(av[2], out, minimal)
+        else:
+            raise ValueError(f"unsupported op {name}")
+
+
+def rule_samples(pattern):
+    """Строит короткие строки, на которых шаблон гарантированно срабатывает.
+
+    Используются для статической проверки пересечений правил и как
+    синтетическая часть корпуса при проверке эквивалентности.
+    """
+    samples = []
+    for minimal in (True, False):
+        out = []
+        try:
+            _sample_items(sre_parse.parse(pattern.pattern, pattern.flags), out, minimal)
+        except Exception:
+            continue
+        sample = "".join(out)
+        for candidate in (sample, f" {sample} "):
+            if candidate not in samples and pattern.search(candidate):
+                samples.append(candidate)
+    return samples
+
+
+class _RuleMatch:
+    """Представление совпадения объединённого шаблона как совпадения одного правила.
+
+    Номера групп сдвигаются на позицию внешней группы правила, поэтому
+    выражения замены вида m.group(1) работают без изменений.
+    """
+    __slots__ = ("_match", "_offset", "_count")
+
+    def __init__(self, match, offset, count):
+        self._match = match
+        self._offset = offset
+        self._count = count
+
+    def _index(self, group):
+        if group == 0:
+            return self._offset
+        if isinstance(group, int) and 0 < group <= self._count:
+            return self._offset + group
+        raise IndexError("no such group")
+
+    def group(self, *groups):
+        if not groups:
+            return self._match.group(self._offset)
+        if len(groups) == 1:
+            return self._match.group(self._index(groups[0]))
+        return tuple(self._match.group(self._index(g)) for g in groups)
+
+    def __getitem__(self, group):
+        return self.group(group)
+
+    def groups(self, default=None):
+        return tuple(self._match.group(i) if self._match.group(i) is not None else default
+                     for i in range(self._offset + 1, self._offset + self._count + 1))
+
+    def start(self, group=0):
+        return self._match.start(self._index(group))
+
+    def end(self, group=0):
+        return self._match.end(self._index(group))
+
+    def span(self, group=0):
+        return self._match.span(self._index(group))
+
+    @property
+    def string(self):
+        return self._match.string
+
+
+class MergedScanner:
+    """Все правила набора, слитые в один шаблон с диспетчеризацией по правилу."""
+
+    def __init__(self, rules):
+        parts = []
+        self._dispatch_table = {}
+        group = 1
+        for rule in rules:
+            flags = "".join(ch for flag, ch in _SCOPED_FLAGS.items() if rule.pattern.flags & flag)
+            body = f"(?{flags}:{rule.pattern.pattern})" if flags else rule.pattern.pattern
+            parts.append(f"({body})")
+            replacement = rule.replacement
+            if isinstance(replacement, str) and "\\" in replacement:
+                replacement = template_function(replacement)
+            self._dispatch_table[group] = (replacement, group, rule.pattern.groups)
+            group += rule.pattern.groups + 1
+        self.pattern = re.compile("|".join(parts))
+
+    def _dispatch(self, match):
+        replacement, offset, count = self._dispatch_table[match.lastindex]
+        if callable(replacement):
+            return replacement(_RuleMatch(match, offset, count))
+        return replacement
+
+    def sub(self, text):
+        return self.pattern.sub(self._dispatch, text)
+
+
+def build_merged_scanner(rules):
+    """Пытается объединить правила в один проход.
+
+    :return: (MergedScanner или None, причина отказа или None).
+    """
+    if len(rules) < 2:
+        return None, "меньше двух правил"
+    allowed = re.UNICODE
+    for flag in _SCOPED_FLAGS:
+        allowed |= flag
+    samples = {}
+    for rule in rules:
+        pattern = rule.pattern
+        if not isinstance(pattern.pattern, str):
+            return None, f"'{rule.name}': bytes-шаблон"
+        if pattern.flags & ~allowed:
+            return None, f"'{rule.name}': флаги нельзя задать локально"
+        if pattern.groupindex:
+            return None, f"'{rule.name}': именованные группы"
+        if re.search(r"\\(\d|g<)", pattern.pattern):
+            return None, f"'{rule.name}': обратные ссылки"
+        if isinstance(rule.replacement, str) and "\\" in rule.replacement:
+            try:
+                template_function(rule.replacement)
+            except ValueError:
+                return None, f"'{rule.name}': неподдерживаемый шаблон замены"
+        samples[rule.name] = rule_samples(pattern)
+        if not samples[rule.name]:
+            return None, f"'{rule.name}': не удалось построить пример совпадения"
+    # Один проход безопасен, только если правила не пересекаются: ни исходный
+    # текст, ни результат одного правила не должны попадать под другое.
+    for rule in rules:
+        for sample in samples[rule.name]:
+            for text in (sample, rule.apply(sample)):
+                for other in rules:
+                    if other is not rule and other.pattern.search(text):
+                        return None, f"правила '{rule.name}' и '{other.name}' пересекаются"
+    try:
+        scanner = MergedScanner(rules)
+    except re.error as e:
+        return None, f"ошибка объединения шаблонов: {e}"
+    # Соседство совпадений разных правил: жадные шаблоны вроде ^(\d)(.*)
+    # в одном проходе "съедают" совпадения остальных правил.
+    for rule in rules:
+        for other in rules:
+            for left in samples[rule.name]:
+                for right in samples[other.name]:
+                    for text in (left + right, f"{left} {right}"):
+                        expected = text
+                        for r in rules:
+                            expected = r.apply(expected)
+                        if scanner.sub(text) != expected:
+                            return None, f"правила '{rule.name}' и '{other.name}' пересекаются"
+    return scanner, None
+
+
+def check_merge_equivalence(rule_set, corpus, max_mismatches=20):
+    """Сравнивает последовательный и объединённый режимы на корпусе строк.
+
+    К корпусу добавляются синтетические примеры, построенные по самим правилам.
+
+    :param rule_set: RuleSet для проверки.
+    :param corpus: Итерируемый набор строк.
+    :return: (ok, checked, mismatches, reason); mismatches - [(text, sequential, merged)].
+    """
+    scanner, reason = build_merged_scanner(rule_set.rules)
+    if scanner is None:
+        return False, 0, [], reason
+    synthetic = [sample for rule in rule_set.rules for sample in rule_samples(rule.pattern)]
+    checked, mismatches = 0, []
+    seen = set()
+    for text in list(synthetic) + [t for t in corpus]:
+        if not text or text in seen:
+            continue
+        seen.add(text)
+        checked += 1
+        sequential = rule_set.apply_sequential(text)
+        merged = scanner.sub(text)
+        if sequential != merged:
+            mismatches.append((text, sequential, merged))
+            if len(mismatches) >= max_mismatches:
+                break
+    return not mismatches, checked, mismatches, None
+
+
+class ReplacementCache:
+    """Ограниченный по размеру LRU-кеш результатов замены: (набор правил, текст) -> текст.
+
+    Штампы, колонтитулы, атрибуты блоков DWG повторяют одни и те же строки
+    тысячи раз за передачу документов; повторный расчёт правил для них не нужен.
+    """
+
+    def __init__(self, maxsize=65536, max_text_len=4096):
+        self.maxsize = maxsize
+        self.max_text_len = max_text_len
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, text):
+        """Возвращает закешированный результат или None."""
+        if len(text) > self.max_text_len:
+            return None
+        with self._lock:
+            result = self._data.get((key, text))
+            if result is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end((key, text))
+            self.hits += 1
+            return result
+
+    def put(self, key, text, result):
+        if len(text) > self.max_text_len or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[(key, text)] = result
+            self._data.move_to_end((key, text))
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Очищает кеш и счётчики (вызывается в начале запуска)."""
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+
+replacement_cache = ReplacementCache()
+
+
+class RuleProfiler:
+    """Статистика срабатывания правил за запуск обработки.
+
+    Пока профилировщик включён, RuleSet.apply применяет правила по одному,
+    без кеша и объединённого режима, и для каждого правила считает:
+    calls - сколько раз regex выполнялся, skipped - сколько раз правило
+    отброшено префильтром, matches - число замен, chars - просмотрено символов,
+    time - суммарное время (с). Статистика ведётся по файлам и парсерам.
+    """
+    FIELDS = ("calls", "skipped", "matches", "chars", "time")
+
+    def __init__(self):
+        self.enabled = False
+        self.current_file = None
+        self._stats = {}   # (file, parser, rule) -> [calls, skipped, matches, chars, time]
+        self._rules = {}   # parser -> имена правил (в порядке config.json)
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Сбрасывает статистику и включает профилирование."""
+        with self._lock:
+            self._stats.clear()
+            self._rules.clear()
+            self.current_file = None
+            self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+        self.current_file = None
+
+    def apply(self, rule_set, text):
+        """Аналог RuleSet.apply_sequential с замерами по каждому правилу."""
+        parser = rule_set.parser or "-"
+        rows = []
+        folded = text.casefold() if rule_set._needs_fold else None
+        for rule in rule_set.rules:
+            started = time.perf_counter()
+            if not rule.may_match(text, folded):
+                rows.append((rule.name, 0, 1, 0, 0, time.perf_counter() - started))
+                continue
+            scanned = len(text)
+            text, count = rule.pattern.subn(rule.replacement, text)
+            if count:
+                folded = text.casefold() if rule_set._needs_fold else None
+            rows.append((rule.name, 1, 0, count, scanned, time.perf_counter() - started))
+        self._record(parser, rule_set, rows)
+        return text
+
+    def find_matches(self, rule_set, text):
+        """Аналог RuleSet.find_matches с замерами по каждому правилу."""
+        rows, found = [], []
+        folded = text.casefold() if rule_set._needs_fold else None
+        for rule in rule_set.rules:
+            started = time.perf_counter()
+            if not rule.may_match(text, folded):
+                rows.append((rule.name, 0, 1, 0, 0, time.perf_counter() - started))
+                continue
+            matches = rule_set._rule_matches(rule, text)
+            found.append(matches)
+            rows.append((rule.name, 1, 0, len(matches), len(text), time.perf_counter() - started))
+        self._record(rule_set.parser or "-", rule_set, rows)
+        return rule_set._select_matches(found)
+
+    def _record(self, parser, rule_set, rows):
+        with self._lock:
+            if parser not in self._rules:
+                self._rules[parser] = [rule.name for rule in rule_set.rules]
+            for name, *values in rows:
+                stat = self._stats.setdefault((self.current_file, parser, name), [0, 0, 0, 0, 0.0])
+                for i, value in enumerate(values):
+                    stat[i] += value
+
+    def export(self):
+        """Статистика в виде, пригодном для передачи из рабочего процесса (см. merge)."""
+        with self._lock:
+            return {"rules": dict(self._rules), "stats": [(key, list(stat)) for key, stat in self._stats.items()]}
+
+    def merge(self, data):
+        """Добавляет статистику, собранную export() в другом процессе."""
+        with self._lock:
+            for parser, names in data["rules"].items():
+                self._rules.setdefault(parser, names)
+            for key, values in data["stats"]:
+                stat = self._stats.setdefault(tuple(key), [0, 0, 0, 0, 0.0])
+                for i, value in enumerate(values):
+                    stat[i] += value
+
+    def report(self):
+        """Отчёт в виде словаря: итоги по парсерам и правилам и разбивка по файлам.
+
+        В итоги попадают все правила использованных наборов, в том числе
+        ни разу не сработавшие (matches == 0).
+        """
+        with self._lock:
+            totals = {parser: {name: dict.fromkeys(self.FIELDS, 0) for name in names}
+                      for parser, names in self._rules.items()}
+            files = {}
+            for (file, parser, name), stat in self._stats.items():
+                row = dict(zip(self.FIELDS, stat))
+                files.setdefault(file or "-", {}).setdefault(parser, {})[name] = row
+                total = totals.setdefault(parser, {}).setdefault(name, dict.fromkeys(self.FIELDS, 0))
+                for field in self.FIELDS:
+                    total[field] += row[field]
+        return {"totals": totals, "files": files}
+
+    def write_report(self, base_path, extra=None):
+        """Записывает отчёт в base_path + '.json' и base_path + '.csv'.
+
+        :return: (путь к JSON, путь к CSV).
+        """
+        report = self.report()
+        if extra:
+            report = {**extra, **report}
+        json_path, csv_path = base_path + ".json", base_path + ".csv"
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        # utf-8-sig и ";" - чтобы файл корректно открывался в Excel
+        with open(csv_path, "w", encoding="utf-8-sig", newline="") as f:
+            writer = csv.writer(f, delimiter=";")
+            writer.writerow(("file", "parser", "rule") + self.FIELDS)
+            for parser, rules in report["totals"].items():
+                for name, row in rules.items():
+                    writer.writerow(("*", parser, name) + tuple(row[field] for field in self.FIELDS))
+            for file, parsers in report["files"].items():
+                for parser, rules in parsers.items():
+                    for name, row in rules.items():
+                        writer.writerow((file, parser, name) + tuple(row[field] for field in self.FIELDS))
+        return json_path, csv_path
+
+
+rule_profiler = RuleProfiler()
+
+
+class RuleSet:
+    """Скомпилированный набор правил одного парсера для конкретной цифры замены.
+
+    Объект неизменяемый и общий для всех процессоров в рамках запуска.
+    Если набор прошёл проверку эквивалентности (см. check_merge_equivalence),
+    правила применяются одним объединённым проходом (engine == 'merged').
+    """
+
+    def __init__(self, key, rules, project=None, parser=None, replacement_digit=None):
+        self.key = key
+        self.rules = rules
+        self.project = project
+        self.parser = parser
+        self.replacement_digit = replacement_digit
+        self.has_scopes = any(rule.scope is not None for rule in rules)
+        self._part_rules = {}    # имя части -> номера правил, действующих в ней
+        self._scoped = {}        # (номера правил части, элемент) -> RuleSet
+        anchors = [rule.anchor for rule in rules]
+        # Общий "шлюз": одно сканирование строки по обязательным элементам всех
+        # правил. Строится только если у каждого правила есть такой элемент.
+        self._gate = re.compile("|".join(anchors)) if anchors and None not in anchors else None
+        self._needs_fold = any(rule.ignorecase and rule.literal is not None for rule in rules)
+        self.joinable = all(rule.joinable for rule in rules)
+        self.merged = None
+
+    @property
+    def engine(self):
+        return "merged" if self.merged is not None else "sequential"
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    @property
+    def patterns(self):
+        """Список (pattern, replacement) в формате, который использовали процессоры."""
+        return [(rule.pattern, rule.replacement) for rule in self.rules]
+
+    def _rules_for_part(self, part):
+        indices = self._part_rules.get(part)
+        if indices is None:
+            indices = tuple(
+                i for i, rule in enumerate(self.rules)
+                if part is None or rule.scope is None or rule.scope[0] is None
+                or any(fnmatch.fnmatchcase(part, glob) for glob in rule.scope[0]))
+            self._part_rules[part] = indices
+        return indices
+
+    def scoped(self, part, element):
+        """Поднабор правил, действующих в элементе element части part.
+
+        part=None - формат без частей (.xls, .doc): учитываются только elements.
+        Поднаборы кешируются, так что для каждого узла это один поиск в словаре.
+        """
+        if not self.has_scopes:
+            return self
+        key = (self._rules_for_part(part), element)
+        rule_set = self._scoped.get(key)
+        if rule_set is None:
+            indices = tuple(i for i in key[0]
+                            if self.rules[i].scope is None or self.rules[i].scope[1] is None
+                            or element in self.rules[i].scope[1])
+            if len(indices) == len(self.rules):
+                rule_set = self
+            else:
+                rules = [self.rules[i] for i in indices]
+                # проверка эквивалентности объединённого режима была для полного набора,
+                # поэтому поднаборы применяются последовательно
+                rule_set = RuleSet((self.key, indices), rules, project=self.project, parser=self.parser,
+                                   replacement_digit=self.replacement_digit)
+            self._scoped[key] = rule_set
+        return rule_set
+
+    def apply_scoped(self, part, elements, texts):
+        """apply_batch с учётом scope: elements[i] - имя элемента строки texts[i]."""
+        if not self.has_scopes:
+            return self.apply_batch(texts)
+        groups = {}
+        for index, element in enumerate(elements):
+            groups.setdefault(element, []).append(index)
+        results = list(texts)
+        for element, indices in groups.items():
+            rule_set = self.scoped(part, element)
+            if not rule_set:
+                continue
+            for index, result in zip(indices, rule_set.apply_batch([texts[i] for i in indices])):
+                results[index] = result
+        return results
+
+    def could_match(self, text):
+        """True, если хотя бы одно правило может сработать на text (по префильтру)."""
+        if not text:
+            return False
+        if self._gate is not None:
+            return self._gate.search(text) is not None
+        folded = text.casefold() if self._needs_fold else None
+        return any(rule.may_match(text, folded) for rule in self.rules)
+
+    def apply(self, text):
+        """Применяет правила к строке, пропуская те, что не могут сработать."""
+        if not text:
+            return text
+        if rule_profiler.enabled:
+            return rule_profiler.apply(self, text)
+        if self._gate is not None and self._gate.search(text) is None:
+            return text
+        result = replacement_cache.get(self.key, text)
+        if result is not None:
+            return result
+        if self.merged is not None:
+            result = self.merged.sub(text)
+        else:
+            result = self.apply_sequential(text)
+        replacement_cache.put(self.key, text, result)
+        return result
+
+    def find_matches(self, text):
+        """Совпадения правил в исходном тексте без замены (для форматов, где текст
+        нельзя просто переписать, например PDF).
+
+        Каждое правило ищется в исходном text; пересекающиеся совпадения
+        отбрасываются (выигрывает правило, стоящее раньше). Результат хранится
+        в общем кеше замен, при включённом профилировщике учитывается по правилам.
+        :return: [(start, end, старый текст, новый текст, имя правила)] по возрастанию start.
+        """
+        if not self.could_match(text):
+            return []
+        if rule_profiler.enabled:
+            return rule_profiler.find_matches(self, text)
+        key = ("matches", self.key)
+        cached = replacement_cache.get(key, text)
+        if cached is not None:
+            return list(cached)
+        folded = text.casefold() if self._needs_fold else None
+        result = self._select_matches(
+            [self._rule_matches(rule, text) for rule in self.rules if rule.may_match(text, folded)])
+        replacement_cache.put(key, text, tuple(result))
+        return result
+
+    @staticmethod
+    def _rule_matches(rule, text):
+        """Непустые совпадения одного правила, которые меняют текст."""
+        found = []
+        for match in rule.pattern.finditer(text):
+            start, end = match.span()
+            if start == end:
+                continue
+            replacement = rule.replacement
+            new_text = replacement(match) if callable(replacement) else match.expand(replacement)
+            if new_text != match.group(0):
+                found.append((start, end, match.group(0), new_text, rule.name))
+        return found
+
+    @staticmethod
+    def _select_matches(found):
+        """Объединяет совпадения правил (в порядке правил), отбрасывая пересекающиеся."""
+        matches, starts = [], []
+        for rule_found in found:
+            for match in rule_found:
+                start, end = match[0], match[1]
+                pos = bisect_left(starts, start)
+                if (pos > 0 and matches[pos - 1][1] > start) or (pos < len(matches) and matches[pos][0] < end):
+                    continue
+                starts.insert(pos, start)
+                matches.insert(pos, match)
+        return matches
+
+    def apply_batch(self, texts):
+        """Применяет правила к списку строк, возвращает список результатов той же длины.
+
+        Повторяющиеся строки обрабатываются один раз. Если все правила допускают
+        склейку (joinable), строки без результата в кеше склеиваются через
+        BATCH_SEPARATOR и обрабатываются одним вызовом re на всю часть документа;
+        иначе - по одной через apply.
+        """
+        results = {}
+        pending = []
+        for text in dict.fromkeys(texts):
+            if not text or (self._gate is not None and self._gate.search(text) is None):
+                results[text] = text
+                continue
+            cached = None if rule_profiler.enabled else replacement_cache.get(self.key, text)
+            if cached is not None:
+                results[text] = cached
+            else:
+                pending.append(text)
+        if pending:
+            joined_results = None
+            if (self.joinable and not rule_profiler.enabled and len(pending) > 1
+                    and not any(BATCH_SEPARATOR in text for text in pending)):
+                buffer = BATCH_SEPARATOR.join(pending)
+                buffer = self.merged.sub(buffer) if self.merged is not None else self.apply_sequential(buffer)
+                joined_results = buffer.split(BATCH_SEPARATOR)
+                # Функция замены могла вставить разделитель - тогда считаем по одной
+                if len(joined_results) != len(pending):
+                    joined_results = None
+            if joined_results is None:
+                for text in pending:
+                    results[text] = self.apply(text)
+            else:
+                for text, result in zip(pending, joined_results):
+                    results[text] = result
+                    replacement_cache.put(self.key, text, result)
+        return [results[text] for text in texts]
+
+    def apply_sequential(self, text):
+        """Последовательно применяет правила по одному.
+
+        Префильтр проверяется на текущем тексте, поэтому цепочки правил
+        (результат одного правила попадает под другое) работают как раньше.
+        """
+        if not text:
+            return text
+        folded = text.casefold() if self._needs_fold else None
+        for rule in self.rules:
+            if not rule.may_match(text, folded):
+                continue
+            new_text = rule.pattern.sub(rule.replacement, text)
+            if new_text != text:
+                text = new_text
+                folded = text.casefold() if self._needs_fold else None
+        return text
+
+    def apply_isolated(self, text, logger=None, context=""):
+        """Как apply_sequential, но ошибка одного правила не отменяет остальные.
+
+        Упавшее правило пропускается с предупреждением (имя правила и context),
+        текст остаётся результатом предыдущих правил. Используется для имён файлов.
+        """
+        logger = logger or logging.getLogger(__name__)
+        for rule in self.rules:
+            try:
+                text = rule.apply(text)
+            except Exception as e:
+                logger.log(logging.WARNING, f"Ошибка правила '{rule.name}' для {context or text}: {e}")
+        return text
+
+
+class RuleCompiler:
+    """Кеш скомпилированных наборов правил с сохранением снимка на диск.
+
+    Исходники правил (regex + код замены) компилируются один раз. В снимок
+    попадают уже разобранные regex (строка + флаги) и байткод выражений замены,
+    поэтому при загрузке снимка eval исходных строк не выполняется.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self._sources = {}      # rules_hash -> [(name, pattern, flags, code, scope, error)]
+        self._rule_sets = {}    # (rules_hash, digit) -> RuleSet
+        self._snapshot_path = None
+        self._dirty = False
+        self._lock = threading.RLock()
+        self.merge_verified = set()  # rules_hash наборов, прошедших проверку эквивалентности
+
+    def _snapshot_file(self, cfg_hash):
+        tag = sys.implementation.cache_tag or "python"
+        return os.path.join(self.cache_dir, f"rules-{cfg_hash}.{tag}.bin")
+
+    def load_snapshot(self, config_data, logger=None):
+        """Подключает снимок для данной конфигурации, если он есть на диске.
+
+        Заодно считывает из конфигурации отметки "merged_engine" проектов:
+        {parser: rules_hash} наборов, для которых разрешён объединённый режим.
+        """
+        logger = logger or logging.getLogger(__name__)
+        path = self._snapshot_file(config_hash(config_data))
+        with self._lock:
+            for project_config in config_data.values():
+                if isinstance(project_config, dict):
+                    self.merge_verified.update((project_config.get("merged_engine") or {}).values())
+            if path == self._snapshot_path:
+                return False
+            self._snapshot_path = path
+            self._dirty = False
+            if not os.path.exists(path):
+                return False
+            try:
+                with open(path, "rb") as f:
+                    snapshot = marshal.load(f)
+                if snapshot.get("version") != SNAPSHOT_VERSION:
+                    return False
+                self._sources.update(snapshot["sets"])
+                logger.log(logging.DEBUG, f"Загружен снимок правил: {path}")
+                return True
+            except Exception as e:
+                logger.log(logging.DEBUG, f"Не удалось прочитать снимок правил {path}: {e}")
+                return False
+
+    def save_snapshot(self, logger=None):
+        """Записывает снимок, если с момента загрузки были скомпилированы новые наборы."""
+        logger = logger or logging.getLogger(__name__)
+        with self._lock:
+            if not self._snapshot_path or not self._dirty:
+                return False
+            path = self._snapshot_path
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    marshal.dump({"version": SNAPSHOT_VERSION, "sets": self._sources}, f)
+                os.replace(tmp_path, path)
+                self._dirty = False
+                logger.log(logging.DEBUG, f"Снимок правил сохранён: {path}")
+                return True
+            except Exception as e:
+                logger.log(logging.DEBUG, f"Не удалось сохранить снимок правил {path}: {e}")
+                return False
+
+    def _compile_sources(self, rules, logger):
+        """Разбирает исходники правил: [(имя, regex, флаги, замена, scope, ошибка)].
+
+        Декларативные правила ("regex"/"flags"/"template") проверяются без eval,
+        шаблон хранится строкой. Для старых правил выполняется eval regex
+        и compile выражения замены.
+        """
+        sources = []
+        try:
+            for rule_name, rule in rules.items():
+                try:
+                    if "regex" in rule:
+                        pattern = re.compile(rule["regex"], parse_flags(rule.get("flags")))
+                        template = rule.get("template", "")
+                        pattern.sub(render_template(template, "0"), "")  # проверка ссылок на группы
+                        sources.append((rule_name, pattern.pattern, pattern.flags, template,
+                                        parse_scope(rule.get("scope")), None))
+                        continue
+                    pattern = eval(rule["pattern"], {"re": re})
+                    code = compile(rule["replacement"], f"<rule {rule_name}>", "eval")
+                    sources.append((rule_name, pattern.pattern, pattern.flags, code,
+                                    parse_scope(rule.get("scope")), None))
+                except Exception as e:
+                    sources.append((rule_name, None, 0, None, None, str(e)))
+        except Exception as e:
+            logger.log(logging.ERROR, f"Ошибка обработки rules: {e}")
+        return sources
+
+    def get(self, rules, replacement_digit, project=None, parser=None, logger=None):
+        """Возвращает общий RuleSet для набора правил и цифры замены.
+
+        :param rules: Словарь {rule_name: {'pattern': str, 'replacement': str}}.
+        :param replacement_digit: Цифра (значение) для подстановки в замены.
+        :param project: Название проекта (для логов и отчётов).
+        :param parser: Имя секции config.json ('word_parser', 'file_rename', ...).
+        :param logger: Логгер для сообщений о загрузке правил.
+        :return: RuleSet.
+        """
+        logger = logger or logging.getLogger(__name__)
+        replacement_digit = str(replacement_digit)
+        r_hash = rules_hash(rules)
+        key = (r_hash, replacement_digit)
+        with self._lock:
+            rule_set = self._rule_sets.get(key)
+            if rule_set is not None:
+                return rule_set
+
+            sources = self._sources.get(r_hash)
+            if sources is None:
+                sources = self._compile_sources(rules or {}, logger)
+                self._sources[r_hash] = sources
+                self._dirty = True
+
+            # Выражения замены ссылаются на self.replacement_digit (парсеры)
+            # или на replacement_digit (file_rename) - поддерживаем оба варианта.
+            env = {
+                "re": re,
+                "self": SimpleNamespace(replacement_digit=replacement_digit),
+                "replacement_digit": replacement_digit,
+            }
+            compiled = []
+            for rule_name, pattern, flags, code, scope, error in sources:
+                if error is not None:
+                    logger.log(logging.ERROR, f"Ошибка загрузки правила '{rule_name}': {error}")
+                    continue
+                try:
+                    if isinstance(code, str):
+                        replacement = render_template(code, replacement_digit)
+                    else:
+                        replacement = eval(code, env)
+                    compiled.append(CompiledRule(rule_name, re.compile(pattern, flags), replacement, scope))
+                    logger.log(logging.DEBUG, f"Загружено правило '{rule_name}'")
+                except Exception as e:
+                    logger.log(logging.ERROR, f"Ошибка загрузки правила '{rule_name}': {e}")
+            if not compiled:
+                logger.log(logging.DEBUG, "Предупреждение: Нет patterns для этого парсера")
+
+            rule_set = RuleSet(key, compiled, project=project, parser=parser,
+                               replacement_digit=replacement_digit)
+            if r_hash in self.merge_verified:
+                scanner, reason = build_merged_scanner(compiled)
+                if scanner is not None:
+                    rule_set.merged = scanner
+                    logger.log(logging.DEBUG, f"Правила {parser or ''} применяются в один проход")
+                else:
+                    logger.log(logging.DEBUG, f"Объединённый режим недоступен для {parser or ''}: {reason}")
+            self._rule_sets[key] = rule_set
+            return rule_set
+
+    def clear(self):
+        """Сбрасывает кеш в памяти (снимок на диске не удаляется)."""
+        with self._lock:
+            self._sources.clear()
+            self._rule_sets.clear()
+            self.merge_verified.clear()
+            self._snapshot_path = None
+            self._dirty = False
+
+
+rule_compiler = RuleCompiler()
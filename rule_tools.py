@@ -0,0 +1,562 @@
+# rule_tools.py
+"""Модуль rule_tools.py: Служебные команды для правил config.json.
+
+Запуск из командной строки:
+    python rule_tools.py check-merge --project "АЭС Эль-Дабаа Блоки 1 и 2" --parser word_parser
+                                     --corpus D:\\samples [--enable]
+
+check-merge - сравнивает последовательное и объединённое (в один проход) применение
+правил на корпусе строк. Корпус - текстовые файлы (каждая строка - отдельный образец)
+и/или пакеты Office (.docx, .xlsx, ...), из XML-частей которых берутся все текстовые узлы.
+С флагом --enable при успешной проверке в config.json проекта записывается отметка
+"merged_engine": {parser: hash правил}; изменение правил автоматически снимает отметку.
+
+    python rule_tools.py convert [--output config.declarative.json | --in-place]
+
+convert - переводит правила всех проектов из eval-формата ("pattern"/"replacement")
+в декларативный ("regex"/"flags"/"template"). Правило переводится, только если
+замена сводится к шаблону re.sub и результат совпадает со старым правилом на примерах;
+остальные правила остаются в прежнем виде.
+
+    python rule_tools.py lint [--project ...] [--parser ...] [--sample D:\\samples]
+                              [--budget-ms 2.0] [--report lint.json]
+
+lint - загружает правила проектов тем же загрузчиком, что и обработка, и замеряет
+время каждого правила на синтетических "худших" строках (повторы почти-совпадений
+и однородные последовательности) и на образце пользователя. Отмечает правила
+со сверхлинейным ростом времени и правила, ни разу не сработавшие на образце.
+Завершается с кодом 1, если правило не загружается или тратит больше
+--budget-ms миллисекунд на килобайт текста. Запускать после правки config.json.
+"""
+import os
+import re
+import ast
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+from zipfile import ZipFile, BadZipFile
+from lxml import etree as ET
+from rule_engine import (RuleCompiler, check_merge_equivalence, rules_hash, rule_samples,
+                         sre_parse)
+
+PARSER_SECTIONS = ('file_rename', 'excel_parser', 'word_parser', 'dwg_parser', 'sha_parser', 'pdf_parser')
+FLAG_NAMES = ('IGNORECASE', 'MULTILINE', 'DOTALL', 'VERBOSE', 'ASCII')
+
+TEXT_EXTENSIONS = ('.txt', '.csv', '.log')
+PACKAGE_EXTENSIONS = ('.docx', '.docm', '.dotx', '.xlsx', '.xlsm', '.xltx')
+
+
+def load_config(config_path):
+    with open(config_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_config(config_path, config_data, template_path=None):
+    """Записывает конфигурацию, сохраняя оформление исходного файла (template_path, по умолчанию config_path).
+
+    Меняется только текст изменённых записей (см. update_json_text), поэтому
+    diff config.json после convert или check-merge --enable содержит только их.
+    """
+    template_path = template_path or config_path
+    text = None
+    if os.path.exists(template_path):
+        with open(template_path, 'r', encoding='utf-8') as f:
+            try:
+                text = update_json_text(f.read(), config_data)
+            except ValueError:
+                text = None
+    if text is None:
+        text = json.dumps(config_data, ensure_ascii=False, indent=2)
+    with open(config_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _skip_ws(text, pos):
+    return _JSON_WHITESPACE.match(text, pos).end()
+
+
+def _scan_json(text, pos):
+    """Разбирает значение JSON с позиции pos: (начало, конец, члены объекта или None).
+
+    Члены объекта - [(ключ, начало ключа, конец ключа, узел значения)].
+    """
+    if text.startswith('{', pos):
+        members = []
+        i = _skip_ws(text, pos + 1)
+        if text.startswith('}', i):
+            return pos, i + 1, members
+        while True:
+            if not text.startswith('"', i):
+                raise ValueError(f"Ожидался ключ в позиции {i}")
+            key, key_end = json.decoder.scanstring(text, i + 1)
+            colon = _skip_ws(text, key_end)
+            if not text.startswith(':', colon):
+                raise ValueError(f"Ожидалось ':' в позиции {colon}")
+            node = _scan_json(text, _skip_ws(text, colon + 1))
+            members.append((key, i, key_end, node))
+            i = _skip_ws(text, node[1])
+            if text.startswith(',', i):
+                i = _skip_ws(text, i + 1)
+            elif text.startswith('}', i):
+                return pos, i + 1, members
+            else:
+                raise ValueError(f"Ожидалось ',' или '}}' в позиции {i}")
+    _, end = _JSON_DECODER.raw_decode(text, pos)
+    return pos, end, None
+
+
+def _render_json(text, node, old, new):
+    start, end, members = node
+    if type(old) is type(new) and old == new:
+        return text[start:end]
+    if not members or not isinstance(new, dict) or not isinstance(old, dict):
+        return json.dumps(new, ensure_ascii=False)
+    last = {key: index for index, (key, *_) in enumerate(members)}   # при повторах ключа действует последний
+    members = [member for index, member in enumerate(members) if last[member[0]] == index]
+    separators = [text[start + 1:members[0][1]]] + [text[prev[3][1]:member[1]] for prev, member in
+                                                     zip(members, members[1:])]
+    generic = separators[1] if len(separators) > 1 else ',' + separators[0]
+    colon = text[members[0][2]:members[0][3][0]]
+    pieces, seen = [], set()
+    for index, (key, key_start, key_end, value) in enumerate(members):
+        if key not in new:
+            continue
+        seen.add(key)
+        separator = separators[0] if not pieces else separators[index] if index else generic
+        pieces.append(separator + text[key_start:key_end] + text[key_end:value[0]]
+                      + _render_json(text, value, old[key], new[key]))
+    for key, value in new.items():
+        if key not in seen:
+            separator = separators[0] if not pieces else generic
+            pieces.append(separator + json.dumps(key, ensure_ascii=False) + colon + json.dumps(value, ensure_ascii=False))
+    if not pieces:
+        return '{}'
+    return '{' + ''.join(pieces) + text[members[-1][3][1]:end - 1] + '}'
+
+
+def update_json_text(text, data):
+    """Текст JSON с данными data, в котором неизменённые записи text сохранены байт в байт.
+
+    Объекты обходятся рекурсивно: у изменённых членов заменяется только
+    значение, удалённые члены вырезаются вместе с разделителем, новые
+    добавляются в конец объекта с отступом соседних. Прочие изменённые
+    значения записываются json.dumps в одну строку.
+    """
+    node = _scan_json(text, _skip_ws(text, 0))
+    if text[_skip_ws(text, node[1]):]:
+        raise ValueError("Лишние данные после JSON")
+    return text[:node[0]] + _render_json(text, node, json.loads(text), data) + text[node[1]:]
+
+
+def _package_texts(path):
+    """Текстовые узлы всех XML-частей пакета Office."""
+    with ZipFile(path) as zip_in:
+        for name in zip_in.namelist():
+            if not name.endswith('.xml'):
+                continue
+            try:
+                root = ET.fromstring(zip_in.read(name))
+            except ET.XMLSyntaxError:
+                continue
+            for elem in root.iter():
+                if elem.text:
+                    yield elem.text
+                if elem.tail:
+                    yield elem.tail
+
+
+def iter_corpus(paths, logger=None):
+    """Перебирает строки корпуса из файлов и папок."""
+    logger = logger or logging.getLogger(__name__)
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        else:
+            files.append(path)
+    for path in files:
+        ext = os.path.splitext(path)[1].lower()
+        try:
+            if ext in TEXT_EXTENSIONS:
+                with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                    for line in f:
+                        yield line.rstrip('\n')
+            elif ext in PACKAGE_EXTENSIONS:
+                yield from _package_texts(path)
+        except (OSError, BadZipFile) as e:
+            logger.log(logging.WARNING, f"Пропуск {path}: {e}")
+
+
+def project_digits(project_config):
+    digits = [value for _, value in project_config.get('digits', [])]
+    return digits or ['0']
+
+
+def cmd_check_merge(args, logger):
+    config_data = load_config(args.config)
+    project_config = config_data.get(args.project)
+    if project_config is None:
+        logger.log(logging.ERROR, f"Проект не найден: {args.project}")
+        return 2
+    rules = project_config.get(args.parser, {})
+    corpus = list(iter_corpus(args.corpus, logger))
+    compiler = RuleCompiler()
+
+    passed = True
+    for digit in project_digits(project_config):
+        rule_set = compiler.get(rules, digit, project=args.project, parser=args.parser, logger=logger)
+        ok, checked, mismatches, reason = check_merge_equivalence(rule_set, corpus)
+        if reason:
+            logger.log(logging.INFO, f"[{digit}] Объединённый режим невозможен: {reason}")
+            passed = False
+            break
+        logger.log(logging.INFO, f"[{digit}] Проверено строк: {checked}, расхождений: {len(mismatches)}")
+        for text, sequential, merged in mismatches:
+            logger.log(logging.INFO, f"    '{text}': последовательно '{sequential}', один проход '{merged}'")
+        passed = passed and ok
+
+    if args.enable:
+        marks = project_config.setdefault('merged_engine', {})
+        if passed:
+            marks[args.parser] = rules_hash(rules)
+            logger.log(logging.INFO, f"Объединённый режим включён для {args.project} / {args.parser}")
+        elif marks.pop(args.parser, None) is not None:
+            logger.log(logging.INFO, f"Объединённый режим отключён для {args.project} / {args.parser}")
+        if not marks:
+            project_config.pop('merged_engine', None)
+        save_config(args.config, config_data)
+    return 0 if passed else 1
+
+
+def _optional_groups(items, optional=False, found=None):
+    """Номера групп, которые могут не участвовать в совпадении."""
+    found = set() if found is None else found
+    for op, av in items:
+        name = str(op)
+        if name == 'SUBPATTERN':
+            if optional and av[0]:
+                found.add(av[0])
+            _optional_groups(av[3], optional, found)
+        elif name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT'):
+            _optional_groups(av[2], optional or av[0] == 0, found)
+        elif name == 'BRANCH':
+            for branch in av[1]:
+                _optional_groups(branch, True, found)
+        elif name in ('ATOMIC_GROUP',):
+            _optional_groups(av, optional, found)
+        elif name in ('ASSERT', 'ASSERT_NOT'):
+            _optional_groups(av[1], True, found)
+    return found
+
+
+def _template_part(node, optional_groups):
+    """Переводит элемент выражения замены в кусок шаблона re.sub."""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value.replace('\\', '\\\\')
+    if isinstance(node, ast.Name) and node.id == 'replacement_digit':
+        return '{digit}'
+    if (isinstance(node, ast.Attribute) and node.attr == 'replacement_digit'
+            and isinstance(node.value, ast.Name) and node.value.id == 'self'):
+        return '{digit}'
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'group'
+            and isinstance(node.func.value, ast.Name) and node.func.value.id == 'm'
+            and len(node.args) == 1 and not node.keywords
+            and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, int)):
+        group = node.args[0].value
+        if group in optional_groups:
+            # f'{m.group(N)}' для неучаствующей группы даёт 'None', шаблон - пустую строку
+            raise ValueError(f"группа {group} может не участвовать в совпадении")
+        return f'\\g<{group}>'
+    if (isinstance(node, ast.BoolOp) and isinstance(node.op, ast.Or) and len(node.values) == 2
+            and isinstance(node.values[1], ast.Constant) and node.values[1].value == ''):
+        return _template_part(node.values[0], set())
+    if isinstance(node, ast.JoinedStr):
+        return ''.join(_template_part(value, optional_groups) for value in node.values)
+    if isinstance(node, ast.FormattedValue) and node.conversion == -1 and node.format_spec is None:
+        return _template_part(node.value, optional_groups)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        return _template_part(node.left, optional_groups) + _template_part(node.right, optional_groups)
+    raise ValueError(f"неподдерживаемое выражение: {ast.dump(node)[:60]}")
+
+
+def _parse_replacement(source):
+    try:
+        return ast.parse(source, mode='eval').body
+    except SyntaxError:
+        # f'{m.group(1) or ''}' - допустимо только с Python 3.12; пробуем другие кавычки
+        fixed = re.sub(r"(\{[^{}']*)''([^{}']*\})", r'\1""\2', source)
+        return ast.parse(fixed, mode='eval').body
+
+
+def convert_rule(rule):
+    """Переводит правило eval-формата в декларативное.
+
+    :return: (новое правило или None, причина отказа или None).
+    """
+    if 'regex' in rule:
+        return None, 'уже декларативное'
+    try:
+        pattern = eval(rule['pattern'], {'re': re})
+    except Exception as e:
+        return None, f'ошибка в pattern: {e}'
+    try:
+        node = _parse_replacement(rule['replacement'])
+        if isinstance(node, ast.Lambda):
+            args = node.args
+            if len(args.args) != 1 or args.args[0].arg != 'm' or args.vararg or args.kwarg:
+                return None, 'лямбда должна принимать один аргумент m'
+            optional = _optional_groups(sre_parse.parse(pattern.pattern, pattern.flags))
+            template = _template_part(node.body, optional)
+        elif isinstance(node, ast.Constant) and isinstance(node.value, str):
+            template = node.value
+        else:
+            return None, 'замена не является строкой или лямбдой'
+    except (SyntaxError, ValueError) as e:
+        return None, str(e)
+    converted = {'regex': pattern.pattern}
+    flags = [name for name in FLAG_NAMES if pattern.flags & getattr(re, name)]
+    if flags:
+        converted['flags'] = flags
+    converted['template'] = template
+    if 'scope' in rule:
+        converted['scope'] = rule['scope']
+    return converted, None
+
+
+def _same_behaviour(old_rule, new_rule, digits):
+    """Сравнивает старое и новое правило на примерах совпадений для всех цифр."""
+    compiler = RuleCompiler()
+    silent = logging.getLogger('rule_tools.silent')
+    silent.propagate = False
+    for digit in digits:
+        old_set = compiler.get({'rule': old_rule}, digit, logger=silent)
+        new_set = compiler.get({'rule': new_rule}, digit, logger=silent)
+        if not new_set:
+            return False
+        if not old_set:
+            continue  # старое правило не загружается этой версией Python
+        texts = rule_samples(new_set.rules[0].pattern)
+        if any(old_set.apply_sequential(t) != new_set.apply_sequential(t) for t in texts):
+            return False
+    return True
+
+
+def convert_config(config_data, logger):
+    """Возвращает копию конфигурации с переведёнными правилами и число переводов."""
+    converted_config = json.loads(json.dumps(config_data))
+    converted_count = 0
+    for project, project_config in converted_config.items():
+        digits = project_digits(project_config)
+        for section in PARSER_SECTIONS:
+            rules = project_config.get(section)
+            if not isinstance(rules, dict):
+                continue
+            for rule_name, rule in list(rules.items()):
+                new_rule, reason = convert_rule(rule)
+                if new_rule is not None and not _same_behaviour(rule, new_rule, digits):
+                    new_rule, reason = None, 'результат отличается на примерах'
+                if new_rule is None:
+                    if reason != 'уже декларативное':
+                        logger.log(logging.INFO, f"[{project} / {section}] '{rule_name}' оставлено: {reason}")
+                    continue
+                rules[rule_name] = new_rule
+                converted_count += 1
+        if 'merged_engine' in project_config:
+            # Хеши правил изменились - проверку объединённого режима нужно пройти заново
+            project_config.pop('merged_engine')
+    return converted_config, converted_count
+
+
+def cmd_convert(args, logger):
+    config_data = load_config(args.config)
+    converted, count = convert_config(config_data, logger)
+    if args.in_place:
+        shutil.copy(args.config, args.config + '.bak')
+        output = args.config
+    else:
+        output = args.output or os.path.splitext(args.config)[0] + '.declarative.json'
+    save_config(output, converted, template_path=args.config)
+    logger.log(logging.INFO, f"Переведено правил: {count}. Результат: {output}")
+    return 0
+
+
+# Размеры удваиваются: на экспоненциальных шаблонах время взрывается уже на
+# коротких строках, и замер прекращается до зависания.
+LINT_SIZES = tuple(2 ** n for n in range(3, 15))   # 8 .. 16384
+LINT_SEEDS = ('0', 'A', 'a', ' ', '.', '0A', 'A0', '0 ', 'A ')
+BASE_SIZE = 1024        # с этого размера накладные расходы вызова уже не искажают мс/КБ
+SUPERLINEAR_RATIO = 4   # допустимый рост мс/КБ при 16-кратном удлинении строки
+SUPERLINEAR_MIN_TIME = 0.001
+
+
+def _time_rule(rule, text, repeat=3):
+    """Минимальное время применения правила к text (с) и число замен."""
+    best, count = None, 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        _, count = rule.pattern.subn(rule.replacement, text)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, count
+
+
+def _rate(rule, seed, size, repeat=5):
+    """Время правила на строке из повторов seed длиной size: (с, мс/КБ)."""
+    text = (seed * (size // len(seed) + 1))[:size]
+    elapsed, _ = _time_rule(rule, text, repeat)
+    return elapsed, elapsed * 1000 / (size / 1024)
+
+
+def _worst_case_seeds(rule):
+    """Фрагменты, повторением которых строятся синтетические строки для правила."""
+    seeds = list(LINT_SEEDS)
+    for sample in rule_samples(rule.pattern):
+        seeds.append(sample)
+        if len(sample) > 1:
+            seeds.append(sample[:-1])              # почти совпадение
+            seeds.append(sample[:-1] + '\n')
+    return [seed for seed in dict.fromkeys(seeds) if seed]
+
+
+def lint_rule(rule, budget_ms, sample_text=None):
+    """Замеряет одно правило.
+
+    :return: словарь с результатами: worst_ms_per_kb, worst_seed, superlinear,
+        sample_ms_per_kb, sample_hits, over_budget.
+    """
+    result = {'rule': rule.name, 'worst_ms_per_kb': 0.0, 'worst_seed': None,
+              'superlinear': False, 'sample_ms_per_kb': None, 'sample_hits': None}
+    for seed in _worst_case_seeds(rule):
+        rates = {}
+        elapsed = exploded = None
+        for size in LINT_SIZES:
+            elapsed, ms_per_kb = _rate(rule, seed, size, repeat=1 if elapsed and elapsed > 0.05 else 5)
+            if budget_ms < ms_per_kb <= budget_ms * 4:
+                ms_per_kb = min(ms_per_kb, _rate(rule, seed, size)[1])   # повторный замер
+            rates[size] = ms_per_kb
+            exploded = ms_per_kb > budget_ms * 4
+            if (size >= BASE_SIZE or exploded) and ms_per_kb > result['worst_ms_per_kb']:
+                result['worst_ms_per_kb'], result['worst_seed'] = ms_per_kb, seed
+            if exploded:
+                break  # дальше только дольше
+        # Сравниваем мс/КБ с замером на строке в 16 раз короче (линейный рост ~ 1)
+        base_rate = rates.get(size // 16)
+        if base_rate is None:
+            superlinear = exploded   # время взорвалось на совсем коротких строках
+        else:
+            superlinear = elapsed > SUPERLINEAR_MIN_TIME and ms_per_kb > base_rate * SUPERLINEAR_RATIO
+            if superlinear and not exploded:
+                # Повторный замер: разовые всплески из-за загрузки машины не считаются
+                elapsed, ms_per_kb = _rate(rule, seed, size)
+                superlinear = ms_per_kb > min(base_rate, _rate(rule, seed, size // 16)[1]) * SUPERLINEAR_RATIO
+        result['superlinear'] = result['superlinear'] or superlinear
+    if sample_text:
+        elapsed, hits = _time_rule(rule, sample_text)
+        result['sample_ms_per_kb'] = elapsed * 1000 / (len(sample_text) / 1024)
+        result['sample_hits'] = hits
+    result['over_budget'] = max(result['worst_ms_per_kb'], result['sample_ms_per_kb'] or 0) > budget_ms
+    return result
+
+
+def cmd_lint(args, logger):
+    config_data = load_config(args.config)
+    sample_text = '\n'.join(iter_corpus(args.sample, logger)) if args.sample else None
+    compiler = RuleCompiler()
+    report, failed, measured = [], False, {}
+    for project, project_config in config_data.items():
+        if args.project and project != args.project:
+            continue
+        for section in PARSER_SECTIONS:
+            rules = project_config.get(section)
+            if not isinstance(rules, dict) or (args.parser and section != args.parser):
+                continue
+            rule_set = compiler.get(rules, project_digits(project_config)[0], project=project,
+                                    parser=section, logger=logger)
+            loaded = {rule.name for rule in rule_set.rules}
+            for name in rules:
+                if name not in loaded:
+                    failed = True
+                    report.append({'project': project, 'parser': section, 'rule': name, 'error': 'не загружается'})
+                    logger.log(logging.ERROR, f"[{project} / {section}] '{name}': правило не загружается")
+            for rule in rule_set.rules:
+                # Одинаковые правила разных проектов замеряются один раз
+                key = (rule.pattern.pattern, rule.pattern.flags, rules_hash({'r': rules[rule.name]}))
+                if key not in measured:
+                    measured[key] = lint_rule(rule, args.budget_ms, sample_text)
+                result = dict(measured[key], project=project, parser=section)
+                report.append(result)
+                problems = []
+                if result['over_budget']:
+                    failed = True
+                    problems.append(f"превышен бюджет {args.budget_ms} мс/КБ")
+                if result['superlinear']:
+                    problems.append("сверхлинейный рост времени")
+                if result['sample_hits'] == 0:
+                    problems.append("не срабатывает на образце")
+                level = logging.WARNING if problems else logging.DEBUG
+                details = f"худший случай {result['worst_ms_per_kb']:.3f} мс/КБ на {result['worst_seed']!r}"
+                if result['sample_ms_per_kb'] is not None:
+                    details += f", образец {result['sample_ms_per_kb']:.3f} мс/КБ, замен {result['sample_hits']}"
+                logger.log(level, f"[{project} / {section}] '{rule.name}': {details}"
+                                  + (f" - {'; '.join(problems)}" if problems else ""))
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    logger.log(logging.INFO, f"Проверено правил: {len(report)}. "
+                             + ("Есть ошибки." if failed else "Ошибок нет."))
+    return 1 if failed else 0
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Служебные команды для правил config.json")
+    parser.add_argument('--config', default=os.path.join(os.getcwd(), 'config.json'),
+                        help="Путь к config.json")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    check_merge = commands.add_parser('check-merge', help="Проверка объединённого режима на корпусе")
+    check_merge.add_argument('--project', required=True)
+    check_merge.add_argument('--parser', required=True)
+    check_merge.add_argument('--corpus', nargs='+', default=[], help="Файлы или папки с образцами")
+    check_merge.add_argument('--enable', action='store_true',
+                             help="Записать результат проверки в config.json")
+    check_merge.set_defaults(handler=cmd_check_merge)
+
+    convert = commands.add_parser('convert', help="Перевод правил в декларативный формат")
+    target = convert.add_mutually_exclusive_group()
+    target.add_argument('--output', help="Куда записать результат")
+    target.add_argument('--in-place', action='store_true',
+                        help="Перезаписать config.json (копия сохраняется в config.json.bak)")
+    convert.set_defaults(handler=cmd_convert)
+
+    lint = commands.add_parser('lint', help="Замер скорости правил")
+    lint.add_argument('--project', help="Только этот проект")
+    lint.add_argument('--parser', help="Только этот парсер")
+    lint.add_argument('--sample', nargs='+', default=[], help="Файлы или папки с образцом текста")
+    lint.add_argument('--budget-ms', type=float, default=2.0,
+                      help="Допустимое время правила на 1 КБ текста, мс")
+    lint.add_argument('--report', help="Записать отчёт в JSON")
+    lint.set_defaults(handler=cmd_lint)
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    logger = logging.getLogger('rule_tools')
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    return args.handler(args, logger)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
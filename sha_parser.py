@@ -15,6 +15,8 @@ import pythoncom
 import pywintypes
 import time
 import logging
+from rule_engine import rule_compiler
+from fast_copy import copy_verbatim
 
 def get_license_servers_from_registry():
     """
@@ -126,6 +128,7 @@ class ShaProcessorWinAPI:
         :param debug: Включает отладочное логирование.
         """
         self.replacement_digit = str(replacement_digit)    # цифра, которая участвует в заменах.
+        self.project = project
         
         self.logger = logger or logging.getLogger()
         self.logger.log(logging.DEBUG, f"Инициализация ShaProcessorWinAPI с цифрой: {self.replacement_digit} и проектом: {project}")
@@ -136,27 +139,24 @@ class ShaProcessorWinAPI:
         """
         Загружает паттерны замен из словаря правил.
 
-        Для каждого правила eval'ит pattern (re.compile) и replacement.
-        Логирует загрузку или ошибки. Если правил нет - выдаёт предупреждение.
+        Правила компилируются общим rule_compiler один раз за запуск
+        для пары (набор правил, цифра замены); результат сохраняется в self.rule_set.
 
         :param rules: Словарь {rule_name: {'pattern': str, 'replacement': str}}.
         :return: Список кортежей (compiled_pattern, replacement_func_or_str).
         """
-        patterns = []
-        try:
-            for rule_name, rule in rules.items():
-                try:
-                    pattern = eval(rule["pattern"], {"re": re})
-                    replacement = eval(rule["replacement"], {"self": self})
-                    patterns.append((pattern, replacement))
-                    self._log(f"Загружено правило '{rule_name}'")
-                except Exception as e:
-                    self._log(f"Ошибка загрузки правила '{rule_name}': {e}")
-        except Exception as e:
-            self.logger.log(logging.ERROR, f"Ошибка обработки rules: {e}")
-        if not patterns:
-            self.logger.log(logging.DEBUG,"Предупреждение: Нет patterns для этого парсера")
-        return patterns
+        self.rule_set = rule_compiler.get(rules, self.replacement_digit, project=self.project,
+                                          parser='sha_parser', logger=self.logger)
+        return self.rule_set.patterns
+
+    def _apply_replacements(self, text):
+        """
+        Применяет все правила к строке.
+
+        :param text: Исходный текст.
+        :return: Текст после замен.
+        """
+        return self.rule_set.apply(text)
 
     def start_app(self):
         """
@@ -213,8 +213,7 @@ class ShaProcessorWinAPI:
                 text = text_obj.Text
                 if text and isinstance(text, str):
                     original_text = text
-                    for pattern, replacement in self.patterns:
-                        text = pattern.sub(replacement, text)
+                    text = self._apply_replacements(text)
                     if text != original_text:
                         text_obj.Text = text
                         self._log(f"[ИЗМЕНЕНО] {obj_name}: '{original_text}' → '{text}'")
@@ -272,9 +271,7 @@ class ShaProcessorWinAPI:
                 except Exception:
                     continue
                 if isinstance(val, str) and val.strip():
-                    new_val = val
-                    for pattern, repl in self.patterns:
-                        new_val = pattern.sub(repl, new_val)
+                    new_val = self._apply_replacements(val)
                     if new_val != val:
                         try:
                             setattr(obj, prop, new_val)
@@ -286,7 +283,8 @@ class ShaProcessorWinAPI:
 
     def process_file(self, input_path, output_path):
         """
-        Обрабатывает файл SHA: открывает, заменяет текст, сохраняет если изменения.
+        Обрабатывает файл SHA: открывает, заменяет текст, сохраняет если изменения,
+        иначе копирует исходный файл в output_path без пересохранения.
         Обрабатывает TextBoxes и Groups на каждом листе. Закрывает документ в finally.
 
         :param input_path: Путь к входному файлу.
@@ -320,7 +318,8 @@ class ShaProcessorWinAPI:
                 doc.SaveAs(output_path)
                 self.logger.log(logging.DEBUG, f"Документ сохранён: {output_path}")
             else:
-                self.logger.log(logging.DEBUG, f"Изменений не найдено, сохранение пропущено")
+                method = copy_verbatim(input_path, output_path)
+                self.logger.log(logging.DEBUG, f"Изменений не найдено, файл скопирован ({method}): {output_path}")
 
             return True
 
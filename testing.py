@@ -1,5 +1,31 @@
 import unittest
+import os
 import re
+import json
+import logging
+import tempfile
+import io
+import struct
+import zipfile
+from unittest import mock
+from rule_engine import (RuleCompiler, ReplacementCache, RuleProfiler, check_merge_equivalence, rules_hash,
+                         parse_scope, rule_profiler)
+from rule_tools import convert_rule, lint_rule, save_config
+from ooxml_package import rewrite_package, stream_rewrite_xml, discover_parts, package_may_match, split_runs
+from ole_package import TextSlot, patch_slots
+from xlsb_package import write_record, read_records, rewrite_records
+from word_parser import WordProcessor
+from excel_parser import ExcelProcessor
+from font_index import FontIndex, read_font_faces, extract_face
+from pdf_content import (FontCodec, parse_tounicode, simple_encoding_map, text_operators, align_operators,
+                         patch_operators)
+
+try:
+    import fitz
+    import pdf_parser
+    from pdf_parser import PdfProcessor, PageTextIndex
+except ImportError:
+    fitz = None
 
 # Mock config with corrected patterns
 MOCK_CONFIG = {
@@ -137,5 +163,726 @@ class TestProcessors(unittest.TestCase):
             result = apply_file_rename(input_name, DIGIT, PROJECT)
             self.assertEqual(result, expected, f"Failed for {input_name}")
 
+ENGINE_RULES = {
+    "unit": {
+        "pattern": "re.compile(r'(Unit\\s*)\\d\\b', re.IGNORECASE)",
+        "replacement": "lambda m: f'{m.group(1)}{self.replacement_digit}'"
+    },
+    "revision": {
+        "pattern": "re.compile(r'C0[2-9]\\b')",
+        "replacement": "'C01'"
+    },
+    "broken": {
+        "pattern": "re.compile(r'(')",
+        "replacement": "'x'"
+    }
+}
+ENGINE_CONFIG = {"test_project": {"word_parser": ENGINE_RULES}}
+
+
+class TestRuleEngine(unittest.TestCase):
+
+    def _tmp_dir(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        return tmp.name
+
+    def test_rule_set_is_shared(self):
+        compiler = RuleCompiler(self._tmp_dir())
+        first = compiler.get(ENGINE_RULES, "2")
+        self.assertIs(first, compiler.get(ENGINE_RULES, 2))
+        self.assertEqual(len(first), 2)
+        self.assertEqual(first.apply("Unit 1, rev C03"), "Unit 2, rev C01")
+
+    def test_snapshot_round_trip(self):
+        cache_dir = self._tmp_dir()
+        compiler = RuleCompiler(cache_dir)
+        compiler.load_snapshot(ENGINE_CONFIG)
+        compiler.get(ENGINE_RULES, "3")
+        self.assertTrue(compiler.save_snapshot())
+
+        restored = RuleCompiler(cache_dir)
+        self.assertTrue(restored.load_snapshot(ENGINE_CONFIG))
+        self.assertEqual(restored.get(ENGINE_RULES, "4").apply("unit 1 C02"), "unit 4 C01")
+
+    def test_prefilter(self):
+        rule_set = RuleCompiler(self._tmp_dir()).get(ENGINE_RULES, "2")
+        unit, revision = rule_set.rules
+        self.assertEqual((unit.literal, unit.ignorecase), ("Unit", True))
+        self.assertEqual(revision.literal, "C0")
+        self.assertFalse(rule_set.could_match("   "))
+        self.assertTrue(rule_set.could_match("UNIT 5"))
+        self.assertEqual(rule_set.apply("UNIT 5"), "UNIT 2")
+
+    def test_merged_engine(self):
+        compiler = RuleCompiler(self._tmp_dir())
+        ok, checked, mismatches, reason = check_merge_equivalence(
+            compiler.get(ENGINE_RULES, "2"), ["Unit 1 C02", "unit3 C09"])
+        self.assertTrue(ok and checked and not mismatches and reason is None)
+
+        config = {"test_project": {"word_parser": ENGINE_RULES,
+                                   "merged_engine": {"word_parser": rules_hash(ENGINE_RULES)}}}
+        merged_compiler = RuleCompiler(self._tmp_dir())
+        merged_compiler.load_snapshot(config)
+        rule_set = merged_compiler.get(ENGINE_RULES, "2")
+        self.assertEqual(rule_set.engine, "merged")
+        self.assertEqual(rule_set.apply("Unit 1 C02"), "Unit 2 C01")
+
+        chained = {"first": {"pattern": "re.compile(r'C02')", "replacement": "'C03'"},
+                   "second": {"pattern": "re.compile(r'C03')", "replacement": "'C01'"}}
+        ok, _, _, reason = check_merge_equivalence(compiler.get(chained, "2"), [])
+        self.assertFalse(ok)
+        self.assertIsNotNone(reason)
+
+    def test_replacement_cache(self):
+        cache = ReplacementCache(maxsize=2)
+        cache.put("set", "a", "A")
+        cache.put("set", "b", "B")
+        self.assertEqual(cache.get("set", "a"), "A")
+        cache.put("set", "c", "C")
+        self.assertIsNone(cache.get("set", "b"))
+        self.assertEqual(cache.stats(), {"size": 2, "maxsize": 2, "hits": 1, "misses": 1, "evictions": 1})
+
+    def test_declarative_rules(self):
+        unit, reason = convert_rule(ENGINE_RULES["unit"])
+        self.assertIsNone(reason)
+        self.assertEqual(unit, {"regex": "(Unit\\s*)\\d\\b", "flags": ["IGNORECASE"],
+                                "template": "\\g<1>{digit}"})
+        optional = {"pattern": "re.compile(r'(A)?B')", "replacement": "lambda m: f'{m.group(1)}C'"}
+        self.assertIsNone(convert_rule(optional)[0])
+
+        compiler = RuleCompiler(self._tmp_dir())
+        declarative = compiler.get({"unit": unit, "revision": ENGINE_RULES["revision"]}, "2")
+        self.assertEqual(declarative.apply("Unit 1, rev C03"),
+                         compiler.get(ENGINE_RULES, "2").apply("Unit 1, rev C03"))
+
+    def test_scoped_rules(self):
+        header = {"regex": "&RC0[2-9]\\b", "template": "&RC01",
+                  "scope": {"parts": ["xl/worksheets/*"], "elements": ["oddHeader", "oddFooter"]}}
+        rule_set = RuleCompiler(self._tmp_dir()).get({"header": header, "unit": ENGINE_RULES["unit"]}, "2")
+        self.assertTrue(rule_set.has_scopes)
+        self.assertEqual(len(rule_set.scoped("xl/worksheets/sheet1.xml", "oddHeader")), 2)
+        self.assertEqual(len(rule_set.scoped("xl/worksheets/sheet1.xml", "t")), 1)
+        self.assertEqual(len(rule_set.scoped("xl/sharedStrings.xml", "oddHeader")), 1)
+        self.assertEqual(len(rule_set.scoped(None, "oddFooter")), 2)
+        self.assertIs(rule_set.scoped("xl/worksheets/sheet1.xml", "t"), rule_set.scoped("xl/worksheets/sheet2.xml", "t"))
+        self.assertEqual(rule_set.apply_scoped("xl/worksheets/sheet1.xml", ["oddHeader", "t"],
+                                               ["&RC03 Unit 1", "&RC03 Unit 1"]),
+                         ["&RC01 Unit 2", "&RC03 Unit 2"])
+        with self.assertRaises(ValueError):
+            parse_scope({"elements": []})
+
+    def test_profiler(self):
+        rule_set = RuleCompiler(self._tmp_dir()).get(ENGINE_RULES, "2", parser="word_parser")
+        profiler = RuleProfiler()
+        profiler.start()
+        profiler.current_file = "a.docx"
+        self.assertEqual(profiler.apply(rule_set, "Unit 1 C02 C03"), "Unit 2 C01 C01")
+        profiler.apply(rule_set, "no match")
+        report = profiler.report()
+        unit = report["files"]["a.docx"]["word_parser"]["unit"]
+        self.assertEqual((unit["calls"], unit["skipped"], unit["matches"]), (1, 1, 1))
+        self.assertEqual(report["totals"]["word_parser"]["revision"]["matches"], 2)
+
+        # совпадения без замены (PDF) учитываются так же; статистика переносится между процессами
+        self.assertEqual(profiler.find_matches(rule_set, "Unit 1 C02"), rule_set.find_matches("Unit 1 C02"))
+        merged = RuleProfiler()
+        merged.merge(profiler.export())
+        self.assertEqual(merged.report(), profiler.report())
+        self.assertEqual(merged.report()["files"]["a.docx"]["word_parser"]["unit"]["matches"], 2)
+
+        json_path, csv_path = profiler.write_report(os.path.join(self._tmp_dir(), "profile"))
+        self.assertTrue(os.path.exists(json_path) and os.path.exists(csv_path))
+
+    def test_apply_batch(self):
+        rule_set = RuleCompiler(self._tmp_dir()).get(ENGINE_RULES, "2")
+        self.assertTrue(rule_set.joinable)
+        texts = ["Unit 1", "", "C03", "Unit 1", "plain", "unit 5 C09"]
+        self.assertEqual(rule_set.apply_batch(texts), [rule_set.apply(text) for text in texts])
+
+        anchored = {"first_digit": {"regex": "^\\d", "template": "{digit}"}}
+        anchored_set = RuleCompiler(self._tmp_dir()).get(anchored, "2")
+        self.assertFalse(anchored_set.joinable)
+        self.assertEqual(anchored_set.apply_batch(["1a", "b1"]), ["2a", "b1"])
+
+    def test_apply_isolated(self):
+        rules = {
+            "boom": {"regex": "Unit", "template": "x"},
+            "revision": {"pattern": "re.compile(r'C0[2-9]\\b')", "replacement": "'C01'"},
+        }
+        rule_set = RuleCompiler(self._tmp_dir()).get(rules, "2")
+        rule_set.rules[0].replacement = lambda m: 1 / 0
+        with self.assertLogs("rename", level="WARNING") as logs:
+            result = rule_set.apply_isolated("Unit 1 C03", logger=logging.getLogger("rename"), context="a.pdf")
+        self.assertEqual(result, "Unit 1 C01")
+        self.assertIn("'boom'", logs.output[0])
+        self.assertIn("a.pdf", logs.output[0])
+
+    def test_lint_rule(self):
+        compiler = RuleCompiler(self._tmp_dir())
+        slow = compiler.get({"slow": {"regex": "\\d+\\s*X", "template": "y"}}, "2").rules[0]
+        result = lint_rule(slow, budget_ms=2.0, sample_text="12 X 3")
+        self.assertTrue(result["superlinear"] and result["over_budget"])
+        self.assertEqual(result["sample_hits"], 1)
+
+    def test_save_config(self):
+        path = os.path.join(self._tmp_dir(), "config.json")
+        text = ('{\n\t"Project": {\n\t\t"word_parser": {\n\t\t\t"Unit": {"pattern": "r\'Unit \\\\d\'",  '
+                '"replacement": "f\'Unit {digit}\'"},\n'
+                '\t\t\t"Rev": {\n                "pattern": "r\'C0\\\\d\'",\n'
+                '                "replacement": "\'C01\'"\n            }\n\t\t},\n'
+                '    "digits": [["1", "1"], ["2",  "2"]]\n\t}\n}\n')
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        data = json.loads(text)
+        save_config(path, data)
+        with open(path, encoding="utf-8") as f:
+            self.assertEqual(f.read(), text)
+
+        data["Project"]["merged_engine"] = {"word_parser": "abc"}
+        del data["Project"]["word_parser"]["Rev"]["replacement"]
+        save_config(path, data)
+        with open(path, encoding="utf-8") as f:
+            written = f.read()
+        self.assertEqual(json.loads(written), data)
+        self.assertIn('\t\t\t"Unit": {"pattern": "r\'Unit \\\\d\'",  ', written)
+        self.assertIn('                "pattern": "r\'C0\\\\d\'"\n            }', written)
+        self.assertIn('"digits": [["1", "1"], ["2",  "2"]],\n    "merged_engine": {"word_parser": "abc"}\n\t}', written)
+
+
+class TestOoxmlPackage(unittest.TestCase):
+
+    def test_rewrite_package(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        tmp_dir = tmp.name
+        input_path = os.path.join(tmp_dir, "in.docx")
+        output_path = os.path.join(tmp_dir, "out.docx")
+        media = os.urandom(4096)
+        with zipfile.ZipFile(input_path, "w", zipfile.ZIP_DEFLATED) as zip_out:
+            zip_out.writestr("word/document.xml", "<doc>Unit 1</doc>")
+            zip_out.writestr("word/media/image1.png", media)
+            zip_out.writestr("docProps/app.xml", "<app/>", compress_type=zipfile.ZIP_STORED)
+
+        modified = rewrite_package(input_path, output_path, ["word/document.xml", "docProps/app.xml"],
+                                   lambda name, data: data.replace(b"1", b"2") if b"1" in data else None)
+        self.assertEqual(modified, {"word/document.xml"})
+        with zipfile.ZipFile(input_path) as zip_in, zipfile.ZipFile(output_path) as zip_out:
+            self.assertIsNone(zip_out.testzip())
+            self.assertEqual(zip_out.namelist(), zip_in.namelist())
+            self.assertEqual(zip_out.read("word/document.xml"), b"<doc>Unit 2</doc>")
+            self.assertEqual(zip_out.read("word/media/image1.png"), media)
+            copied = zip_out.getinfo("docProps/app.xml")
+            self.assertEqual(copied.compress_type, zipfile.ZIP_STORED)
+
+    def test_rewrite_package_workers(self):
+        source = io.BytesIO()
+        with zipfile.ZipFile(source, "w", zipfile.ZIP_DEFLATED) as package:
+            for i in range(12):
+                package.writestr(f"part{i}.xml", f"<p>Unit 1 {i}</p>" * 200)
+        names = [f"part{i}.xml" for i in range(12) if i % 3]
+        outputs = []
+        for workers in (1, 4):
+            output = io.BytesIO()
+            modified = rewrite_package(io.BytesIO(source.getvalue()), output, names,
+                                       lambda name, data: data.replace(b"Unit 1", b"Unit 2"), workers=workers)
+            self.assertEqual(modified, set(names))
+            outputs.append(output.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+        with zipfile.ZipFile(io.BytesIO(outputs[1])) as package:
+            self.assertIsNone(package.testzip())
+            self.assertEqual(package.namelist(), [f"part{i}.xml" for i in range(12)])
+            self.assertIn(b"Unit 2", package.read("part1.xml"))
+            self.assertIn(b"Unit 1", package.read("part3.xml"))
+
+    def test_discover_parts(self):
+        main = "application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"
+        comments = "application/vnd.openxmlformats-officedocument.wordprocessingml.comments+xml"
+        rel = '<Relationship Id="{0}" Type="t" Target="{1}"{2}/>'
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w") as package:
+            package.writestr("[Content_Types].xml",
+                             '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                             '<Default Extension="xml" ContentType="application/xml"/>'
+                             f'<Override PartName="/word/document.xml" ContentType="{main}"/>'
+                             f'<Override PartName="/word/comments.xml" ContentType="{comments}"/>'
+                             f'<Override PartName="/word/orphan.xml" ContentType="{comments}"/>'
+                             f'<Override PartName="/word/media/My%20File.xml" ContentType="{comments}"/>'
+                             f'<Override PartName="/word/media/%D0%A1%D1%85%D0%B5%D0%BC%D0%B0.xml" '
+                             f'ContentType="{comments}"/></Types>')
+            rels = '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">{}</Relationships>'
+            package.writestr("_rels/.rels", rels.format(rel.format("rId1", "word/document.xml", "")))
+            package.writestr("word/_rels/document.xml.rels", rels.format(
+                rel.format("rId1", "comments.xml", "") + rel.format("rId2", "../word/styles.xml", "")
+                + rel.format("rId3", "http://example.com", ' TargetMode="External"')
+                + rel.format("rId4", "media/My%20File.xml", "")
+                + rel.format("rId5", "media/%D0%A1%D1%85%D0%B5%D0%BC%D0%B0.xml", "")))
+            for name in ("word/document.xml", "word/comments.xml", "word/orphan.xml", "word/styles.xml",
+                         "word/media/My File.xml", "word/media/Схема.xml"):
+                package.writestr(name, "<x/>")
+        with zipfile.ZipFile(buf) as package:
+            # цели связей и PartName - URI с %-кодами, имена в архиве - без них
+            self.assertEqual(discover_parts(package, {main, comments}),
+                             {"word/document.xml": main, "word/comments.xml": comments,
+                              "word/media/My File.xml": comments, "word/media/Схема.xml": comments})
+
+    @staticmethod
+    def _package(main_type, main_part, main_xml, rel_type, embedded=None):
+        """Минимальный пакет OOXML с одной основной частью и, возможно, вложенным пакетом."""
+        types = ('<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                 '<Default Extension="xlsx" ContentType="application/vnd.openxmlformats-officedocument.'
+                 f'spreadsheetml.sheet"/><Override PartName="/{main_part}" ContentType="{main_type}"/></Types>')
+        rels = '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">{}</Relationships>'
+        folder, name = main_part.split("/")
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w") as package:
+            package.writestr("[Content_Types].xml", types)
+            package.writestr("_rels/.rels", rels.format(f'<Relationship Id="rId1" Type="{rel_type}" '
+                                                        f'Target="{main_part}"/>'))
+            package.writestr(main_part, main_xml)
+            if embedded is not None:
+                package.writestr(f"{folder}/_rels/{name}.rels", rels.format(
+                    '<Relationship Id="rId2" Type="package" Target="embeddings/Sheet.xlsx"/>'))
+                package.writestr(f"{folder}/embeddings/Sheet.xlsx", embedded)
+        return buf.getvalue()
+
+    def test_embedded_package(self):
+        ns = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+        workbook = self._package("application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml",
+                                 "xl/sheet1.xml", f'<worksheet xmlns="{ns}"><sheetData><row><c t="inlineStr">'
+                                 '<is><t>Unit 1</t></is></c></row></sheetData></worksheet>', "sheet")
+        w = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+        document = self._package("application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml",
+                                 "word/document.xml", f'<w:document xmlns:w="{w}"><w:body><w:p><w:r>'
+                                 '<w:t>Unit 1</w:t></w:r></w:p></w:body></w:document>', "doc", embedded=workbook)
+        rules = {"unit": ENGINE_RULES["unit"]}
+
+        processor = WordProcessor("2", "test_project", rules,
+                                  project_rules={"word_parser": rules, "excel_parser": rules})
+        with zipfile.ZipFile(io.BytesIO(processor.process_bytes(document))) as package:
+            self.assertIn(b"Unit 2", package.read("word/document.xml"))
+            with zipfile.ZipFile(io.BytesIO(package.read("word/embeddings/Sheet.xlsx"))) as inner:
+                self.assertIn(b"Unit 2", inner.read("xl/sheet1.xml"))
+
+        # без правил Excel вложенная книга копируется как есть
+        with zipfile.ZipFile(io.BytesIO(WordProcessor("2", "test_project", rules).process_bytes(document))) as package:
+            self.assertEqual(package.read("word/embeddings/Sheet.xlsx"), workbook)
+
+    def test_package_may_match(self):
+        w = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+        main_type = "application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"
+        rule_set = RuleCompiler().get({"unit": ENGINE_RULES["unit"]}, "2")
+
+        def may_match(body):
+            document = self._package(main_type, "word/document.xml",
+                                     f'<w:document xmlns:w="{w}"><w:body>{body}</w:body></w:document>', "doc")
+            with zipfile.ZipFile(io.BytesIO(document)) as package:
+                return package_may_match(package, {main_type}, rule_set.could_match)
+
+        self.assertFalse(may_match('<w:p><w:r><w:t>Nothing here</w:t></w:r></w:p>'))
+        # текст абзаца, разбитый на несколько w:t, и ссылки на символы
+        self.assertTrue(may_match('<w:p><w:r><w:t>Un</w:t></w:r>\n<w:r><w:t>it 1</w:t></w:r></w:p>'))
+        self.assertTrue(may_match('<w:p><w:r><w:t>Unit&#x20;1</w:t></w:r></w:p>'))
+        # комментарии без разбора XML не проверить
+        self.assertTrue(may_match('<!-- x --><w:p><w:r><w:t>Nothing</w:t></w:r></w:p>'))
+
+        processor = WordProcessor("2", "test_project", {})
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "doc.docx")
+            with open(path, "wb") as f:
+                f.write(self._package(main_type, "word/document.xml", f'<w:document xmlns:w="{w}"><w:body><w:p>'
+                                      '<w:r><w:t>Лист регистрации изменений</w:t></w:r></w:p></w:body></w:document>',
+                                      "doc"))
+            # таблица изменений очищается и без правил
+            self.assertTrue(processor.may_change(path))
+
+    def test_stream_rewrite_xml(self):
+        ns = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+        sheet = (f'<worksheet xmlns="{ns}" xmlns:r="urn:r"><sheetData>'
+                 + "".join(f'<row r="{i}"><c><f>"C02"</f></c></row>' for i in range(1, 6))
+                 + '</sheetData><headerFooter><oddHeader>C02</oddHeader></headerFooter></worksheet>')
+        chunks = []
+
+        def process_chunk(elements):
+            chunks.append(len(elements))
+            for elem in elements:
+                for node in elem.iter():
+                    if node.text:
+                        node.text = node.text.replace("C02", "C01")
+            return True
+
+        out = io.BytesIO()
+        self.assertTrue(stream_rewrite_xml(io.BytesIO(sheet.encode()), out, ("sheetData",), process_chunk,
+                                           chunk_size=2))
+        self.assertEqual(chunks, [2, 2, 1, 1])
+        result = out.getvalue().decode()
+        self.assertNotIn("C02", result)
+        self.assertEqual(result.count("xmlns="), 1)
+
+    def test_split_runs(self):
+        self.assertEqual(split_runs(["Unit ", "1"], "Unit 2"), ["Unit ", "2"])
+        self.assertEqual(split_runs(["Un", "it 1", " end"], "Unit 22 end"), ["Un", "it 22", " end"])
+        self.assertEqual(split_runs(["ab", "cd"], ""), ["", ""])
+
+    def test_excel_rich_text(self):
+        ns = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+        shared = (f'<sst xmlns="{ns}"><si><r><t>Un</t></r><r><rPr><b/></rPr><t xml:space="preserve">it 1</t></r>'
+                  '<rPh><t>Unit 1</t></rPh></si></sst>')
+        processor = ExcelProcessor("2", "test_project", {"unit": ENGINE_RULES["unit"]})
+        result = processor._process_part("xl/sharedStrings.xml", shared.encode()).decode()
+        # строка, разбитая на фрагменты, заменена с сохранением фрагментов; фонетика не затрагивается
+        self.assertIn("<t>Un</t>", result)
+        self.assertIn('<t xml:space="preserve">it 2</t>', result)
+        self.assertRegex(result, r"<rPh>\s*<t>Unit 1</t>")
+
+        sheet = (f'<worksheet xmlns="{ns}"><sheetData><row><c t="s"><v>1</v></c><c t="str"><f>"Unit "&amp;1</f>'
+                 '<v>Unit 1</v></c></row></sheetData></worksheet>')
+        result = processor._process_part("xl/worksheets/sheet1.xml", sheet.encode()).decode()
+        self.assertIn("<v>Unit 2</v>", result)
+        self.assertIn("<v>1</v>", result)
+
+    def test_word_paragraphs(self):
+        w = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+        rows = "".join(f"<w:tr><w:tc><w:p><w:r><w:t>row {n}</w:t></w:r></w:p></w:tc></w:tr>" for n in range(4))
+        document = (f'<w:document xmlns:w="{w}"><w:body>'
+                    '<w:p><w:r><w:t>Un</w:t></w:r><w:ins><w:r><w:t>it 1</w:t></w:r></w:ins>'
+                    '<w:r><w:instrText>PAGE</w:instrText></w:r></w:p>'
+                    '<w:sdt><w:sdtContent><w:p><w:r><w:t>Unit 1</w:t></w:r></w:p></w:sdtContent></w:sdt>'
+                    '<w:p><w:r><w:t>Лист регистрации </w:t></w:r><w:r><w:t>изменений</w:t></w:r></w:p>'
+                    f'<w:tbl>{rows}</w:tbl></w:body></w:document>')
+        processor = WordProcessor("2", "test_project", {"unit": ENGINE_RULES["unit"]})
+        result = processor._process_part("word/document.xml", document.encode()).decode()
+        # текст абзаца склеивается по фрагментам, в том числе внутри w:ins
+        self.assertRegex(result, r"(?s)<w:t>Un</w:t>.*<w:t>it 2</w:t>")
+        self.assertEqual(result.count("Unit 2"), 1)
+        self.assertIn("PAGE", result)
+        # таблица изменений: первые две строки остаются, остальные очищаются
+        self.assertIn("row 1", result)
+        self.assertNotIn("row 2", result)
+        self.assertNotIn("row 3", result)
+
+    def test_word_stream(self):
+        w = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+        rows = "".join(f"<w:tr><w:tc><w:p><w:r><w:t>row {n}</w:t></w:r></w:p></w:tc></w:tr>" for n in range(3))
+        # заголовок - последний элемент первой пачки (500 элементов), таблица - в следующей
+        filler = "<w:p><w:r><w:t>text</w:t></w:r></w:p>" * 499
+        document = (f'<w:document xmlns:w="{w}"><w:body>{filler}'
+                    '<w:p><w:r><w:t>Лист регистрации изменений</w:t></w:r></w:p>'
+                    f'<w:tbl>{rows}</w:tbl><w:p><w:r><w:t>Un</w:t></w:r><w:r><w:t>it 1</w:t></w:r></w:p>'
+                    '<w:sectPr/></w:body></w:document>')
+        processor = WordProcessor("2", "test_project", {"unit": ENGINE_RULES["unit"]})
+        out = io.BytesIO()
+        self.assertTrue(processor._process_part_stream("word/document.xml", io.BytesIO(document.encode()), out))
+        result = out.getvalue().decode()
+        self.assertIn("<w:t>it 2</w:t>", result)
+        self.assertIn("row 1", result)
+        self.assertNotIn("row 2", result)
+        self.assertNotIn("\n  ", result)
+
+
+class TestOlePackage(unittest.TestCase):
+
+    def test_patch_slots(self):
+        # "10UKD C02" из двух фрагментов: 1 байт на символ и UTF-16
+        data = bytearray(b"10UKD" + " C02".encode("utf-16-le"))
+        slot = TextSlot("10UKD C02", [(0, 5, "cp1252"), (5, 4, "utf-16-le")])
+        self.assertEqual(patch_slots(data, [slot], ["20UKD C01"]), (True, 1))
+        self.assertEqual(bytes(data), b"20UKD" + " C01".encode("utf-16-le"))
+
+        before = bytes(data)
+        slot = TextSlot("20UKD C01", slot.segments)
+        ok, reason = patch_slots(data, [slot, slot], ["30UKD C01", "20UKD C001"])
+        self.assertFalse(ok)
+        self.assertIn("длину", reason)
+        self.assertEqual(bytes(data), before)
+        self.assertFalse(patch_slots(data, [slot], ["Ж0UKD C01"])[0])
+
+
+class TestXlsbPackage(unittest.TestCase):
+
+    @staticmethod
+    def _wide(text):
+        raw = text.encode("utf-16-le")
+        return struct.pack("<I", len(raw) // 2) + raw
+
+    def test_rewrite_records(self):
+        src = io.BytesIO()
+        write_record(src, 159, struct.pack("<II", 2, 2))  # BrtBeginSst
+        write_record(src, 19, b"\x00" + self._wide("Unit 1"))
+        # RichStr: "C02" полужирным (шрифт 1), " Unit 1" обычным (шрифт 0)
+        write_record(src, 19, b"\x01" + self._wide("C02 Unit 1") + struct.pack("<IHHHH", 2, 0, 1, 3, 0))
+        write_record(src, 6, struct.pack("<II", 0, 0) + self._wide("x" * 300))  # BrtCellSt
+        # обозначение разбито между фрагментами: "Unit " полужирным, "1" обычным
+        write_record(src, 19, b"\x01" + self._wide("Unit 1") + struct.pack("<IHHHH", 2, 0, 1, 5, 0))
+        out = io.BytesIO()
+        self.assertTrue(rewrite_records(io.BytesIO(src.getvalue()), out,
+                                        lambda texts, elements: [t.replace("Unit 1", "Unit 12") for t in texts],
+                                        chunk_size=1))
+        records = list(read_records(io.BytesIO(out.getvalue())))
+        self.assertEqual([rt for rt, _ in records], [159, 19, 19, 6, 19])
+        self.assertEqual(records[1][1], b"\x00" + self._wide("Unit 12"))
+        self.assertEqual(records[2][1],
+                         b"\x01" + self._wide("C02 Unit 12") + struct.pack("<IHHHH", 2, 0, 1, 3, 0))
+        self.assertEqual(records[3][1], struct.pack("<II", 0, 0) + self._wide("x" * 300))
+        self.assertEqual(records[4][1], b"\x01" + self._wide("Unit 12") + struct.pack("<IHHHH", 2, 0, 1, 5, 0))
+
+
+class TestPdfContent(unittest.TestCase):
+
+    def test_patch_operators(self):
+        codec = FontCodec(simple_encoding_map('WinAnsiEncoding'))
+        data = (b"BT /F1 10 Tf [(Uni) -20 (t 1)] TJ (a\\) \\(b\\)) Tj ET\n"
+                b"BI /W 1 /H 1 ID \x00(Unit 1)\xff EI\n"
+                b"q /F2 10 Tf <0001> Tj Q (Unit 1) Tj")
+        operators = text_operators(data, {b"F1": codec})
+        # F2 без кодека и данные изображения пропущены
+        self.assertEqual([operator.text for operator in operators], ["Unit 1", "a) (b)", "Unit 1"])
+        self.assertEqual(align_operators(operators, "Unit 1\na) (b)\n?\nUnit 1\n"), [0, 7, 16])
+        new_data = patch_operators(data, [(operators[2], "Unit 2"), (operators[0], "Unit 2")])
+        self.assertEqual(new_data, data.replace(b"(t 1)", b"(t 2)").replace(b"Q (Unit 1)", b"Q (Unit 2)"))
+
+        # соседние операторы и пробел, добавленный при разборе страницы
+        operators = text_operators(b"/F1 9 Tf (Unit 1) Tj (5) Tj (Unit 1) Tj (x y) Tj", {b"F1": codec})
+        self.assertEqual(align_operators(operators, "Unit 15\nUnit 1\nx  y"), [0, 6, 8, None])
+
+        codes, width = parse_tounicode(b"begincmap 1 beginbfchar <0003> <0020> endbfchar "
+                                       b"1 beginbfrange <0010> <0019> <0030> endbfrange endcmap")
+        self.assertEqual((codes[b"\x00\x11"], width), ("1", 2))
+        subset = FontCodec(codes, width, subset=True)
+        operators = text_operators(b"/F1 9 Tf <00110003> Tj", {b"F1": subset})
+        self.assertFalse(subset.can_replace("1 ", "9 "))   # глифа "9" в подмножестве может не быть
+        subset.used.add("9")
+        self.assertTrue(subset.can_replace("1 ", "9 "))
+        self.assertEqual(patch_operators(b"/F1 9 Tf <00110003> Tj", [(operators[0], "9 ")]),
+                         b"/F1 9 Tf <00190003> Tj")
+
+        differences = simple_encoding_map(None, [49, "two", "afii10017"])
+        self.assertEqual((differences[b"1"], b"2" in differences), ("2", False))
+
+
+class TestFontIndex(unittest.TestCase):
+
+    @staticmethod
+    def _name_table(names):
+        """Таблица name: записи Windows (UTF-16BE, английский)."""
+        strings = [text.encode("utf-16-be") for text in names.values()]
+        records, offset = b"", 0
+        for name_id, raw in zip(names, strings):
+            records += struct.pack(">HHHHHH", 3, 1, 0x409, name_id, len(raw), offset)
+            offset += len(raw)
+        return struct.pack(">HHH", 0, len(names), 6 + len(records)) + records + b"".join(strings)
+
+    def _font(self, names, base=0):
+        """Минимальный sfnt только с таблицей name; base - смещение шрифта в файле (для .ttc)."""
+        table = self._name_table(names)
+        return (struct.pack(">IHHHH", 0x00010000, 1, 16, 0, 0)
+                + struct.pack(">4sIII", b"name", 0, base + 28, len(table)) + table)
+
+    def test_font_index(self):
+        arial = {1: "Arial", 2: "Regular", 4: "Arial", 6: "ArialMT"}
+        bold = {1: "Arial", 2: "Bold", 4: "Arial Bold", 6: "Arial-BoldMT"}
+        cambria = {1: "Cambria", 2: "Regular", 4: "Cambria", 6: "Cambria"}
+        math_face = {1: "Cambria Math", 2: "Regular", 4: "Cambria Math", 6: "CambriaMath"}
+        with tempfile.TemporaryDirectory() as tmp:
+            fonts = os.path.join(tmp, "fonts")
+            os.makedirs(os.path.join(fonts, "sub"))
+            with open(os.path.join(fonts, "arial.ttf"), "wb") as f:
+                f.write(self._font(arial))
+            with open(os.path.join(fonts, "sub", "arialbd.ttf"), "wb") as f:
+                f.write(self._font(bold))
+            first = self._font(cambria, base=20)
+            second = self._font(math_face, base=20 + len(first))
+            collection = os.path.join(fonts, "cambria.ttc")
+            with open(collection, "wb") as f:
+                f.write(b"ttcf" + struct.pack(">III", 0x00010000, 2, 20) + struct.pack(">I", 20 + len(first))
+                        + first + second)
+
+            cache_path = os.path.join(tmp, "cache", "font-index.json")
+            index = FontIndex(dirs=[fonts], cache_path=cache_path)
+            self.assertEqual(index.lookup("ABCDEF+ArialMT"), (os.path.join(fonts, "arial.ttf"), 0))
+            self.assertEqual(index.lookup("Arial,Bold"), (os.path.join(fonts, "sub", "arialbd.ttf"), 0))
+            self.assertEqual(index.lookup("Arial-BoldMT")[0], os.path.join(fonts, "sub", "arialbd.ttf"))
+            self.assertEqual(index.lookup("CambriaMath"), (collection, 1))
+            self.assertIsNone(index.lookup("GOST type A"))
+            self.assertTrue(os.path.exists(cache_path))
+
+            # отдельный шрифт из коллекции читается как обычный .ttf
+            face = os.path.join(tmp, "face.ttf")
+            with open(face, "wb") as f:
+                f.write(extract_face(collection, 1))
+            self.assertIn("cambriamath", read_font_faces(face)[0][1])
+
+            # удаление шрифта меняет время изменения каталога - индекс строится заново
+            os.remove(os.path.join(fonts, "arial.ttf"))
+            self.assertIsNone(FontIndex(dirs=[fonts], cache_path=cache_path).lookup("ArialMT"))
+
+
+@unittest.skipIf(fitz is None, "PyMuPDF не установлен")
+class TestPdfProcessor(unittest.TestCase):
+
+    def test_page_text_index(self):
+        doc = fitz.open()
+        page = doc.new_page()
+        page.insert_text((72, 72), "Drawing Unit 1 of Unit 3", fontsize=10)
+        page.insert_text((72, 100), "Unit", fontsize=12)
+        page.insert_text((72, 120), "4", fontsize=12)
+        index = PageTextIndex(page)
+        self.assertEqual(index.text, "Drawing Unit 1 of Unit 3\nUnit\n4\n")
+        self.assertEqual(index.span_at(8).size, 10)
+        self.assertEqual(index.span_at(25).size, 12)
+        self.assertIsNone(index.rect(25, 31))   # совпадение на двух строках
+        rect = index.rect(8, 14)
+        self.assertTrue(72 < rect.x0 < rect.x1 and rect.y0 < 72 < rect.y1)
+
+        processor = PdfProcessor("2", "test_project", {"unit": ENGINE_RULES["unit"]})
+        matches = processor._find_matches(index)
+        self.assertEqual([(start, end, old, new) for start, end, old, new, _ in matches],
+                         [(8, 14, "Unit 1", "Unit 2"), (18, 24, "Unit 3", "Unit 2"), (25, 31, "Unit\n4", "Unit\n2")])
+
+    def test_redact_page(self):
+        doc = fitz.open()
+        page = doc.new_page()
+        page.insert_text((72, 72), "Drawing Unit 1 of Unit 3", fontsize=10)
+        page.insert_text((300, 400), "Unit 4", fontsize=10, morph=(fitz.Point(300, 400), fitz.Matrix(90)))
+        page.draw_line((60, 70), (300, 70))
+        page.insert_link({"kind": fitz.LINK_URI, "from": fitz.Rect(100, 60, 160, 75), "uri": "https://example.com"})
+        page = doc.reload_page(page)
+        link = page.load_links()
+        link.set_border(width=2)
+        link.set_colors(stroke=(1, 0, 0))
+        with tempfile.TemporaryDirectory() as tmp:
+            input_path, output_path = os.path.join(tmp, "in.pdf"), os.path.join(tmp, "out.pdf")
+            doc.save(input_path)
+            processor = PdfProcessor("2", "test_project", {"unit": ENGINE_RULES["unit"]}, replace_mode='redact')
+            self.assertTrue(processor.process_file(input_path, output_path))
+            result_doc = fitz.open(output_path)
+            result = result_doc[0]
+            lines = {(span["text"], tuple(line["dir"])) for block in result.get_text("dict")["blocks"]
+                     for line in block["lines"] for span in line["spans"]}
+            self.assertIn(("Drawing ", (1.0, 0.0)), lines)
+            self.assertIn(("Unit 2", (0.0, -1.0)), lines)
+            self.assertEqual(result.get_text().count("Unit 2"), 3)
+            self.assertNotIn("Unit 1", result.get_text())
+            # графика и ссылки под заменённым текстом не удаляются
+            self.assertEqual(len(result.get_drawings()), 1)
+            self.assertEqual([link["uri"] for link in result.get_links()], ["https://example.com"])
+            # у ссылки остаются рамка и цвет
+            link = result.load_links()
+            self.assertEqual(link.border["width"], 2)
+            self.assertEqual(tuple(link.colors["stroke"]), (1, 0, 0))
+
+    def test_rewrite_content(self):
+        doc = fitz.open()
+        page = doc.new_page()
+        # "Unit 1" и "5" - соседние операторы: "Unit 15" правилу не соответствует и не меняется
+        page.insert_text((72, 50), "Unit 1", fontsize=10)
+        page.insert_text((72 + fitz.get_text_length("Unit 1", fontsize=10), 50), "5", fontsize=10)
+        page.insert_text((72, 72), "Drawing Unit 1 of Unit 3", fontsize=10)
+        page.insert_text((72, 100), "Unit 1", fontsize=10, fontname="cour")
+        page.insert_text((72, 120), "Unit ", fontsize=10)
+        page.insert_text((72 + fitz.get_text_length("Unit ", fontsize=10), 120), "4", fontsize=10)
+        page.draw_line((60, 70), (300, 70))
+        with tempfile.TemporaryDirectory() as tmp:
+            input_path, output_path = os.path.join(tmp, "in.pdf"), os.path.join(tmp, "out.pdf")
+            doc.save(input_path)
+            processor = PdfProcessor("2", "test_project", {"unit": ENGINE_RULES["unit"]})
+            self.assertTrue(processor.process_file(input_path, output_path))
+            result = fitz.open(output_path)[0]
+            self.assertEqual(result.get_text().count("Unit 2"), 4)
+            self.assertIsNone(re.search(r"Unit 1\b", result.get_text()))
+            # строки изменены на месте: спаны не разбиты, закрашивания и аннотаций нет
+            lines = [span["text"] for block in result.get_text("dict")["blocks"]
+                     for line in block["lines"] for span in line["spans"]]
+            self.assertEqual(lines[:3], ["Unit 15", "Drawing Unit 2 of Unit 2", "Unit 2"])
+            self.assertEqual(len(result.get_drawings()), 1)
+            content = result.read_contents()
+            self.assertNotIn(b"556e69742031", content.lower())   # "Unit 1" в шестнадцатеричной форме
+            # совпадение, разбитое между операторами, заменяется поверх
+            self.assertNotIn("4", result.get_text())
+            self.assertIn("Unit 15", result.get_text())
+
+    def test_parallel_pages(self):
+        doc = fitz.open()
+        for number in range(5):
+            page = doc.new_page()
+            page.insert_text((72, 72), f"Page {number}: " + ("Unit 1" if number % 2 else "nothing"), fontsize=10)
+        doc.set_toc([[1, "Start", 1], [1, "End", 5]])
+        with tempfile.TemporaryDirectory() as tmp:
+            input_path = os.path.join(tmp, "in.pdf")
+            doc.save(input_path)
+            texts = []
+            rule_profiler.start()
+            self.addCleanup(rule_profiler.stop)
+            for workers in (1, 2):
+                rule_profiler.current_file = f"workers{workers}.pdf"
+                output_path = os.path.join(tmp, f"out{workers}.pdf")
+                processor = PdfProcessor("2", "test_project", {"unit": ENGINE_RULES["unit"]}, workers=workers,
+                                         pages_per_chunk=2)
+                self.assertTrue(processor.process_file(input_path, output_path))
+                result = fitz.open(output_path)
+                texts.append([page.get_text() for page in result])
+                self.assertEqual(result.get_toc(), [[1, "Start", 1], [1, "End", 5]])
+            self.assertEqual(texts[0], texts[1])
+            # статистика правил из рабочих процессов попадает в отчёт
+            counts = [{parser: {name: (row["calls"], row["matches"]) for name, row in rules.items()}
+                       for parser, rules in rule_profiler.report()["files"][f"workers{workers}.pdf"].items()}
+                      for workers in (1, 2)]
+            self.assertEqual(counts[0], counts[1])
+            self.assertGreaterEqual(sum(matches for rules in counts[1].values() for _, matches in rules.values()), 2)
+            self.assertEqual(sum(text.count("Unit 2") for text in texts[1]), 2)
+
+    def test_worker_snapshot(self):
+        config = {"test_project": {"pdf_parser": {"unit": ENGINE_RULES["unit"]}}}
+        doc = fitz.open()
+        doc.new_page().insert_text((72, 72), "Unit 1", fontsize=10)
+        with tempfile.TemporaryDirectory() as tmp:
+            input_path = os.path.join(tmp, "in.pdf")
+            doc.save(input_path)
+            parent = RuleCompiler(tmp)
+            parent.load_snapshot(config)
+            with mock.patch.object(pdf_parser, "rule_compiler", parent):
+                PdfProcessor("2", "test_project", config["test_project"]["pdf_parser"], config_data=config)
+            self.assertTrue(parent.save_snapshot())
+            # рабочий процесс берёт правила из снимка и ничего не компилирует
+            worker = RuleCompiler(tmp)
+            settings = {"replacement_digit": "2", "project": "test_project", "rules": config["test_project"]["pdf_parser"],
+                        "config_data": config}
+            with mock.patch.object(pdf_parser, "rule_compiler", worker), \
+                    mock.patch.object(worker, "_compile_sources", side_effect=AssertionError("compiled")):
+                changed_pages, data, _, _ = pdf_parser._process_page_range((input_path, 0, 1, settings, None))
+            self.assertEqual(changed_pages, [0])
+            self.assertIn("Unit 2", fitz.open(stream=data, filetype="pdf")[0].get_text())
+
+    def test_parallel_links(self):
+        doc = fitz.open()
+        for number in range(6):
+            page = doc.new_page()
+            page.insert_text((72, 72), f"Page {number}: Unit 1", fontsize=10)
+        doc[0].insert_link({"kind": fitz.LINK_GOTO, "from": fitz.Rect(72, 100, 200, 120), "page": 4})
+        doc[4].insert_link({"kind": fitz.LINK_GOTO, "from": fitz.Rect(72, 100, 200, 120), "page": 1})
+        doc[4].insert_link({"kind": fitz.LINK_URI, "from": fitz.Rect(72, 130, 200, 150), "uri": "https://example.com"})
+        doc.set_toc([[1, "Start", 1], [1, "Five", 5]])
+        with tempfile.TemporaryDirectory() as tmp:
+            input_path = os.path.join(tmp, "in.pdf")
+            doc.save(input_path)
+            results = []
+            for workers in (1, 2):
+                output_path = os.path.join(tmp, f"out{workers}.pdf")
+                processor = PdfProcessor("2", "test_project", {"unit": ENGINE_RULES["unit"]}, workers=workers,
+                                         pages_per_chunk=2)
+                self.assertTrue(processor.process_file(input_path, output_path))
+                result = fitz.open(output_path)
+                links = [[(link["kind"], link.get("page"), link.get("uri")) for link in page.get_links()]
+                         for page in result]
+                results.append((links, [page.get_text() for page in result], result.get_toc()))
+            # ссылки между диапазонами разных процессов сохраняются так же, как без пула
+            self.assertEqual(results[0], results[1])
+            links, texts, toc = results[1]
+            self.assertEqual(links[0], [(fitz.LINK_GOTO, 4, None)])
+            self.assertEqual(links[4], [(fitz.LINK_GOTO, 1, None), (fitz.LINK_URI, None, "https://example.com")])
+            self.assertTrue(all("Unit 2" in text for text in texts))
+            self.assertEqual(toc, [[1, "Start", 1], [1, "Five", 5]])
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
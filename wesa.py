@@ -12,6 +12,7 @@
 """
 import os
 import logging
+import multiprocessing
 import tkinter as tk
 from Logger import GUILogHandler
 from tkinter import filedialog, messagebox, scrolledtext, ttk
@@ -35,6 +36,7 @@ class FileProcessorGUI:
             input_dir (tk.StringVar): Путь к входной папке.
             output_dir (tk.StringVar): Путь к выходной папке.
             debug_logging (tk.BooleanVar): Флаг отладочного логирования.
+            profile_rules (tk.BooleanVar): Флаг профилирования правил замены.
             config_data (dict): Загруженная конфигурация из JSON.
             lbl_project (tk.Label): Метка для отображения текущего проекта.
         """
@@ -54,6 +56,7 @@ class FileProcessorGUI:
         self.project = tk.StringVar()
         self.input_dir = tk.StringVar()
         self.debug_logging = tk.BooleanVar(value=False)
+        self.profile_rules = tk.BooleanVar(value=False)
         self.lbl_project = None
         self.config_data = config_data
         
@@ -90,6 +93,7 @@ class FileProcessorGUI:
 
         
         tk.Checkbutton(self.root, text="Отладочные логи", variable=self.debug_logging).pack(anchor="w", padx=10, pady=5)
+        tk.Checkbutton(self.root, text="Профилирование правил", variable=self.profile_rules).pack(anchor="w", padx=10)
         btn_run = tk.Button(frame_right, text="Запустить обработку",
                             command=self.run_processing,
                             bg="green", fg="white", font=("Arial", 11), padx=50, pady=5)
@@ -150,7 +154,8 @@ class FileProcessorGUI:
             messagebox.showerror("Ошибка", "Выберите существующую папку с исходными файлами!")
             return
         
-        file_handler = FileHandler(input_dir, project, repl_digit, logger=self.logger)
+        file_handler = FileHandler(input_dir, project, repl_digit, logger=self.logger,
+                                   profile=self.profile_rules.get())
         file_handler.process_files()   
 
         messagebox.showinfo(
@@ -192,6 +197,8 @@ def set_icon(root, icon_path):
     root.iconphoto(False, icon)
 
 if __name__ == "__main__":
+    # PDF обрабатываются в пуле процессов; в собранном exe дочерние процессы запускаются через него же
+    multiprocessing.freeze_support()
     root = tk.Tk()
     app = FileProcessorGUI(root)
     set_icon(root, config_handler.get_relative_path("icon.ico"))
@@ -1,136 +1,347 @@
 # word_parser.py
+import io
 import os
 import re
+import struct
+import threading
 from shutil import rmtree
 from tempfile import mkdtemp
-from zipfile import ZipFile
+from zipfile import ZipFile, BadZipFile
 from lxml import etree as ET
 import logging
+from rule_engine import rule_compiler
+from ooxml_package import (rewrite_package, package_may_match, stream_rewrite_xml, discover_parts, DOCPROPS_TYPES, DRAWING_TYPES,
+                           EMBEDDED_PACKAGE_TYPES, MAX_EMBED_DEPTH, local_name, text_nodes, split_runs)
+from excel_parser import ExcelProcessor, STREAM_PART_SIZE
+from ole_package import CompoundFile, doc_table_stream_name, doc_text_slots, patch_slots
+
+try:
+    import win32com.client as win32
+except ImportError:
+    win32 = None
+
+_WORDML = 'application/vnd.openxmlformats-officedocument.wordprocessingml.'
+# Части документа, в которых есть текст для замены
+WORD_TEXT_TYPES = frozenset({
+    _WORDML + 'document.main+xml',
+    _WORDML + 'template.main+xml',
+    'application/vnd.ms-word.document.macroEnabled.main+xml',
+    'application/vnd.ms-word.template.macroEnabledTemplate.main+xml',
+    _WORDML + 'header+xml',
+    _WORDML + 'footer+xml',
+    _WORDML + 'comments+xml',
+    _WORDML + 'footnotes+xml',
+    _WORDML + 'endnotes+xml',
+}) | DOCPROPS_TYPES | DRAWING_TYPES | frozenset(EMBEDDED_PACKAGE_TYPES)
+
+WORD_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+_W_P = '{%s}p' % WORD_NS
+_W_T = '{%s}t' % WORD_NS
+_W_TBL = '{%s}tbl' % WORD_NS
+_W_TR = '{%s}tr' % WORD_NS
+_W_TC = '{%s}tc' % WORD_NS
+_XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+
+# Заголовок таблицы, данные которой очищаются (кроме двух первых строк).
+REVISION_TABLE_TITLE = re.compile(r'Лист\s+регистрации\s+изменений|Record\s+of\s+revisions', re.IGNORECASE)
 
 
 class WordProcessor:
-    def __init__(self, replacement_digit, project, rules, logger=None):
+    def __init__(self, replacement_digit, project, rules, logger=None, project_rules=None, embed_depth=0,
+                 workers=None, stream_threshold=STREAM_PART_SIZE):
+        """
+        :param project_rules: Все разделы правил проекта ({"word_parser": ..., "excel_parser": ...})
+            для вложенных объектов; по умолчанию вложенные документы обрабатываются правилами rules,
+            а вложенные книги Excel копируются без изменений.
+        :param embed_depth: Уровень вложенности пакета (0 - файл на диске).
+        :param workers: Число потоков обработки частей пакета (см. rewrite_package).
+        :param stream_threshold: Части больше этого размера (document.xml отчётов на сотни МБ)
+            обрабатываются потоково, по одному элементу w:body.
+        """
         self.replacement_digit = str(replacement_digit)
+        self.project = project
         self.logger = logger or logging.getLogger()
+        self.stream_threshold = stream_threshold
+        self.project_rules = project_rules if project_rules is not None else {'word_parser': rules}
+        self.embed_depth = embed_depth
+        self.workers = workers
+        self._part_types = {}
+        self._embedded_processors = {}
+        # части обрабатываются в нескольких потоках, а вложенный процессор хранит состояние пакета
+        self._embed_lock = threading.Lock()
         self.patterns = self._load_patterns(rules)
-        
 
     def _load_patterns(self, rules):
-        patterns = []
-        try:
-            for rule_name, rule in rules.items():
-                try:
-                    pattern = eval(rule["pattern"], {"re": re})
-                    replacement = eval(rule["replacement"], {"self": self})
-                    patterns.append((pattern, replacement))
-                    self.logger.log(logging.DEBUG, f"Загружено правило '{rule_name}'")
-                except Exception as e:
-                    self.logger.log(logging.DEBUG, f"Ошибка загрузки правила '{rule_name}': {e}")
-        except Exception as e:
-            self.logger.log(logging.DEBUG, f"Ошибка обработки rules: {e}")
-        if not patterns:
-            self.logger.log(logging.DEBUG, "Предупреждение: Нет patterns для этого парсера")
-        return patterns
+        self.rule_set = rule_compiler.get(rules, self.replacement_digit, project=self.project,
+                                          parser='word_parser', logger=self.logger)
+        return self.rule_set.patterns
 
-    def _apply_replacements(self, text):
+    def _apply_replacements(self, text, part=None, element=None):
         if text is None:
             return None
         original_text = text
-        for pattern, repl in self.patterns:
-            text = pattern.sub(repl, text)
+        rule_set = self.rule_set if element is None else self.rule_set.scoped(part, element)
+        text = rule_set.apply(text)
         if text != original_text:
             self.logger.log(logging.DEBUG, f"Замена текста: '{original_text}' → '{text}'")
         return text
 
-    def _process_xml_tree(self, tree):
+    def _apply_replacements_batch(self, texts, part=None, elements=None):
+        """Пакетный вариант _apply_replacements для всех строк части документа.
+
+        elements - имена элементов строк для правил со scope (см. RuleSet.scoped).
+        """
+        if elements is None:
+            results = self.rule_set.apply_batch(texts)
+        else:
+            results = self.rule_set.apply_scoped(part, elements, texts)
+        changes = {(old, new) for old, new in zip(texts, results) if old != new}
+        for old, new in changes:
+            self.logger.log(logging.DEBUG, f"Замена текста: '{old}' → '{new}'")
+        return results
+
+    def _clear_revision_table(self, tbl):
+        """Очищает строки таблицы изменений, кроме двух первых; True, если было что очищать."""
+        self.logger.log(logging.DEBUG,
+                        "Найдена таблица 'Лист регистрации изменений' или 'Record of revisions'. Очистка данных в столбцах.")
+        rows = tbl.findall(_W_TR)
+        if len(rows) <= 2:
+            self.logger.log(logging.DEBUG, "Таблица найдена, но не содержит строк с данными для очистки.")
+            return False
+        for row in rows[2:]:
+            for cell in row.findall(_W_TC):
+                for t in cell.iter(_W_T):
+                    if t.text and t.text.strip():
+                        self.logger.log(logging.DEBUG, f"Очистка текста в ячейке: '{t.text.strip()}' → ''")
+                        t.text = ''
+        return True
+
+    def _process_elements(self, elements, part=None, after_title=False):
+        """Один проход по элементам части (корню дерева или пачке детей w:body).
+
+        Текст w:t собирается по абзацам (ближайший предок w:p), правила
+        применяются один раз к склеенному тексту абзаца, и результат
+        раскладывается обратно по фрагментам (split_runs). Прочий текст
+        (instrText, delText, ...) обрабатывается по узлам. По тексту тех же
+        абзацев ищется заголовок 'Лист регистрации изменений'; таблица
+        после него - следующий w:tbl среди соседей абзаца.
+
+        :param after_title: Заголовок был в конце предыдущей пачки, таблица ещё не встретилась.
+        :return: (были ли изменения, ждём ли таблицу после заголовка в следующей пачке).
+        """
+        nodes, paragraphs = [], {}
+        for root in elements:
+            for elem in root.iter():
+                if elem.tag == _W_T:
+                    paragraph = next(elem.iterancestors(_W_P), None)
+                    if paragraph is not None:
+                        paragraphs.setdefault(paragraph, []).append(elem)
+                    elif elem.text:
+                        nodes.append((elem, 'text', elem.text, 't'))
+                elif elem.text:
+                    nodes.append((elem, 'text', elem.text, local_name(elem)))
+                if elem.tail and elem is not root:
+                    parent = elem.getparent()
+                    nodes.append((elem, 'tail', elem.tail, local_name(parent) if parent is not None else ''))
+
+        groups = list(paragraphs.items())
+        texts = [value for _, _, value, _ in nodes] + [''.join(t.text or '' for t in runs) for _, runs in groups]
+        element_names = [element for _, _, _, element in nodes] + ['t'] * len(groups)
+        new_texts = self._apply_replacements_batch(texts, part, element_names)
+
         modified = False
-        nsmap = {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}
-
-        for elem in tree.iter():
-            if elem.text:
-                new_text = self._apply_replacements(elem.text)
-                if new_text != elem.text:
-                    elem.text = new_text
-                    modified = True
-            if elem.tail:
-                new_tail = self._apply_replacements(elem.tail)
-                if new_tail != elem.tail:
-                    elem.tail = new_tail
-                    modified = True
-
-        for parent in tree.findall('.//w:p', namespaces=nsmap) + tree.findall('.//w:sdtContent', namespaces=nsmap):
-            texts = parent.findall('.//w:t', namespaces=nsmap)
-            if len(texts) < 2:
-                continue
-
-            full_text = ''.join(t.text or '' for t in texts)
-            new_full_text = self._apply_replacements(full_text)
-
-            if new_full_text != full_text:
+        for (elem, attr, value, _), new_value in zip(nodes, new_texts):
+            if new_value != value:
+                setattr(elem, attr, new_value)
+                modified = True
+
+        if after_title:
+            tbl = next((elem for elem in elements if elem.tag == _W_TBL), None)
+            if tbl is not None:
+                modified = self._clear_revision_table(tbl) or modified
+                after_title = False
+        # соседи элемента пачки после неё могут быть разобраны не полностью (iterparse читает с опережением)
+        top_level = {elem: index for index, elem in enumerate(elements)}
+        for (paragraph, runs), text, new_text in zip(groups, texts[len(nodes):], new_texts[len(nodes):]):
+            if new_text != text:
                 modified = True
-                idx = 0
-                for t in texts:
-                    if t.text is not None:
-                        part_len = len(t.text)
-                        t.text = new_full_text[idx:idx + part_len]
-                        idx += part_len
-
-        for p in tree.findall('.//w:p', namespaces=nsmap):
-            para_texts = ''.join(t.text or '' for t in p.findall('.//w:t', namespaces=nsmap)).strip()
-            if re.search(r'Лист\s+регистрации\s+изменений|Record\s+of\s+revisions', para_texts, re.IGNORECASE):
-                tbl = p.getnext()
-                while tbl is not None and tbl.tag != '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}tbl':
-                    tbl = tbl.getnext()
+                for t, value in zip(runs, split_runs([t.text or '' for t in runs], new_text)):
+                    t.text = value
+                    if value != value.strip():
+                        t.set(_XML_SPACE, 'preserve')
+            if REVISION_TABLE_TITLE.search(new_text):
+                if paragraph in top_level:
+                    following = elements[top_level[paragraph] + 1:]
+                    tbl = next((elem for elem in following if elem.tag == _W_TBL), None)
+                else:
+                    tbl = next(paragraph.itersiblings(_W_TBL), None)
                 if tbl is not None:
-                    self.logger.log(logging.DEBUG, 
-                         "Найдена таблица 'Лист регистрации изменений' или 'Record of revisions'. Очистка данных в столбцах.")
-                    rows = tbl.findall('w:tr', namespaces=nsmap)
-                    if len(rows) > 1:
-                        for row in rows[2:]:
-                            cells = row.findall('w:tc', namespaces=nsmap)
-                            for cell in cells:
-                                for t in cell.findall('.//w:t', namespaces=nsmap):
-                                    if t.text and t.text.strip():
-                                        self.logger.log(logging.DEBUG, f"Очистка текста в ячейке: '{t.text.strip()}' → ''")
-                                        t.text = ''
-                            modified = True
-                    else:
-                        self.logger.log(logging.DEBUG, "Таблица найдена, но не содержит строк с данными для очистки.")
+                    modified = self._clear_revision_table(tbl) or modified
+                elif paragraph in top_level:
+                    after_title = True   # таблица будет в следующей пачке (потоковый режим)
+        return modified, after_title
+
+    def _process_xml_tree(self, tree, part=None):
+        return self._process_elements([tree.getroot()], part)[0]
 
+    def _process_part(self, fname, data):
+        """Обрабатывает XML-часть пакета; возвращает новые байты или None, если изменений нет."""
+        try:
+            parser = ET.XMLParser(remove_blank_text=True)
+            tree = ET.fromstring(data, parser).getroottree()
+        except ET.XMLSyntaxError as e:
+            self.logger.log(logging.DEBUG, f"Ошибка XML в {fname}: {e}")
+            return None
+        if not self._process_xml_tree(tree, fname):
+            return None
+        self.logger.log(logging.DEBUG, f"Файл изменен: {fname}")
+        return ET.tostring(tree, encoding='UTF-8', xml_declaration=True, pretty_print=True)
+
+    def _process_part_stream(self, fname, src, dst):
+        """Потоковая обработка большой части: дети w:body по одному, без pretty_print.
+
+        В памяти держится одна пачка элементов (абзацев, таблиц, блоков sdt).
+        """
+        after_title = False
+
+        def process_chunk(elements):
+            nonlocal after_title
+            modified, after_title = self._process_elements(elements, fname, after_title)
+            return modified
+
+        modified = stream_rewrite_xml(src, dst, ('body',), process_chunk)
+        if modified:
+            self.logger.log(logging.DEBUG, f"Файл изменен: {fname}")
         return modified
 
+    def _process_package_stream(self, fname, src, dst):
+        if self._part_types.get(fname) in EMBEDDED_PACKAGE_TYPES:
+            data = src.read()
+            new_data = self._process_embedded(fname, data)
+            dst.write(data if new_data is None else new_data)
+            return new_data is not None
+        return self._process_part_stream(fname, src, dst)
+
+    def _embedded_processor(self, parser):
+        if parser not in self._embedded_processors:
+            rules = self.project_rules.get(parser)
+            if rules is None:
+                return None
+            processor_class = WordProcessor if parser == 'word_parser' else ExcelProcessor
+            self._embedded_processors[parser] = processor_class(
+                self.replacement_digit, self.project, rules, logger=self.logger,
+                project_rules=self.project_rules, embed_depth=self.embed_depth + 1, workers=1)
+        return self._embedded_processors[parser]
+
+    def _process_embedded(self, fname, data):
+        """Обрабатывает вложенный пакет (объект Word или Excel) в памяти; возвращает новые байты или None."""
+        if self.embed_depth >= MAX_EMBED_DEPTH:
+            self.logger.log(logging.DEBUG, f"Пропущен вложенный объект (слишком глубокая вложенность): {fname}")
+            return None
+        processor = self._embedded_processor(EMBEDDED_PACKAGE_TYPES[self._part_types[fname]])
+        if processor is None:
+            self.logger.log(logging.DEBUG, f"Пропущен вложенный объект (нет правил): {fname}")
+            return None
+        self.logger.log(logging.DEBUG, f"Обработка вложенного объекта: {fname}")
+        try:
+            with self._embed_lock:
+                return processor.process_bytes(data)
+        except (BadZipFile, ValueError, KeyError, ET.XMLSyntaxError) as e:
+            self.logger.log(logging.DEBUG, f"Вложенный объект {fname} не обработан: {e}")
+            return None
+
+    def _process_package_part(self, fname, data):
+        if self._part_types.get(fname) in EMBEDDED_PACKAGE_TYPES:
+            return self._process_embedded(fname, data)
+        return self._process_part(fname, data)
+
+    def process_package(self, input_path, output_path):
+        """Переписывает пакет OOXML (путь или файловый объект); возвращает имена изменённых частей."""
+        with ZipFile(input_path) as zip_in:
+            self._part_types = discover_parts(zip_in, WORD_TEXT_TYPES)
+        self.logger.log(logging.DEBUG, f"Части с текстом: {', '.join(self._part_types)}")
+        return rewrite_package(input_path, output_path, self._part_types, self._process_package_part,
+                               logger=self.logger, stream_part=self._process_package_stream,
+                               stream_threshold=self.stream_threshold, workers=self.workers)
+
+    def process_bytes(self, data):
+        """Обрабатывает пакет в памяти; возвращает новые байты или None, если изменений нет."""
+        output = io.BytesIO()
+        if not self.process_package(io.BytesIO(data), output):
+            return None
+        return output.getvalue()
+
+    def _process_doc_inplace(self, input_path, output_path):
+        """Замена текста .doc/.dot прямо в потоке WordDocument, без Word.
+
+        :return: True, если файл записан; False - нужна конвертация в .docx.
+        """
+        try:
+            compound = CompoundFile.open(input_path)
+            word_document = compound.read_stream('WordDocument')
+            table = compound.read_stream(doc_table_stream_name(word_document))
+            slots = doc_text_slots(word_document, table)
+        except (ValueError, KeyError, struct.error) as e:
+            self.logger.log(logging.DEBUG, f"Замена на месте невозможна ({input_path}): {e}")
+            return False
+        if any(REVISION_TABLE_TITLE.search(slot.text) for slot in slots):
+            # очистка таблицы меняет длину текста - только через .docx
+            self.logger.log(logging.DEBUG, f"Найден 'Лист регистрации изменений', нужна конвертация: {input_path}")
+            return False
+        new_texts = self._apply_replacements_batch([slot.text for slot in slots],
+                                                   elements=[slot.element for slot in slots])
+        patched, info = patch_slots(word_document, slots, new_texts)
+        if not patched:
+            self.logger.log(logging.DEBUG, f"Замена на месте невозможна ({input_path}): {info}")
+            return False
+        compound.write_stream('WordDocument', word_document)
+        compound.save(output_path)
+        self.logger.log(logging.DEBUG, f"Изменено абзацев: {info}. Файл обработан без конвертации: {output_path}")
+        return True
+
+    def _could_change(self, text):
+        return self.rule_set.could_match(text) or REVISION_TABLE_TITLE.search(text) is not None
+
+    def may_change(self, input_path):
+        """Быстрая проверка пакета без разбора XML: False, если обработка точно ничего не изменит
+        (тогда файл можно просто скопировать). Для .doc всегда True.
+        """
+        if input_path.lower().endswith(('.doc', '.dot')):
+            return True
+        try:
+            with ZipFile(input_path) as zip_in:
+                return package_may_match(zip_in, WORD_TEXT_TYPES, self._could_change)
+        except (BadZipFile, ValueError, KeyError, OSError):
+            return True
+
     def process_file(self, input_path, output_path):
-        tmp_dir = mkdtemp()
+        tmp_dir = None
         self.logger.log(logging.DEBUG, f"Открыт файл: {input_path}")
-        modified_files = set()
 
         try:
-            with ZipFile(input_path) as zip_in:
-                filenames = zip_in.namelist()
-                zip_in.extractall(tmp_dir)
-
-            target_files = ['word/document.xml', 'docProps/core.xml']
-            target_files += [f for f in filenames if f.startswith('word/header') or f.startswith('word/footer')]
-
-            for fname in target_files:
-                full_path = os.path.join(tmp_dir, fname)
-                if not os.path.exists(full_path) or os.path.getsize(full_path) == 0:
-                    self.logger.log(logging.DEBUG, f"Пропущен файл (отсутствует или пуст): {fname}")
-                    continue
-                try:
-                    parser = ET.XMLParser(remove_blank_text=True)
-                    tree = ET.parse(full_path, parser)
-                    modified = self._process_xml_tree(tree)
-                    if modified:
-                        tree.write(full_path, encoding='UTF-8', xml_declaration=True, pretty_print=True)
-                        modified_files.add(fname)
-                        self.logger.log(logging.DEBUG, f"Файл изменен: {fname}")
-                except ET.XMLSyntaxError as e:
-                    self.logger.log(logging.DEBUG, f"Ошибка XML в {fname}: {e}")
-
-            with ZipFile(output_path, 'w') as zip_out:
-                for fname in filenames:
-                    zip_out.write(os.path.join(tmp_dir, fname), fname)
+            if input_path.lower().endswith(('.doc', '.dot')):
+                if self._process_doc_inplace(input_path, output_path):
+                    return True
+                output_path = os.path.splitext(output_path)[0] + '.docx'
+                self.logger.log(logging.DEBUG, f"Конвертируем {input_path} в .docx...")
+                tmp_dir = mkdtemp()
+                temp_input = os.path.join(tmp_dir, 'converted.docx')
+
+                if win32:
+                    word = win32.Dispatch('Word.Application')
+                    word.Visible = False
+                    doc = word.Documents.Open(os.path.abspath(input_path))
+                    doc.SaveAs2(os.path.abspath(temp_input), FileFormat=16)  # 16 = docx
+                    doc.Close()
+                    word.Quit()
+                    self.logger.log(logging.DEBUG, f"Конвертация завершена: {temp_input}")
+                else:
+                    raise ImportError(
+                        "pywin32 не установлен. Установите 'pip install pywin32' для конвертации на Windows.")
+
+                input_path = temp_input
+
+            self.process_package(input_path, output_path)
 
             self.logger.log(logging.DEBUG, f"Файл успешно обработан: {output_path}")
             return True
@@ -140,4 +351,5 @@ class WordProcessor:
             return False
 
         finally:
-            rmtree(tmp_dir, ignore_errors=True)
\ No newline at end of file
+            if tmp_dir:
+                rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,241 @@
+# xlsb_package.py
+"""Модуль xlsb_package.py: Потоковая замена строк в двоичных частях книг Excel (.xlsb, BIFF12).
+
+Части .xlsb (xl/sharedStrings.bin, xl/worksheets/sheetN.bin) - это
+последовательность записей: тип (1-2 байта), размер (1-4 байта), данные.
+Оба числа - целые переменной длины (7 бит в байте, старший бит - "есть
+продолжение"). Записи читаются из потока буфером фиксированного размера и
+пишутся в выходной поток пачками, поэтому расход памяти не зависит от
+размера листа.
+
+Обрабатываются записи с текстом:
+    BrtSSTItem           - строка таблицы общих строк (RichStr, с форматированием по фрагментам);
+    BrtCellSt            - ячейка с inline-строкой;
+    BrtBeginHeaderFooter - колонтитулы листа.
+Остальные записи (в том числе формулы - они хранятся в разобранном виде)
+копируются без изменений.
+"""
+import struct
+from ooxml_package import split_runs
+
+BRT_CELL_ST = 6
+BRT_SST_ITEM = 19
+BRT_BEGIN_HEADER_FOOTER = 479
+
+_READ_CHUNK = 1024 * 1024
+_NULL_STRING = 0xFFFFFFFF
+_RICH_STR = 0x01
+_EXT_STR = 0x02
+
+
+def _encode_varint(value, max_bytes):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            break
+    if len(out) > max_bytes:
+        raise ValueError("Значение не помещается в заголовок записи BIFF12")
+    return bytes(out)
+
+
+def write_record(dst, record_type, payload):
+    dst.write(_encode_varint(record_type, 2) + _encode_varint(len(payload), 4) + payload)
+
+
+def read_records(src):
+    """Записи BIFF12 из потока: пары (тип, данные)."""
+    buffer, pos = b'', 0
+    eof = False
+
+    def fill(need):
+        nonlocal buffer, pos, eof
+        while len(buffer) - pos < need and not eof:
+            chunk = src.read(max(_READ_CHUNK, need))
+            if not chunk:
+                eof = True
+                break
+            buffer = buffer[pos:] + chunk
+            pos = 0
+        return len(buffer) - pos >= need
+
+    def varint(max_bytes):
+        nonlocal pos
+        value = 0
+        for shift in range(0, 7 * max_bytes, 7):
+            if not fill(1):
+                raise ValueError("Неожиданный конец записи BIFF12")
+            byte = buffer[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+        return value
+
+    while fill(1):
+        record_type = varint(2)
+        size = varint(4)
+        if not fill(size):
+            raise ValueError("Неожиданный конец записи BIFF12")
+        yield record_type, buffer[pos:pos + size]
+        pos += size
+
+
+def _read_wide_string(payload, offset, nullable=False):
+    """XLWideString: (текст или None, смещение после строки)."""
+    count = struct.unpack_from('<I', payload, offset)[0]
+    offset += 4
+    if nullable and count == _NULL_STRING:
+        return None, offset
+    end = offset + count * 2
+    if end > len(payload):
+        raise ValueError("Строка выходит за пределы записи BIFF12")
+    return payload[offset:end], end
+
+
+def _wide_string(raw):
+    return struct.pack('<I', len(raw) // 2) + raw
+
+
+def _decode(raw):
+    return raw.decode('utf-16-le', errors='surrogatepass')
+
+
+def _encode(text):
+    return text.encode('utf-16-le', errors='surrogatepass')
+
+
+class TextRecord:
+    """Текстовые фрагменты записи и сборка новой записи из изменённых фрагментов.
+
+    elements - имена соответствующих элементов SpreadsheetML ('t', 'oddHeader', ...) для scope правил.
+    """
+    __slots__ = ('texts', 'elements', '_build')
+
+    def __init__(self, texts, elements, build):
+        self.texts = texts
+        self.elements = elements
+        self._build = build
+
+    def build(self, new_texts):
+        """Новые данные записи или None, если запись нельзя изменить (её нужно оставить как есть)."""
+        return self._build([_encode(text) for text in new_texts])
+
+
+def _cell_string(payload):
+    raw, end = _read_wide_string(payload, 8)
+    head, tail = payload[:8], payload[end:]
+    return TextRecord([_decode(raw)], ['t'], lambda new: head + _wide_string(new[0]) + tail)
+
+
+def _sst_item(payload):
+    flags = payload[0]
+    raw, pos = _read_wide_string(payload, 1)
+    runs = []
+    if flags & _RICH_STR:
+        count = struct.unpack_from('<I', payload, pos)[0]
+        runs = [struct.unpack_from('<HH', payload, pos + 4 + 4 * k) for k in range(count)]
+        pos += 4 + 4 * count
+    tail = payload[pos:]
+
+    # строка обрабатывается целиком, как склеенные r/t в sharedStrings.xml; новый текст
+    # раскладывается по фрагментам с одним шрифтом через split_runs
+    bounds = sorted({0, len(raw) // 2} | {min(ich, len(raw) // 2) for ich, _ in runs})
+    segments = [_decode(raw[2 * start:2 * end]) for start, end in zip(bounds, bounds[1:])]
+
+    def build(new):
+        text = _decode(new[0])
+        pieces = split_runs(segments, text) if len(segments) > 1 else [text]
+        lengths = [len(_encode(piece)) // 2 for piece in pieces]
+        if flags & _EXT_STR and lengths != [len(_encode(segment)) // 2 for segment in segments]:
+            return None  # фонетические фрагменты ссылаются на позиции исходной строки
+        starts = dict(zip(bounds, [0] + [sum(lengths[:k + 1]) for k in range(len(lengths))]))
+        out = bytes([flags]) + _wide_string(new[0])
+        if flags & _RICH_STR:
+            out += struct.pack('<I', len(runs))
+            out += b''.join(struct.pack('<HH', starts[min(ich, len(raw) // 2)], font) for ich, font in runs)
+        return out + tail
+
+    return TextRecord([_decode(raw)], ['t'], build)
+
+
+# Порядок строк в BrtBeginHeaderFooter
+_HEADER_FOOTER_ELEMENTS = ('oddHeader', 'oddFooter', 'evenHeader', 'evenFooter', 'firstHeader', 'firstFooter')
+
+
+def _header_footer(payload):
+    raws, pos = [], 2
+    for _ in range(6):
+        raw, pos = _read_wide_string(payload, pos, nullable=True)
+        raws.append(raw)
+    head, tail = payload[:2], payload[pos:]
+    present = [(raw, element) for raw, element in zip(raws, _HEADER_FOOTER_ELEMENTS) if raw is not None]
+
+    def build(new):
+        replaced = iter(new)
+        strings = [struct.pack('<I', _NULL_STRING) if raw is None else _wide_string(next(replaced))
+                   for raw in raws]
+        return head + b''.join(strings) + tail
+
+    return TextRecord([_decode(raw) for raw, _ in present], [element for _, element in present], build)
+
+
+TEXT_RECORDS = {
+    BRT_CELL_ST: _cell_string,
+    BRT_SST_ITEM: _sst_item,
+    BRT_BEGIN_HEADER_FOOTER: _header_footer,
+}
+
+
+def rewrite_records(src, dst, process_texts, chunk_size=500):
+    """Переписывает часть .xlsb из потока src в поток dst.
+
+    Текст записей из TEXT_RECORDS передаётся в process_texts(строки, имена
+    элементов) -> список новых строк пачками примерно по chunk_size записей;
+    прочие записи копируются как есть.
+
+    :return: True, если хотя бы одна запись изменилась.
+    """
+    modified = False
+    pending = []   # (тип, данные, TextRecord или None)
+    text_count = 0
+
+    def flush():
+        nonlocal modified, text_count
+        texts = [text for _, _, record in pending if record for text in record.texts]
+        elements = [element for _, _, record in pending if record for element in record.elements]
+        new_texts = iter(process_texts(texts, elements)) if texts else iter(())
+        out = []
+        for record_type, payload, record in pending:
+            if record is not None:
+                new = [next(new_texts) for _ in record.texts]
+                if new != record.texts:
+                    rebuilt = record.build(new)
+                    if rebuilt is not None:
+                        payload = rebuilt
+                        modified = True
+            out.append(_encode_varint(record_type, 2) + _encode_varint(len(payload), 4))
+            out.append(payload)
+        dst.write(b''.join(out))
+        pending.clear()
+        text_count = 0
+
+    for record_type, payload in read_records(src):
+        parse = TEXT_RECORDS.get(record_type)
+        record = None
+        if parse is not None:
+            try:
+                record = parse(payload)
+            except (ValueError, struct.error, IndexError):
+                record = None  # повреждённую запись не трогаем
+        pending.append((record_type, payload, record))
+        if record is not None:
+            text_count += 1
+        if text_count >= chunk_size or len(pending) >= chunk_size * 20:
+            flush()
+    flush()
+    return modified